@@ -1,20 +1,46 @@
-from flask import Flask, jsonify, request
+import server_mode
+# eventletを使う場合は、他のモジュールを読み込む前に標準ライブラリを置き換える
+server_mode.monkey_patch()
+from flask import Flask, jsonify, request, g, Response
 from flask_cors import CORS
 import os
 import json
 from flask_socketio import SocketIO
-from usb_detector import list_usb_devices
-from iso_writer import write_iso_to_device, get_iso_files
+from usb_detector import list_usb_devices, get_usb_location
+from iso_writer import write_iso_to_device, wipe_device, get_iso_files, unmount_device
+import write_journal
+import image_cache
+import buffer_pool
+import iso_upload
+import http_source
+import image_store
+import batch
+import bus_scheduler
+import cluster
+import device_registry
+import device_history
+import capacity_probe
 import platform
 import subprocess
 import time
+import uuid
+from collections import OrderedDict
+from telemetry import WriteTelemetry
+import metrics
+import log_pipeline
+from log_pipeline import log
 
 app = Flask(__name__)
 # CORS設定を修正して認証関連のヘッダーを許可
 CORS(app, supports_credentials=True, expose_headers=['Authorization'])
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=server_mode.ASYNC_MODE)
+# 書き込みジョブのスレッドからの進捗通知もここを経由して送る
+emitter = server_mode.Emitter(socketio)
+run_blocking = server_mode.run_blocking
 
-ISO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "isos")
+ISO_DIR = os.environ.get("YAKERU_ISO_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "isos")
+# 1台のマシンで複数のノードを動かす場合はポートを変える
+PORT = int(os.environ.get("YAKERU_PORT", "5000"))
 
 # 書き込み状態追跡用のグローバル変数
 write_status = {
@@ -25,20 +51,36 @@ write_status = {
 # 書き込み中フラグを追加
 is_writing_active = False
 
-# デバッグ用のミドルウェアを追加して、すべてのリクエストとレスポンスをログ出力
+# 実行中ジョブのテレメトリと、直近のジョブ履歴（job_id -> WriteTelemetry）
+current_telemetry = None
+job_history = OrderedDict()
+JOB_HISTORY_LIMIT = 20
+
+# すべてのリクエストのレイテンシを記録（ヘッダーやボディは読まず、1リクエスト1レコードだけ）
 @app.before_request
 def log_request_info():
-    """リクエスト情報をログに記録"""
-    app.logger.debug('Request Headers: %s', request.headers)
-    app.logger.debug('Request Body: %s', request.get_data())
+    """リクエストの開始時刻を記録"""
+    g.request_start = time.perf_counter()
 
 @app.after_request
 def log_response_info(response):
     """レスポンス情報をログに記録"""
-    app.logger.debug('Response Status: %s', response.status)
-    app.logger.debug('Response Headers: %s', response.headers)
+    _observe_request_latency(response)
     return response
 
+def _observe_request_latency(response):
+    """ルートごとのリクエストレイテンシをメトリクスとログ（debug）に記録"""
+    start = getattr(g, "request_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.HTTP_REQUEST_LATENCY.observe(
+        elapsed, method=request.method, route=route, status=response.status_code)
+    log("request", f"{request.method} {request.path} {response.status_code}", level="debug",
+        method=request.method, route=route, status=response.status_code,
+        duration_ms=round(elapsed * 1000, 2))
+
 # アプリケーション起動時に書き込み状態をリセットする
 @app.before_first_request
 def reset_write_status_on_startup():
@@ -49,7 +91,7 @@ def reset_write_status_on_startup():
         "status": "idle"
     }
     is_writing_active = False
-    print("Write status reset on startup")
+    log("server", "Write status reset on startup")
 
 # ヘルスチェック用のエンドポイント追加
 @app.route('/api/health', methods=['GET'])
@@ -65,26 +107,99 @@ def health_check():
 def get_isos():
     """ISOファイルの一覧を取得"""
     try:
-        iso_files = get_iso_files(ISO_DIR)
+        iso_files = run_blocking(get_iso_files, ISO_DIR)
         return jsonify({"isos": iso_files})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def _upload_error_response(e):
+    body = {"error": str(e)}
+    if e.offset is not None:
+        body["offset"] = e.offset
+    response = jsonify(body)
+    if e.offset is not None:
+        response.headers["Upload-Offset"] = str(e.offset)
+    return response, e.status
+
+def _upload_response(session, status=200):
+    response = jsonify(session)
+    response.headers["Upload-Offset"] = str(session["offset"])
+    return response, status
+
+@app.route('/api/uploads', methods=['GET', 'POST'])
+def create_upload():
+    """ISOファイルのアップロードを開始（GETでは未完了のアップロード一覧）"""
+    try:
+        if request.method == 'GET':
+            return jsonify({"uploads": iso_upload.list_uploads(ISO_DIR)})
+        
+        data = request.json or {}
+        os.makedirs(ISO_DIR, exist_ok=True)
+        session = iso_upload.create_upload(
+            ISO_DIR, data.get('filename'), size=data.get('size'), sha256=data.get('sha256'))
+        return _upload_response(session, 201)
+    except iso_upload.UploadError as e:
+        return _upload_error_response(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'PUT', 'DELETE'])
+def upload_chunk(upload_id):
+    """アップロードの状態取得・データ送信・中止
+
+    PUTのボディはチャンクごとにそのままディスクへ書き込む。
+    Upload-Offset ヘッダー（省略時は書き込み済みの末尾）から再開できる。
+    """
+    try:
+        if request.method == 'GET':
+            return _upload_response(iso_upload.get_upload(ISO_DIR, upload_id))
+        if request.method == 'DELETE':
+            iso_upload.get_upload(ISO_DIR, upload_id)
+            iso_upload.cancel_upload(ISO_DIR, upload_id)
+            return jsonify({"success": True})
+        
+        offset = request.headers.get('Upload-Offset', request.args.get('offset'))
+        session = iso_upload.write_chunk(
+            ISO_DIR, upload_id, request.stream, offset=int(offset) if offset is not None else None)
+        return _upload_response(session)
+    except iso_upload.UploadError as e:
+        return _upload_error_response(e)
+    except ValueError:
+        return jsonify({"error": "Invalid Upload-Offset"}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    """サイズを指定せずに開始したアップロードを完了して登録"""
+    try:
+        return _upload_response(iso_upload.complete_upload(ISO_DIR, upload_id))
+    except iso_upload.UploadError as e:
+        return _upload_error_response(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/usb-devices', methods=['GET'])
 def get_usb_devices():
-    """利用可能なUSBデバイスの一覧を取得"""
+    """利用可能なUSBデバイスの一覧を取得（?min_size=バイト数 でそれ以上の容量のデバイスだけ）"""
     global is_writing_active
     
     try:
+        min_size = request.args.get('min_size')
+        if min_size is not None:
+            if not min_size.isdigit():
+                return jsonify({"error": "min_size must be a number of bytes", "devices": []}), 400
+            min_size = int(min_size)
         # 書き込み中はデバイス一覧取得をブロック
         if is_writing_active:
-            print("Blocked USB device scan during active write operation")
+            log("device", "Blocked USB device scan during active write operation", level="debug")
             return jsonify({"devices": [], "blocked": True, "message": "Device scan blocked during write operation"}), 423
             
-        devices = list_usb_devices()
+        with metrics.DEVICE_SCAN_LATENCY.time(source="list"):
+            devices = run_blocking(list_usb_devices, min_size)
         return jsonify({"devices": devices})
     except Exception as e:
-        print(f"Error in get_usb_devices: {str(e)}")
+        log("device", f"Error in get_usb_devices: {e}", level="error")
         return jsonify({"error": str(e), "devices": []}), 500  # 500を返してクライアント側でもエラー処理
         
 @app.route('/api/write', methods=['POST'])
@@ -96,46 +211,93 @@ def write_iso():
         # 書き込み中なら新たな書き込みを拒否
         if is_writing_active:
             return jsonify({"error": "Write operation already in progress"}), 409
+        if batch.active_batches():
+            return jsonify({"error": "A batch is in progress"}), 409
             
         data = request.json
         iso_file = data.get('iso_file')
+        iso_url = data.get('iso_url')
         device = data.get('device')
+        resume = bool(data.get('resume', False))
+        verify = bool(data.get('verify', False))
+        skip_if_current = bool(data.get('skip_if_current', False))
+        probe_capacity = bool(data.get('probe_capacity', False))
         
-        if not iso_file or not device:
+        if not (iso_file or iso_url) or not device:
             return jsonify({"error": "ISO file and device must be specified"}), 400
-            
-        iso_path = os.path.join(ISO_DIR, iso_file)
         
-        if not os.path.exists(iso_path):
-            return jsonify({"error": f"ISO file {iso_file} not found"}), 404
+        cache_dir = None
+        if iso_url:
+            # HTTP(S)のURLから直接書き込む（cache=trueならISO_DIRにも保存して次回はローカルから読む）
+            if not http_source.is_url(iso_url):
+                return jsonify({"error": "iso_url must be an http:// or https:// URL"}), 400
+            iso_path = iso_url
+            if data.get('cache', False):
+                cached = http_source.cached_copy(iso_url, ISO_DIR)
+                if cached:
+                    log("http", f"Using cached copy of {iso_url}: {cached}", url=iso_url)
+                    iso_path = cached
+                else:
+                    cache_dir = ISO_DIR
+        else:
+            iso_path = os.path.join(ISO_DIR, iso_file)
+            
+            if not os.path.exists(iso_path):
+                return jsonify({"error": f"ISO file {iso_file} not found"}), 404
+            # デバイスの容量（容量プローブで偽装が分かっていれば実際の容量）に収まらないイメージは書き込まない
+            try:
+                run_blocking(capacity_probe.ensure_fits, device, os.path.getsize(iso_path))
+            except OSError as e:
+                return jsonify({"error": e.strerror}), 413
         
         # Linux環境での連続書き込み対策: 前回の完了ステータスをクリアしてからスタート
         if platform.system() == "Linux" and write_status.get("status") == "completed":
-            print("Clearing previous completed status before starting new write operation")
+            log("write", "Clearing previous completed status before starting new write operation")
             write_status = {"progress": 0, "status": "idle"}
             time.sleep(1)  # 状態変更が確実に伝わるよう少し待機
         
+        # ジョブごとのテレメトリを用意
+        job_id = uuid.uuid4().hex[:12]
+        telemetry = _register_job(job_id, device)
+        
         # 書き込み状態をリセットし、書き込み中フラグを設定
-        write_status = {"progress": 0, "status": "started"}
+        write_status = {"progress": 0, "status": "started", "job_id": job_id,
+                        "telemetry": telemetry.snapshot()}
         is_writing_active = True
             
         # 非同期で書き込み処理を開始
-        socketio.start_background_task(
-            write_iso_to_device_wrapper, iso_path, device, progress_callback
+        server_mode.spawn_worker(
+            write_iso_to_device_wrapper, iso_path, device, progress_callback, telemetry, resume,
+            cache_dir, verify, skip_if_current, probe_capacity
         )
         
-        return jsonify({"status": "Writing started"})
+        return jsonify({"status": "Writing started", "job_id": job_id})
     except Exception as e:
         # エラー時は書き込み中フラグを解除
         is_writing_active = False
         return jsonify({"error": str(e)}), 500
 
+def _register_job(job_id, device):
+    """新しいジョブのテレメトリを作成し、履歴に登録する"""
+    global current_telemetry
+    
+    telemetry = WriteTelemetry(job_id=job_id, device=device)
+    job_history[job_id] = telemetry
+    while len(job_history) > JOB_HISTORY_LIMIT:
+        job_history.popitem(last=False)
+    current_telemetry = telemetry
+    return telemetry
+
 # 書き込み処理のラッパー関数を追加（書き込み完了時にフラグをリセットする）
-def write_iso_to_device_wrapper(iso_path, device_path, callback):
+def write_iso_to_device_wrapper(iso_path, device_path, callback, telemetry=None, resume=False,
+                                cache_dir=None, verify=False, skip_if_current=False,
+                                probe_capacity=False):
     global is_writing_active
     
     try:
-        result = write_iso_to_device(iso_path, device_path, callback)
+        result = write_iso_to_device(iso_path, device_path, callback, telemetry, resume=resume,
+                                     cache_dir=cache_dir, verify=verify,
+                                     skip_if_current=skip_if_current, probe_capacity=probe_capacity)
         return result
     except Exception as e:
         # 例外をそのまま伝搬
@@ -144,7 +306,269 @@ def write_iso_to_device_wrapper(iso_path, device_path, callback):
         # 書き込み完了後に処理が行われるが、
         # is_writing_activeフラグは既にcallback内でリセットされているため
         # ここでは追加のリセット処理を行わない（二重リセット防止）
-        print("Write operation completed in wrapper function")
+        if telemetry is not None:
+            metrics.observe_write_job(telemetry)
+            batch.record_job(telemetry)
+        log("write", "Write operation completed in wrapper function", level="debug",
+            job_id=telemetry.job_id if telemetry is not None else None, device=device_path)
+
+@app.route('/api/batches', methods=['GET', 'POST'])
+def create_batch():
+    """マニフェストに従ってまとめて書き込みを開始（GETではバッチ一覧）
+
+    dry_run=trueの場合は割り当てと推定時間だけを返す
+    """
+    try:
+        if request.method == 'GET':
+            return jsonify({"batches": [b.snapshot() for b in batch.list_batches()],
+                            "device_rates_mbps": batch.RATES.snapshot()})
+        
+        manifest = request.json or {}
+        if not manifest.get('dry_run'):
+            if is_writing_active:
+                return jsonify({"error": "Write operation already in progress"}), 409
+            if batch.active_batches():
+                return jsonify({"error": "A batch is already in progress"}), 409
+        
+        with metrics.DEVICE_SCAN_LATENCY.time(source="batch"):
+            devices = [d["id"] for d in run_blocking(list_usb_devices)]
+        dry_run = bool(manifest.get('dry_run'))
+        new_batch = run_blocking(batch.create_batch, manifest, ISO_DIR, devices, register=not dry_run)
+        if dry_run:
+            return jsonify(new_batch.snapshot())
+        
+        new_batch.start(server_mode.spawn_worker, _register_job, _emit_batch_progress)
+        return jsonify(new_batch.snapshot()), 202
+    except batch.BatchError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    """バッチ全体の進捗・ETAと各ジョブの状態を取得"""
+    found = batch.get_batch(batch_id)
+    if found is None:
+        return jsonify({"error": f"Batch {batch_id} not found"}), 404
+    return jsonify(found.snapshot())
+
+@app.route('/api/batches/<batch_id>/cancel', methods=['POST'])
+def cancel_batch(batch_id):
+    """未開始のジョブを取り消す（書き込み中のジョブは最後まで実行）"""
+    found = batch.get_batch(batch_id)
+    if found is None:
+        return jsonify({"error": f"Batch {batch_id} not found"}), 404
+    found.cancel()
+    return jsonify(found.snapshot())
+
+def _emit_batch_progress(current_batch):
+    emitter.emit('batch_progress', current_batch.snapshot())
+
+@app.route('/api/cluster/nodes', methods=['GET', 'POST'])
+def cluster_nodes():
+    """クラスタのノード一覧（POSTでノードを登録）"""
+    try:
+        if request.method == 'POST':
+            data = request.json or {}
+            node = cluster.add_node(data.get('url'), data.get('name'))
+            return jsonify(node.snapshot()), 201
+        return jsonify({"nodes": [node.snapshot() for node in run_blocking(cluster.refresh_nodes)]})
+    except cluster.ClusterError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/cluster/nodes/<name>', methods=['DELETE'])
+def remove_cluster_node(name):
+    try:
+        cluster.remove_node(name)
+        return jsonify({"removed": name})
+    except cluster.ClusterError as e:
+        return jsonify({"error": str(e)}), e.status
+
+@app.route('/api/cluster/devices', methods=['GET'])
+def cluster_devices():
+    """全ノードのUSBデバイス一覧（各デバイスにnodeを付加）"""
+    try:
+        nodes = run_blocking(cluster.refresh_nodes)
+        return jsonify({"devices": cluster.aggregate_devices(nodes),
+                        "nodes": [node.snapshot() for node in nodes]})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/cluster/isos', methods=['GET'])
+def cluster_isos():
+    """全ノードのISOファイル一覧（ファイルごとに持っているノードを付加）"""
+    try:
+        return jsonify({"isos": cluster.aggregate_isos(run_blocking(cluster.refresh_nodes))})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/cluster/jobs', methods=['GET', 'POST'])
+def cluster_jobs():
+    """マニフェストのジョブをノードに割り振って書き込みを開始（GETではジョブ一覧）
+
+    dry_run=trueの場合はノードへの割り当てだけを返す
+    """
+    try:
+        if request.method == 'GET':
+            return jsonify({"jobs": [job.snapshot() for job in cluster.list_jobs()]})
+        manifest = request.json or {}
+        dry_run = bool(manifest.get('dry_run'))
+        job = run_blocking(cluster.create_job, manifest, register=not dry_run)
+        if dry_run:
+            return jsonify(job.snapshot())
+        job.start(socketio.start_background_task, _emit_cluster_progress)
+        return jsonify(job.snapshot()), 202
+    except cluster.ClusterError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/cluster/jobs/<job_id>', methods=['GET'])
+def get_cluster_job(job_id):
+    """全ノードをまとめた進捗・ETAと各ジョブの状態を取得"""
+    job = cluster.get_job(job_id)
+    if job is None:
+        return jsonify({"error": f"Cluster job {job_id} not found"}), 404
+    return jsonify(job.snapshot())
+
+@app.route('/api/cluster/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_cluster_job(job_id):
+    job = cluster.get_job(job_id)
+    if job is None:
+        return jsonify({"error": f"Cluster job {job_id} not found"}), 404
+    job.cancel()
+    return jsonify(job.snapshot())
+
+def _emit_cluster_progress(job):
+    emitter.emit('cluster_progress', job.snapshot())
+
+@app.route('/api/device-registry', methods=['GET'])
+def get_device_registry():
+    """書き込みに成功したデバイスの記録（シリアルごと）"""
+    return jsonify({"devices": device_registry.list_entries()})
+
+@app.route('/api/device-registry/check', methods=['POST'])
+def check_device_registry():
+    """デバイスがすでにISOファイルを保持しているか（書き込みを省略できるか）をフィンガープリントで確認"""
+    try:
+        data = request.json or {}
+        iso_file = data.get('iso_file')
+        device = data.get('device')
+        if not iso_file or not device:
+            return jsonify({"error": "ISO file and device must be specified"}), 400
+        iso_path = os.path.join(ISO_DIR, iso_file)
+        if not os.path.exists(iso_path):
+            return jsonify({"error": f"ISO file {iso_file} not found"}), 404
+        return jsonify(run_blocking(device_registry.check, iso_path, device))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/device-history', methods=['GET'])
+def get_device_history():
+    """デバイスごとの書き込み履歴の集計（劣化・stragglerのデバイスにflagsを付ける）
+
+    ?device=/dev/sdc でそのデバイスの全ジョブの履歴、?flagged=true で報告対象のデバイスだけを返す
+    """
+    try:
+        device = request.args.get('device')
+        if device:
+            history = run_blocking(device_history.get_history, device)
+            if history is None:
+                return jsonify({"error": f"No history for {device}"}), 404
+            return jsonify(history)
+        threshold = float(request.args.get('threshold', device_history.DEGRADATION_THRESHOLD))
+        flagged = request.args.get('flagged', 'false').lower() in ('1', 'true', 'yes')
+        return jsonify({"threshold": threshold,
+                        "devices": device_history.report(threshold, flagged_only=flagged)})
+    except ValueError:
+        return jsonify({"error": "threshold must be a number"}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/usb-devices/probe', methods=['POST'])
+def probe_usb_device():
+    """デバイスの容量偽装を調べ、実際に使える容量を返す（数十か所に書き込んで元に戻す）
+
+    プローブ中は書き込み中フラグを立て、同じデバイスへの書き込みや消去が同時に始まらないようにする。
+    書き込みと同じくマウント解除してから調べ、解除できないパーティションがあれば409で拒否する
+    （マウントされたファイルシステムが書き戻しの前後に書き込むと壊れるため）
+    """
+    global is_writing_active
+    
+    try:
+        device = (request.json or {}).get('device')
+        if not device:
+            return jsonify({"error": "Device must be specified"}), 400
+        if is_writing_active or device in batch.active_devices():
+            return jsonify({"error": "Write operation already in progress"}), 409
+        is_writing_active = True
+        try:
+            still_mounted = run_blocking(unmount_device, device)
+            if still_mounted:
+                return jsonify({"error": f"Device is still mounted: {', '.join(still_mounted)}"}), 409
+            return jsonify(run_blocking(capacity_probe.probe, device))
+        finally:
+            is_writing_active = False
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/wipe', methods=['POST'])
+def wipe_usb_device():
+    """USBデバイスを消去して再利用できる状態にする（zero=trueなら全体をゼロにする）"""
+    global write_status, is_writing_active
+    
+    try:
+        if is_writing_active:
+            return jsonify({"error": "Write operation already in progress"}), 409
+        if batch.active_batches():
+            return jsonify({"error": "A batch is in progress"}), 409
+        
+        data = request.json or {}
+        device = data.get('device')
+        zero = bool(data.get('zero', False))
+        if not device:
+            return jsonify({"error": "Device must be specified"}), 400
+        
+        job_id = uuid.uuid4().hex[:12]
+        telemetry = _register_job(job_id, device)
+        write_status = {"progress": 0, "status": "started", "job_id": job_id,
+                        "telemetry": telemetry.snapshot()}
+        is_writing_active = True
+        
+        server_mode.spawn_worker(wipe_device_wrapper, device, progress_callback, telemetry, zero)
+        
+        return jsonify({"status": "Wipe started", "job_id": job_id})
+    except Exception as e:
+        is_writing_active = False
+        return jsonify({"error": str(e)}), 500
+
+def wipe_device_wrapper(device_path, callback, telemetry, zero=False):
+    try:
+        return wipe_device(device_path, callback, telemetry, zero=zero)
+    except Exception as e:
+        log("wipe", f"Wipe of {device_path} failed: {e}", level="error",
+            job_id=telemetry.job_id, device=device_path)
+    finally:
+        metrics.observe_write_job(telemetry)
+
+@app.route('/api/usb-topology', methods=['GET'])
+def get_usb_topology():
+    """USBデバイスをバス（ルートハブ）ごとにまとめ、バスごとの同時書き込み数の上限と計測値を返す"""
+    try:
+        buses = run_blocking(_usb_buses)
+        return jsonify({"buses": buses, "scheduler": bus_scheduler.SCHEDULER.status()})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def _usb_buses():
+    buses = {}
+    for device in list_usb_devices():
+        location = get_usb_location(device["id"])
+        entry = dict(location, id=device["id"], name=device.get("name"))
+        buses.setdefault(location["bus"] or "unknown", []).append(entry)
+    return buses
 
 @app.route('/api/write-status', methods=['GET'])
 def get_write_status():
@@ -155,8 +579,92 @@ def get_write_status():
     # すでにここでは状態を上書きしないため、常に最新のステータスが返される
     # (completedのステータスはリセットリクエストが来るまで維持される)
     
+    # ストール検出のためテレメトリは問い合わせ時点の値に更新する
+    if current_telemetry is not None and write_status.get("job_id") == current_telemetry.job_id:
+        write_status["telemetry"] = current_telemetry.snapshot()
+    
     return jsonify(write_status)
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """直近のジョブのテレメトリを取得"""
+    telemetry = job_history.get(job_id)
+    if telemetry is None:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+    return jsonify({"job_id": job_id, "status": telemetry.status, "telemetry": telemetry.snapshot()})
+
+@app.route('/api/jobs/<job_id>/trace', methods=['GET'])
+def get_job_trace(job_id):
+    """ジョブのフェーズ・サブステップのトレースをChrome trace-event形式でダウンロード"""
+    telemetry = job_history.get(job_id)
+    if telemetry is None:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+    response = jsonify(telemetry.chrome_trace())
+    response.headers["Content-Disposition"] = f"attachment; filename=yakeru-{job_id}.trace.json"
+    return response
+
+@app.route('/api/journals', methods=['GET'])
+def get_journals():
+    """中断された書き込みのうち、再開可能なものの一覧を取得"""
+    try:
+        return jsonify({"journals": run_blocking(write_journal.list_journals)})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/store', methods=['GET'])
+def get_image_store():
+    """内容アドレス型ストアの状態（重複排除で節約した容量など）を取得"""
+    try:
+        return jsonify(run_blocking(image_store.status, ISO_DIR))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/store/dedupe', methods=['POST'])
+def dedupe_images():
+    """ISO_DIR内の全イメージをストアに登録し、同じ内容のファイルを共有させる"""
+    try:
+        if not image_store.ENABLED:
+            return jsonify({"error": "Image store is disabled (set YAKERU_CAS=1)"}), 400
+        result = run_blocking(image_store.dedupe, ISO_DIR)
+        result["removed"] = run_blocking(image_store.gc, ISO_DIR)
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/image-cache', methods=['GET'])
+def get_image_cache():
+    """メモリにキャッシュされているISOイメージの状態を取得"""
+    return jsonify(image_cache.get_cache().status())
+
+@app.route('/api/image-cache/pin', methods=['POST', 'DELETE'])
+def pin_image():
+    """ISOイメージをメモリに常駐させる（DELETEで解除）"""
+    try:
+        data = request.json or {}
+        iso_file = data.get('iso_file')
+        if not iso_file:
+            return jsonify({"error": "ISO file must be specified"}), 400
+        
+        iso_path = os.path.join(ISO_DIR, iso_file)
+        if not os.path.exists(iso_path):
+            return jsonify({"error": f"ISO file {iso_file} not found"}), 404
+        
+        if request.method == 'DELETE':
+            image_cache.get_cache().unpin(iso_path)
+        else:
+            run_blocking(image_cache.get_cache().pin, iso_path)
+        return jsonify(image_cache.get_cache().status())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheusテキスト形式でメトリクスを返す"""
+    metrics.update_job_gauges(list(job_history.values()))
+    metrics.update_buffer_pool_gauges(buffer_pool.get_pool().status())
+    metrics.update_log_gauges(log_pipeline.stats())
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route('/api/rescan-usb', methods=['POST'])
 def rescan_usb():
     """USBデバイスを再スキャンする（Linuxのudevtrigger用）"""
@@ -165,52 +673,57 @@ def rescan_usb():
     try:
         # 書き込み中はデバイス再スキャンをブロック
         if is_writing_active:
-            print("Blocked USB device rescan during active write operation")
+            log("device", "Blocked USB device rescan during active write operation", level="debug")
             return jsonify({"devices": [], "blocked": True, "message": "Rescan blocked during write operation"}), 423
             
         if platform.system() == "Linux":
-            try:
-                # udevadmコマンドでUSBデバイスを再検出
-                subprocess.run(
-                    ["udevadm", "trigger"],
-                    check=True
-                )
-                subprocess.run(
-                    ["udevadm", "settle"],
-                    check=True
-                )
-                
-                # デバイスファイルの権限を確認/更新（エラーを無視）
-                try:
-                    # sdドライブの場合
-                    if os.path.exists("/dev/sd*"):
-                        subprocess.run(
-                            ["chmod", "-R", "a+rw", "/dev/sd*"],
-                            check=False
-                        )
-                    # vdドライブの場合（仮想環境向け）
-                    if os.path.exists("/dev/vd*"):
-                        subprocess.run(
-                            ["chmod", "-R", "a+rw", "/dev/vd*"],
-                            check=False
-                        )
-                    # nvmeドライブの場合
-                    if os.path.exists("/dev/nvme*"):
-                        subprocess.run(
-                            ["chmod", "-R", "a+rw", "/dev/nvme*"],
-                            check=False
-                        )
-                except Exception as e:
-                    print(f"Warning: Permission setting failed: {e}")
-            except Exception as e:
-                print(f"Warning: Failed to trigger USB rescan: {e}")
+            run_blocking(_trigger_linux_rescan)
         
         # 更新されたデバイス一覧を返す
-        devices = list_usb_devices()
+        with metrics.DEVICE_SCAN_LATENCY.time(source="rescan"):
+            devices = run_blocking(list_usb_devices)
         return jsonify({"devices": devices})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def _trigger_linux_rescan():
+    """udevでUSBデバイスを再検出する（udevadm settleは数秒かかることがある）"""
+    try:
+        # udevadmコマンドでUSBデバイスを再検出
+        subprocess.run(
+            ["udevadm", "trigger"],
+            check=True
+        )
+        subprocess.run(
+            ["udevadm", "settle"],
+            check=True
+        )
+        
+        # デバイスファイルの権限を確認/更新（エラーを無視）
+        try:
+            # sdドライブの場合
+            if os.path.exists("/dev/sd*"):
+                subprocess.run(
+                    ["chmod", "-R", "a+rw", "/dev/sd*"],
+                    check=False
+                )
+            # vdドライブの場合（仮想環境向け）
+            if os.path.exists("/dev/vd*"):
+                subprocess.run(
+                    ["chmod", "-R", "a+rw", "/dev/vd*"],
+                    check=False
+                )
+            # nvmeドライブの場合
+            if os.path.exists("/dev/nvme*"):
+                subprocess.run(
+                    ["chmod", "-R", "a+rw", "/dev/nvme*"],
+                    check=False
+                )
+        except Exception as e:
+            log("device", f"Permission setting failed: {e}", level="warning")
+    except Exception as e:
+        log("device", f"Failed to trigger USB rescan: {e}", level="warning")
+
 @app.route('/api/reset-status', methods=['POST'])
 def reset_status():
     """書き込み状態を明示的にリセットするエンドポイント"""
@@ -225,27 +738,30 @@ def reset_status():
     # 書き込み中フラグも強制的にリセット
     is_writing_active = False
     
-    print("Status explicitly reset by frontend request")
+    log("server", "Status explicitly reset by frontend request")
     
     # Linux環境では、デバイスの状態をリセットするため、システムコマンドを実行
     if platform.system() == "Linux":
-        try:
-            # syncを実行してすべてのバッファをフラッシュ
-            subprocess.run(["sync"], check=True)
-            print("System buffers flushed with sync command")
-            
-            # USBサブシステムをリセットするためのudevadmコマンド実行
-            subprocess.run(["udevadm", "trigger"], check=False)
-            subprocess.run(["udevadm", "settle"], check=False)
-            print("USB subsystem refreshed with udevadm")
-            
-            # 確実に状態がクリアされたことを確認するため待機
-            time.sleep(1)
-        except Exception as e:
-            print(f"Warning: Failed to reset device state: {e}")
+        run_blocking(_reset_linux_device_state)
     
     return jsonify({"status": "Status reset successfully"})
 
+def _reset_linux_device_state():
+    try:
+        # syncを実行してすべてのバッファをフラッシュ
+        subprocess.run(["sync"], check=True)
+        log("device", "System buffers flushed with sync command")
+        
+        # USBサブシステムをリセットするためのudevadmコマンド実行
+        subprocess.run(["udevadm", "trigger"], check=False)
+        subprocess.run(["udevadm", "settle"], check=False)
+        log("device", "USB subsystem refreshed with udevadm")
+        
+        # 確実に状態がクリアされたことを確認するため待機
+        time.sleep(1)
+    except Exception as e:
+        log("device", f"Failed to reset device state: {e}", level="warning")
+
 # 進捗コールバック関数を修正
 def progress_callback(progress, status):
     """書き込み進捗をWebSocketで通知"""
@@ -255,29 +771,29 @@ def progress_callback(progress, status):
         # 基本的な進捗情報を更新
         write_status["progress"] = progress
         write_status["status"] = status
+        telemetry_data = current_telemetry.snapshot() if current_telemetry is not None else None
+        write_status["telemetry"] = telemetry_data
         
-        # エラーステータスの場合はログに出力
-        if status and status.startswith("error"):
-            print(f"Error occurred during writing: {status}")
-            # エラー通知が確実に送信された後でフラグをリセットするため、ここではリセットしない
-        
-        # 完了通知の場合はログに出力
-        if status == "completed":
-            print(f"Write process completed with status: {status}, progress: {progress}%")
-            # 完了状態を維持するため、is_writing_activeのみをリセットし、ステータスはcompletedのまま
+        # エラー通知が確実に送信された後でフラグをリセットするため、ここではリセットしない
+        # 完了状態を維持するため、is_writing_activeのみをリセットし、ステータスはcompletedのまま
         
         # ソケットで通知
         progress_data = {
             'progress': progress, 
-            'status': status
+            'status': status,
+            'job_id': write_status.get("job_id"),
+            'telemetry': telemetry_data
         }
         
         # 完了通知とエラー通知は確実に送信
         if status == "completed" or (status and status.startswith("error")):
+            # 終了の記録は1回だけ（通知の再送ごとには記録しない）
+            log("write", f"Write process finished with status: {status}, progress: {progress}%",
+                level="info" if status == "completed" else "error",
+                job_id=write_status.get("job_id"), progress=progress)
             # 確実に通知されるように、より頻繁に送信
             for i in range(8):  # 8回に増やす
-                print(f"Sending {status} notification (attempt {i+1}/8)")
-                socketio.emit('write_progress', progress_data)
+                emitter.emit('write_progress', progress_data)
                 # REST APIでのポーリングにも対応するためwrite_statusを確実に更新
                 write_status["progress"] = progress
                 write_status["status"] = status
@@ -286,22 +802,22 @@ def progress_callback(progress, status):
             
             # 全ての通知が送信された後にフラグをリセット(書き込み中フラグのみリセット、ステータスはそのまま)
             if status == "completed" or status.startswith("error"):
-                print(f"All notifications sent for {status}, now resetting writing active flag only")
                 is_writing_active = False  # 重要: 書き込み中フラグのみリセット
                 # write_statusのステータスは変更しない
         else:
-            socketio.emit('write_progress', progress_data)
+            emitter.emit('write_progress', progress_data)
     except Exception as e:
         # 例外発生時は書き込み中フラグをリセット
         is_writing_active = False
-        print(f"Error in progress_callback: {e}")
+        log("write", f"Error in progress_callback: {e}", level="error")
         # 通知失敗時でもステータスは更新
         write_status["status"] = f"error: {str(e)}"
 
 @app.errorhandler(Exception)
 def handle_exception(e):
     """すべての未処理例外をキャッチするグローバルエラーハンドラ"""
-    print(f"Unhandled exception: {str(e)}")
+    log("server", f"Unhandled exception: {e}", level="error",
+        method=request.method, path=request.path)
     return jsonify({
         "error": "Internal server error",
         "message": str(e)
@@ -310,4 +826,10 @@ def handle_exception(e):
 if __name__ == '__main__':
     # フォルダが存在しない場合は作成
     os.makedirs(ISO_DIR, exist_ok=True)
-    socketio.run(app, debug=True, host='0.0.0.0', port=5000)
+    if server_mode.is_async():
+        # 本番用: 自動リロードとデバッガは使わない
+        log("server", f"Starting server in {server_mode.ASYNC_MODE} mode on port {PORT}")
+        emitter.start()
+        socketio.run(app, host='0.0.0.0', port=PORT)
+    else:
+        socketio.run(app, debug=True, host='0.0.0.0', port=PORT)
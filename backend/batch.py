@@ -0,0 +1,461 @@
+"""マニフェストに従って複数のUSBメモリにまとめて書き込むバッチ処理
+
+マニフェストの例:
+
+    {
+      "items": [
+        {"iso_file": "distro-a.iso", "count": 10},
+        {"iso_file": "distro-b.iso", "devices": ["/dev/sdc", "/dev/sdd"]}
+      ],
+      "max_concurrent": 4
+    }
+
+台数指定のイメージは、大きいイメージほど速いデバイスに割り当て（デバイスの速度は過去の書き込みで計測）、
+推定所要時間の長いジョブから順に開始して、バッチ全体の完了時間（makespan）を短くする。
+同じUSBバスのデバイスは、bus_schedulerが許す台数までしか同時に書き込まない。
+"""
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+import iso_writer
+import metrics
+import usb_detector
+import capacity_probe
+import device_history
+from bus_scheduler import SCHEDULER
+from log_pipeline import log
+
+MB = 1024 * 1024
+
+# 計測値のないデバイスの想定速度（bytes/sec）
+DEFAULT_RATE = float(os.environ.get("YAKERU_BATCH_DEFAULT_MBPS", "20")) * MB
+# 同時に書き込むデバイス数の既定値
+DEFAULT_MAX_CONCURRENT = int(os.environ.get("YAKERU_BATCH_MAX_CONCURRENT", "4"))
+# 書き込み以外（アンマウント・同期など）にかかる1ジョブあたりの時間（秒）
+JOB_OVERHEAD = 5.0
+# 保持するバッチ履歴の件数
+BATCH_HISTORY_LIMIT = 20
+# 進捗通知の最短間隔（秒）
+UPDATE_INTERVAL = 1.0
+# 速度のEWMAの平滑化係数
+RATE_ALPHA = 0.5
+# バスの空きを待つ間隔（秒）
+BUS_WAIT_INTERVAL = 1.0
+
+
+class BatchError(Exception):
+    """マニフェストの不備など（HTTPステータスコード付き）"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class DeviceRates:
+    """デバイスごとの書き込み速度の計測値"""
+
+    def __init__(self):
+        self._rates = {}
+        self._lock = threading.Lock()
+
+    def record(self, device, rate):
+        if not device or rate <= 0:
+            return
+        with self._lock:
+            previous = self._rates.get(device)
+            self._rates[device] = rate if previous is None else (
+                RATE_ALPHA * rate + (1 - RATE_ALPHA) * previous)
+
+    def get(self, device):
+        with self._lock:
+            return self._rates.get(device)
+
+    def estimate(self, device):
+        """計測値がなければ、他のデバイスの中央値（それもなければ既定値）を使う"""
+        with self._lock:
+            rate = self._rates.get(device)
+            if rate is not None:
+                return rate
+            known = sorted(self._rates.values())
+        return known[len(known) // 2] if known else DEFAULT_RATE
+
+    def snapshot(self):
+        with self._lock:
+            return {device: round(rate / MB, 2) for device, rate in self._rates.items()}
+
+
+RATES = DeviceRates()
+
+
+def record_job(telemetry):
+    """完了したジョブの平均速度をデバイスの計測値に反映し、デバイスの履歴に残す"""
+    if telemetry.status == "completed":
+        RATES.record(telemetry.device, telemetry.average_rate())
+    try:
+        device_history.record(telemetry)
+    except OSError as e:
+        log("history", f"Failed to record the job history: {e}", level="warning",
+            job_id=telemetry.job_id, device=telemetry.device)
+
+
+# ---- 計画 ----
+
+def plan(manifest, iso_dir, available_devices):
+    """マニフェストからジョブの一覧（開始順）を作る"""
+    items = manifest.get("items")
+    if not items:
+        raise BatchError("Manifest must contain items")
+
+    pinned = []
+    counted = []
+    used = set()
+    for item in items:
+        iso_file = item.get("iso_file")
+        if not iso_file:
+            raise BatchError("Each item must specify iso_file")
+        iso_path = os.path.join(iso_dir, iso_file)
+        if not os.path.exists(iso_path):
+            raise BatchError(f"ISO file {iso_file} not found", 404)
+        size = os.path.getsize(iso_path)
+
+        devices = item.get("devices") or []
+        for device in devices:
+            if device in used:
+                raise BatchError(f"Device {device} is assigned more than once")
+            used.add(device)
+            try:
+                capacity_probe.ensure_fits(device, size)
+            except OSError as e:
+                raise BatchError(e.strerror, 413)
+            pinned.append(_job(iso_file, iso_path, size, device))
+        count = int(item.get("count", 0))
+        if count < 0:
+            raise BatchError("count must not be negative")
+        counted.extend((iso_file, iso_path, size) for _ in range(count))
+
+    free = [device for device in available_devices if device not in used]
+    if len(counted) > len(free):
+        raise BatchError(f"Not enough devices: {len(counted)} needed, {len(free)} available", 409)
+
+    # 大きいイメージから順に速いデバイスへ割り当てる（容量や容量偽装で収まらないデバイスは飛ばす）
+    counted.sort(key=lambda job: job[2], reverse=True)
+    free.sort(key=RATES.estimate, reverse=True)
+    usable = {device: capacity_probe.device_capacity(device) for device in free}
+    jobs = list(pinned)
+    for iso_file, iso_path, size in counted:
+        device = next((d for d in free if usable[d] is None or usable[d] >= size), None)
+        if device is None:
+            raise BatchError(f"No device with enough usable capacity for {iso_file}", 413)
+        free.remove(device)
+        jobs.append(_job(iso_file, iso_path, size, device))
+    if not jobs:
+        raise BatchError("Manifest does not contain any jobs")
+
+    # 所要時間の長いジョブから開始する（LPT）
+    jobs.sort(key=lambda job: job.estimated_seconds, reverse=True)
+    return jobs
+
+
+def _job(iso_file, iso_path, size, device):
+    job = BatchJob(iso_file, iso_path, size, device,
+                   size / RATES.estimate(device) + JOB_OVERHEAD)
+    job.bus = usb_detector.get_usb_location(device)["bus"]
+    return job
+
+
+def _makespan(durations, workers):
+    """durationsを順に空いたワーカーへ割り当てたときの完了時間"""
+    loads = [0.0] * max(workers, 1)
+    for duration in durations:
+        i = loads.index(min(loads))
+        loads[i] += duration
+    return max(loads) if loads else 0.0
+
+
+# ---- 実行 ----
+
+class BatchJob:
+    """バッチ内の1件の書き込み"""
+
+    def __init__(self, iso_file, iso_path, size, device, estimated_seconds):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.iso_file = iso_file
+        self.iso_path = iso_path
+        self.size = size
+        self.device = device
+        self.estimated_seconds = estimated_seconds
+        self.bus = None
+        self.state = "pending"
+        self.error = None
+        self.telemetry = None
+
+    def bytes_written(self):
+        if self.state == "skipped":
+            return self.size
+        if self.telemetry is None:
+            return self.size if self.state == "completed" else 0
+        return self.telemetry.bytes_written
+
+    def remaining_seconds(self):
+        if self.state == "pending":
+            return self.estimated_seconds
+        if self.state != "running":
+            return 0.0
+        eta = self.telemetry.eta() if self.telemetry is not None else None
+        if eta is not None:
+            return eta + JOB_OVERHEAD
+        elapsed = self.telemetry.elapsed() if self.telemetry is not None else 0.0
+        return max(self.estimated_seconds - elapsed, 0.0)
+
+    def snapshot(self):
+        return {
+            "job_id": self.job_id,
+            "iso_file": self.iso_file,
+            "device": self.device,
+            "bus": self.bus,
+            "size": self.size,
+            "state": self.state,
+            "error": self.error,
+            "estimated_seconds": round(self.estimated_seconds, 1),
+            "telemetry": self.telemetry.snapshot() if self.telemetry is not None else None,
+        }
+
+
+class Batch:
+    """ジョブを並行して実行し、バッチ全体の進捗とETAを集計する"""
+
+    def __init__(self, jobs, max_concurrent=None, engine=None, verify=False, skip_if_current=False,
+                 probe_capacity=False):
+        self.batch_id = uuid.uuid4().hex[:12]
+        self.jobs = jobs
+        self.max_concurrent = max(int(max_concurrent or DEFAULT_MAX_CONCURRENT), 1)
+        self.engine = engine
+        self.verify = verify
+        self.skip_if_current = skip_if_current
+        self.probe_capacity = probe_capacity
+        self.state = "planned"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+        # バスの空きを待っているワーカーを、ジョブの完了時に起こす
+        self._job_done = threading.Condition(self._lock)
+        self._running_workers = 0
+        self._last_update = 0.0
+        self._register_job = None
+        self._on_update = None
+
+    def start(self, spawn, register_job=None, on_update=None):
+        """spawn(func)でワーカーを起動する（socketio.start_background_taskなど）"""
+        self._register_job = register_job
+        self._on_update = on_update
+        self.state = "running"
+        self.started_at = time.time()
+        workers = min(self.max_concurrent, len(self.jobs))
+        self._running_workers = workers
+        log("batch", f"Starting {len(self.jobs)} jobs with {workers} workers "
+            f"(estimated {self.estimated_makespan():.0f}s)", batch_id=self.batch_id)
+        for _ in range(workers):
+            spawn(self._worker)
+
+    def cancel(self):
+        """まだ開始していないジョブを取り消す（実行中のジョブは最後まで書き込む）"""
+        with self._lock:
+            for job in self.jobs:
+                if job.state == "pending":
+                    job.state = "cancelled"
+            self._job_done.notify_all()
+        self._notify(force=True)
+
+    def _next_job(self):
+        """バスに空きのある未開始ジョブを取り出す（どのバスも埋まっていれば空くまで待つ）"""
+        with self._lock:
+            while True:
+                pending = [job for job in self.jobs if job.state == "pending"]
+                if not pending:
+                    return None
+                for job in pending:
+                    if SCHEDULER.try_acquire(job.bus):
+                        job.state = "running"
+                        return job
+                # 他のバッチのジョブが終わっても通知されないため、一定間隔で確認し直す
+                self._job_done.wait(BUS_WAIT_INTERVAL)
+
+    def _worker(self):
+        try:
+            while True:
+                job = self._next_job()
+                if job is None:
+                    break
+                self._run_job(job)
+        finally:
+            with self._lock:
+                self._running_workers -= 1
+                done = self._running_workers == 0
+            if done:
+                self._finish()
+
+    def _run_job(self, job):
+        if self._register_job is not None:
+            job.telemetry = self._register_job(job.job_id, job.device)
+        else:
+            from telemetry import WriteTelemetry
+            job.telemetry = WriteTelemetry(job_id=job.job_id, device=job.device)
+
+        def progress_callback(progress, status):
+            if status == "writing":
+                self._record_bus_rate(job.bus)
+            self._notify()
+
+        try:
+            iso_writer.write_iso_to_device(job.iso_path, job.device, progress_callback,
+                                           job.telemetry, engine=self.engine,
+                                           rate_limiter=SCHEDULER.rate_limiter(job.bus),
+                                           verify=self.verify,
+                                           skip_if_current=self.skip_if_current,
+                                           probe_capacity=self.probe_capacity)
+            job.state = "skipped" if job.telemetry.skipped else "completed"
+        except Exception as e:
+            job.state = "error"
+            job.error = str(e)
+            log("batch", f"Job failed: {e}", level="error",
+                batch_id=self.batch_id, job_id=job.job_id, device=job.device)
+        finally:
+            SCHEDULER.release(job.bus)
+            with self._lock:
+                self._job_done.notify_all()
+            record_job(job.telemetry)
+            metrics.observe_write_job(job.telemetry)
+            self._notify(force=True)
+
+    def _record_bus_rate(self, bus):
+        """同じバスの全ジョブが書き込み中なら、その合計速度をバスの計測値として記録する"""
+        if bus is None:
+            return
+        with self._lock:
+            running = [job for job in self.jobs if job.bus == bus and job.state == "running"]
+        rates = []
+        for job in running:
+            telemetry = job.telemetry
+            if telemetry is None or telemetry.status != "writing" or not telemetry.ewma_rate:
+                # 開始直後や同期中のジョブがあると、合計速度を過小評価してしまう
+                return
+            rates.append(telemetry.ewma_rate)
+        SCHEDULER.record(bus, len(rates), sum(rates))
+
+    def _finish(self):
+        self.finished_at = time.time()
+        states = [job.state for job in self.jobs]
+        if "error" in states:
+            self.state = "completed_with_errors"
+        elif "cancelled" in states:
+            self.state = "cancelled"
+        else:
+            self.state = "completed"
+        try:
+            device_history.mark_stragglers(
+                self.batch_id, [job.telemetry for job in self.jobs if job.telemetry is not None])
+        except OSError as e:
+            log("history", f"Failed to record stragglers: {e}", level="warning", batch_id=self.batch_id)
+        log("batch", f"{self.state} in {self.finished_at - self.started_at:.1f}s",
+            batch_id=self.batch_id, state=self.state)
+        self._notify(force=True)
+
+    def _notify(self, force=False):
+        if self._on_update is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_update < UPDATE_INTERVAL:
+            return
+        self._last_update = now
+        try:
+            self._on_update(self)
+        except Exception as e:
+            log("batch", f"Batch progress notification failed: {e}", level="warning",
+                batch_id=self.batch_id)
+
+    def estimated_makespan(self):
+        return _makespan([job.estimated_seconds for job in self.jobs], self.max_concurrent)
+
+    def eta(self):
+        """実行中ジョブの残り時間から始めて、未開始のジョブを空いたワーカーに順に割り当てて推定する"""
+        if self.state != "running":
+            return None
+        running = [job.remaining_seconds() for job in self.jobs if job.state == "running"]
+        pending = [job.estimated_seconds for job in self.jobs if job.state == "pending"]
+        loads = sorted(running) + [0.0] * max(self.max_concurrent - len(running), 0)
+        for duration in pending:
+            i = loads.index(min(loads))
+            loads[i] += duration
+        return max(loads) if loads else 0.0
+
+    def snapshot(self):
+        total = sum(job.size for job in self.jobs if job.state != "cancelled")
+        written = sum(job.bytes_written() for job in self.jobs if job.state != "cancelled")
+        counts = {}
+        for job in self.jobs:
+            counts[job.state] = counts.get(job.state, 0) + 1
+        eta = self.eta()
+        return {
+            "batch_id": self.batch_id,
+            "state": self.state,
+            "max_concurrent": self.max_concurrent,
+            "verify": self.verify,
+            "skip_if_current": self.skip_if_current,
+            "probe_capacity": self.probe_capacity,
+            "total_bytes": total,
+            "bytes_written": written,
+            "percent": round(written * 100.0 / total, 2) if total else 0.0,
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+            "estimated_makespan_seconds": round(self.estimated_makespan(), 1),
+            "jobs_by_state": counts,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "jobs": [job.snapshot() for job in self.jobs],
+        }
+
+
+# ---- バッチの管理 ----
+
+_batches = OrderedDict()
+_batches_lock = threading.Lock()
+
+
+def create_batch(manifest, iso_dir, available_devices, register=True):
+    """マニフェストからバッチを作る。register=Falseなら一覧に載せない（dry_runの割り当て確認用）"""
+    jobs = plan(manifest, iso_dir, available_devices)
+    batch = Batch(jobs, manifest.get("max_concurrent"), manifest.get("engine"),
+                  bool(manifest.get("verify", False)), bool(manifest.get("skip_if_current", False)),
+                  bool(manifest.get("probe_capacity", False)))
+    if not register:
+        return batch
+    with _batches_lock:
+        _batches[batch.batch_id] = batch
+        while len(_batches) > BATCH_HISTORY_LIMIT:
+            _batches.popitem(last=False)
+    return batch
+
+
+def get_batch(batch_id):
+    with _batches_lock:
+        return _batches.get(batch_id)
+
+
+def list_batches():
+    with _batches_lock:
+        return list(_batches.values())
+
+
+def active_batches():
+    return [batch for batch in list_batches() if batch.state == "running"]
+
+
+def active_devices():
+    """実行中のバッチが書き込みに使っている（これから使う）デバイス"""
+    devices = set()
+    for batch in active_batches():
+        devices.update(job.device for job in batch.jobs if job.state in ("pending", "running"))
+    return devices
@@ -0,0 +1,339 @@
+"""iso_writer の書き込みスループットを計測するベンチマーク
+
+合成ISOを生成し、通常ファイル・tmpfs・ループデバイスに対して
+書き込みエンジンとブロックサイズの組み合わせごとに write_iso_to_device を実行する。
+結果はJSONで出力し、--compare で別のコミットの結果と比較できる。
+
+    python benchmark.py --size 256M --entropy 0.5 --output bench.json
+    python benchmark.py --compare baseline.json bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+MB = 1024 * 1024
+
+
+def parse_size(text):
+    """'256M' や '1G' のようなサイズ表記をバイト数に変換"""
+    text = str(text).strip().upper()
+    units = {"K": 1024, "M": MB, "G": 1024 * MB}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def generate_iso(path, size, entropy, seed=0):
+    """指定サイズの合成ISOを作成する
+
+    entropyは乱数ブロックの割合（0.0=全てゼロ、1.0=全て乱数）。
+    同じseedなら同じ内容になるため、コミット間の比較に使える
+    """
+    rng = random.Random(seed)
+    block = MB
+    zero_block = bytes(block)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            length = min(block, remaining)
+            if rng.random() < entropy:
+                f.write(rng.randbytes(length))
+            else:
+                f.write(zero_block[:length])
+            remaining -= length
+
+
+def _cached_iso(work_dir, size, entropy, seed):
+    path = os.path.join(work_dir, f"synthetic-{size}-{entropy}-{seed}.iso")
+    if not os.path.exists(path):
+        print(f"Generating {path}...", file=sys.stderr)
+        generate_iso(path, size, entropy, seed)
+    return path
+
+
+# ---- 書き込み先 ----
+
+def _prepare_targets(names, work_dir, size):
+    """書き込み先を用意する。戻り値は (名前, パス, 後始末関数) のリスト"""
+    targets = []
+    for name in names:
+        if name == "file":
+            path = os.path.join(work_dir, "target.img")
+            targets.append((name, path, lambda p=path: _remove(p)))
+        elif name == "tmpfs":
+            if not os.path.isdir("/dev/shm"):
+                print("Skipping tmpfs target: /dev/shm not available", file=sys.stderr)
+                continue
+            path = os.path.join("/dev/shm", f"yakeru-bench-{os.getpid()}.img")
+            targets.append((name, path, lambda p=path: _remove(p)))
+        elif name == "loop":
+            loop = _setup_loop_device(work_dir, size)
+            if loop is None:
+                continue
+            device, backing = loop
+            targets.append((name, device, lambda d=device, b=backing: _teardown_loop(d, b)))
+        else:
+            raise ValueError(f"Unknown target: {name}")
+    return targets
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _setup_loop_device(work_dir, size):
+    if platform.system() != "Linux" or os.geteuid() != 0 or shutil.which("losetup") is None:
+        print("Skipping loop target: requires Linux, root and losetup", file=sys.stderr)
+        return None
+    backing = os.path.join(work_dir, "loop-backing.img")
+    with open(backing, 'wb') as f:
+        f.truncate(size)
+    result = subprocess.run(["losetup", "-f", "--show", backing], capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"Skipping loop target: {result.stderr.strip()}", file=sys.stderr)
+        _remove(backing)
+        return None
+    return result.stdout.strip(), backing
+
+
+def _teardown_loop(device, backing):
+    subprocess.run(["losetup", "-d", device], check=False)
+    _remove(backing)
+
+
+# ---- 計測 ----
+
+def run_case(iso_path, target_path, engine, block_size):
+    """1ケースを現在のプロセスで実行し、計測結果を返す（子プロセス側で呼ばれる）"""
+    import resource
+    sys.path.insert(0, BACKEND_DIR)
+    from iso_writer import write_iso_to_device
+    from telemetry import WriteTelemetry
+    import log_pipeline
+    # 結果のJSON（標準出力の最後の行）にログが混ざらないようにする
+    log_pipeline.configure(stream=sys.stderr)
+
+    telemetry = WriteTelemetry(job_id="bench", device=target_path, log_interval=-1)
+    cpu_start = os.times()
+    wall_start = time.perf_counter()
+    error = None
+    try:
+        write_iso_to_device(iso_path, target_path, None, telemetry,
+                            engine=engine, block_size=block_size)
+    except Exception as e:
+        error = str(e)
+    wall = time.perf_counter() - wall_start
+    cpu_end = os.times()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrssはLinuxではKB、macOSではバイト
+    peak_rss_kb = usage.ru_maxrss // 1024 if platform.system() == "Darwin" else usage.ru_maxrss
+
+    size = os.path.getsize(iso_path)
+    writing_time = telemetry.phase_times.get("writing", 0.0)
+    return {
+        "error": error,
+        "bytes": size,
+        "wall_seconds": wall,
+        "write_mbps": size / writing_time / MB if writing_time > 0 and not error else None,
+        "end_to_end_mbps": size / wall / MB if wall > 0 and not error else None,
+        "cpu_user_seconds": cpu_end.user - cpu_start.user,
+        "cpu_system_seconds": cpu_end.system - cpu_start.system,
+        "peak_rss_kb": peak_rss_kb,
+        "phase_seconds": dict(telemetry.phase_times),
+        "retries": telemetry.retries,
+    }
+
+
+# 書き込みのたびに保存される状態ファイルの保存先（ベンチマークでは作業ディレクトリに向ける）
+STATE_PATH_VARS = {
+    "YAKERU_DEVICE_REGISTRY": "device_registry.json",
+    "YAKERU_JOURNAL_DIR": "journal",
+    "YAKERU_CAPACITY_PROBES": "capacity_probes.json",
+    "YAKERU_DEVICE_HISTORY": "device_history.json",
+}
+
+
+def _run_case_subprocess(iso_path, target_path, engine, block_size, work_dir):
+    """ピークRSSを正しく測るため、ケースごとに別プロセスで実行する
+
+    状態ファイルはケースごとの一時ディレクトリに置く（本番の記録を汚さず、
+    前のケースの記録で書き込みが省略されたり再開されたりしないようにする）
+    """
+    spec = json.dumps({"iso": iso_path, "target": target_path,
+                       "engine": engine, "block_size": block_size})
+    state_dir = tempfile.mkdtemp(prefix="state-", dir=work_dir)
+    env = dict(os.environ)
+    env.update({name: os.path.join(state_dir, filename)
+                for name, filename in STATE_PATH_VARS.items()})
+    try:
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-case", spec],
+                                capture_output=True, text=True, env=env)
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed"}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _summarize(samples):
+    """繰り返し計測の中央値をまとめる"""
+    ok = [s for s in samples if not s.get("error")]
+    if not ok:
+        return {"error": samples[-1].get("error"), "repeats": len(samples)}
+    summary = {"repeats": len(samples), "failures": len(samples) - len(ok)}
+    for key in ("write_mbps", "end_to_end_mbps", "wall_seconds",
+                "cpu_user_seconds", "cpu_system_seconds", "peak_rss_kb"):
+        values = [s[key] for s in ok if s.get(key) is not None]
+        summary[key] = statistics.median(values) if values else None
+    phases = {}
+    for s in ok:
+        for phase, seconds in s.get("phase_seconds", {}).items():
+            phases.setdefault(phase, []).append(seconds)
+    summary["phase_seconds"] = {p: statistics.median(v) for p, v in phases.items()}
+    summary["samples"] = [s.get("write_mbps") for s in ok]
+    return summary
+
+
+def _git_revision():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                                capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmark(args):
+    sys.path.insert(0, BACKEND_DIR)
+    from iso_writer import available_engines
+
+    size = parse_size(args.size)
+    engines = args.engines.split(",") if args.engines else available_engines()
+    block_sizes = [parse_size(b) for b in args.block_sizes.split(",")]
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="yakeru-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+
+    iso_path = _cached_iso(work_dir, size, args.entropy, args.seed)
+    targets = _prepare_targets(args.targets.split(","), work_dir, size)
+    results = []
+    try:
+        for target_name, target_path, _ in targets:
+            for engine in engines:
+                for block_size in block_sizes:
+                    print(f"{target_name:6} {engine:8} {block_size // 1024:>6} KB ...",
+                          end=" ", file=sys.stderr, flush=True)
+                    samples = [_run_case_subprocess(iso_path, target_path, engine, block_size,
+                                                   work_dir)
+                               for _ in range(args.repeat)]
+                    summary = _summarize(samples)
+                    summary.update({"target": target_name, "engine": engine, "block_size": block_size})
+                    results.append(summary)
+                    if summary.get("error"):
+                        print(f"error: {summary['error']}", file=sys.stderr)
+                    else:
+                        print(f"{summary['write_mbps']:.1f} MB/s", file=sys.stderr)
+    finally:
+        for _, _, cleanup in targets:
+            cleanup()
+        if not args.work_dir and not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "revision": _git_revision(),
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "image_size": size,
+            "entropy": args.entropy,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+
+
+def _case_key(result):
+    return (result["target"], result["engine"], result["block_size"])
+
+
+def compare(baseline, current, threshold):
+    """2つの結果を比較し、threshold(%)を超えて遅くなったケースの数を返す"""
+    base = {_case_key(r): r for r in baseline["results"]}
+    regressions = 0
+    print(f"{'target':6} {'engine':8} {'block':>7} {'base MB/s':>10} {'new MB/s':>10} {'change':>8}")
+    for result in current["results"]:
+        key = _case_key(result)
+        before = base.get(key, {}).get("write_mbps")
+        after = result.get("write_mbps")
+        if not before or not after:
+            change_text = "n/a"
+        else:
+            change = (after - before) * 100 / before
+            change_text = f"{change:+.1f}%"
+            if change < -threshold:
+                regressions += 1
+                change_text += " !"
+        print(f"{key[0]:6} {key[1]:8} {key[2] // 1024:>5}KB "
+              f"{before or 0:>10.1f} {after or 0:>10.1f} {change_text:>8}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Yakeru-USB write throughput benchmark")
+    parser.add_argument("--size", default="256M", help="synthetic image size (e.g. 256M, 2G)")
+    parser.add_argument("--entropy", type=float, default=0.5,
+                        help="fraction of random (incompressible) blocks, 0.0-1.0")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--targets", default="file,tmpfs,loop",
+                        help="comma separated: file, tmpfs, loop")
+    parser.add_argument("--engines", help="comma separated engines (default: all available)")
+    parser.add_argument("--block-sizes", default="256K,1M,4M")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--work-dir", help="directory for images and file targets")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary work directory")
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=5.0,
+                        help="regression threshold in percent for --compare")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        spec = json.loads(args.run_case)
+        result = run_case(spec["iso"], spec["target"], spec["engine"], spec["block_size"])
+        print(json.dumps(result))
+        return 0
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        return 1 if compare(baseline, current, args.threshold) else 0
+
+    report = run_benchmark(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
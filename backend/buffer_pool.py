@@ -0,0 +1,171 @@
+import os
+import mmap
+import threading
+
+MB = 1024 * 1024
+
+# 書き込みバッファの合計サイズの上限。超える場合、新しいジョブはバッファが空くまで待つ
+POOL_BUDGET = int(os.environ.get("YAKERU_BUFFER_POOL_MB", "64")) * MB
+# バッファのサイズはこの単位に切り上げる（O_DIRECTのアライメント）
+BUFFER_ALIGNMENT = 4096
+
+
+def buffer_address(obj):
+    """バッファ（読み取り専用のmmapやmemoryviewを含む）の先頭アドレスを取得する"""
+    import ctypes
+
+    class Py_buffer(ctypes.Structure):
+        _fields_ = [
+            ("buf", ctypes.c_void_p), ("obj", ctypes.c_void_p),
+            ("len", ctypes.c_ssize_t), ("itemsize", ctypes.c_ssize_t),
+            ("readonly", ctypes.c_int), ("ndim", ctypes.c_int),
+            ("format", ctypes.c_char_p), ("shape", ctypes.c_void_p),
+            ("strides", ctypes.c_void_p), ("suboffsets", ctypes.c_void_p),
+            ("internal", ctypes.c_void_p),
+        ]
+
+    view = Py_buffer()
+    get_buffer = ctypes.pythonapi.PyObject_GetBuffer
+    get_buffer.argtypes = [ctypes.py_object, ctypes.POINTER(Py_buffer), ctypes.c_int]
+    release = ctypes.pythonapi.PyBuffer_Release
+    release.argtypes = [ctypes.POINTER(Py_buffer)]
+    if get_buffer(obj, ctypes.byref(view), 0) != 0:
+        return None
+    try:
+        return view.buf
+    finally:
+        release(ctypes.byref(view))
+
+
+class PooledBuffer:
+    """プールから借りたページ境界に揃ったバッファ"""
+
+    def __init__(self, pool, size):
+        self._pool = pool
+        self.size = size
+        # 匿名mmapは常にページ境界から始まるため、O_DIRECTにもそのまま使える
+        self.mmap = mmap.mmap(-1, size)
+        self.view = memoryview(self.mmap)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+    def release(self):
+        """バッファをプールに返す"""
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            pool._release(self)
+
+    def _destroy(self):
+        try:
+            self.view.release()
+            self.mmap.close()
+        except BufferError:
+            # スライスがまだ参照されている場合はGCに任せる
+            pass
+
+
+class BufferPool:
+    """並行ジョブで共有する書き込みバッファのプール
+
+    解放されたバッファは破棄せずに次のジョブで再利用する。
+    合計サイズが予算を超える場合はバッファが返されるまで待つため、
+    並行ジョブが増えてもRSSは予算以上に増えない。
+    """
+
+    def __init__(self, budget=POOL_BUDGET):
+        self.budget = budget
+        self._free = {}          # サイズ -> 未使用バッファのリスト
+        self._allocated = 0      # 確保済みの合計（使用中＋未使用）
+        self._in_use = 0
+        self._waiting = 0
+        self._condition = threading.Condition()
+        self.stats = {"acquired": 0, "reused": 0, "allocated": 0, "waits": 0}
+
+    @staticmethod
+    def _round_up(size):
+        return -(-size // BUFFER_ALIGNMENT) * BUFFER_ALIGNMENT
+
+    def acquire(self, size, timeout=None):
+        """size以上のバッファを借りる。予算を超える場合は空くまで待つ（タイムアウト時はNone）"""
+        size = self._round_up(size)
+        with self._condition:
+            waited = False
+            while True:
+                free = self._free.get(size)
+                if free:
+                    buffer = free.pop()
+                    buffer._pool = self
+                    self.stats["reused"] += 1
+                    break
+
+                # 他のサイズの未使用バッファを解放して予算を空ける
+                if self._allocated + size > self.budget:
+                    self._trim(self._allocated + size - self.budget)
+
+                # 予算より大きいバッファでも、他に何も確保していなければ許可する
+                if self._allocated + size <= self.budget or self._allocated == 0:
+                    buffer = PooledBuffer(self, size)
+                    self._allocated += size
+                    self.stats["allocated"] += 1
+                    break
+
+                if timeout == 0:
+                    return None
+                if not waited:
+                    self.stats["waits"] += 1
+                    waited = True
+                self._waiting += 1
+                try:
+                    if not self._condition.wait(timeout):
+                        return None
+                finally:
+                    self._waiting -= 1
+
+            self._in_use += size
+            self.stats["acquired"] += 1
+            return buffer
+
+    def _release(self, buffer):
+        with self._condition:
+            self._in_use -= buffer.size
+            self._free.setdefault(buffer.size, []).append(buffer)
+            self._condition.notify_all()
+
+    def _trim(self, needed):
+        """未使用バッファを解放する（ロック保持中に呼ぶ）"""
+        for size in list(self._free):
+            free = self._free[size]
+            while free and needed > 0:
+                free.pop()._destroy()
+                self._allocated -= size
+                needed -= size
+            if not free:
+                del self._free[size]
+
+    def status(self):
+        with self._condition:
+            return {
+                "budget_bytes": self.budget,
+                "allocated_bytes": self._allocated,
+                "in_use_bytes": self._in_use,
+                "waiting_jobs": self._waiting,
+                "stats": dict(self.stats),
+            }
+
+
+# プロセス全体で共有するプール
+_pool = BufferPool()
+
+
+def get_pool():
+    return _pool
+
+
+def acquire(size, timeout=None):
+    """共有プールから書き込みバッファを借りる"""
+    return _pool.acquire(size, timeout)
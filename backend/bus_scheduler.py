@@ -0,0 +1,132 @@
+"""USBバスごとの同時書き込み数と帯域の制御
+
+同じルートハブ（コントローラ）に多数のUSBメモリを繋いで同時に書き込むと、
+全体のスループットがかえって落ちることがある。バスごとに同時書き込み数を制限し、
+上限は計測した合計スループットから自動で調整する（YAKERU_BUS_MAX_WRITERSで固定も可能）。
+YAKERU_BUS_BANDWIDTH_MBPSを指定すると、同じバスのジョブで共有するレート制限もかける。
+"""
+import os
+import time
+import threading
+
+MB = 1024 * 1024
+
+# バスごとの同時書き込み数の上限（0は計測に基づいて自動調整）
+FIXED_BUS_WRITERS = int(os.environ.get("YAKERU_BUS_MAX_WRITERS", "0"))
+# 自動調整の初期値と最大値
+AUTO_START_WRITERS = 2
+AUTO_MAX_WRITERS = 8
+# 合計スループットがこの割合以上増えなければ、同時書き込み数を増やす意味がないとみなす
+GAIN_THRESHOLD = 0.05
+# バスごとの帯域の上限（0は制限なし）
+BUS_BANDWIDTH = float(os.environ.get("YAKERU_BUS_BANDWIDTH_MBPS", "0")) * MB
+# 合計スループットのEWMAの平滑化係数
+EWMA_ALPHA = 0.2
+
+
+class RateLimiter:
+    """同じバスのジョブで共有するトークンバケット"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def throttle(self, count):
+        """countバイトの書き込みが帯域の上限を超えないよう待つ"""
+        with self._lock:
+            now = time.monotonic()
+            # 遊んでいた時間の分をまとめて使えないよう、最大1秒分までしか貯めない
+            start = max(now - 1.0, self._next_time)
+            self._next_time = start + count / self.rate
+            delay = self._next_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class BusScheduler:
+    """バスごとの同時書き込み数を管理し、合計スループットを計測する"""
+
+    def __init__(self, fixed_writers=FIXED_BUS_WRITERS, bandwidth=BUS_BANDWIDTH):
+        self.fixed_writers = fixed_writers
+        self.bandwidth = bandwidth
+        self._active = {}        # バス -> 書き込み中のジョブ数
+        self._throughput = {}    # バス -> {同時書き込み数: 合計スループットのEWMA}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def writer_limit(self, bus):
+        """バスの同時書き込み数の上限"""
+        if bus is None:
+            return None
+        if self.fixed_writers > 0:
+            return self.fixed_writers
+        with self._lock:
+            levels = dict(self._throughput.get(bus, {}))
+        if not levels:
+            return AUTO_START_WRITERS
+        # 最大の合計スループットにほぼ届く最小の同時書き込み数を選ぶ
+        best = max(levels.values())
+        limit = min(n for n, rate in levels.items() if rate >= best * (1 - GAIN_THRESHOLD))
+        # 計測済みの中で最大の数が最良なら、もう1台増やして試す
+        if limit == max(levels) and limit < AUTO_MAX_WRITERS:
+            limit += 1
+        return limit
+
+    def try_acquire(self, bus):
+        """バスに空きがあれば書き込み枠を確保してTrueを返す"""
+        if bus is None:
+            return True
+        limit = self.writer_limit(bus)
+        with self._lock:
+            active = self._active.get(bus, 0)
+            if active >= limit:
+                return False
+            self._active[bus] = active + 1
+            return True
+
+    def release(self, bus):
+        if bus is None:
+            return
+        with self._lock:
+            self._active[bus] = max(self._active.get(bus, 0) - 1, 0)
+
+    def rate_limiter(self, bus):
+        """バスで共有するレート制限（設定されていなければNone）"""
+        if bus is None or self.bandwidth <= 0:
+            return None
+        with self._lock:
+            limiter = self._limiters.get(bus)
+            if limiter is None:
+                limiter = self._limiters[bus] = RateLimiter(self.bandwidth)
+            return limiter
+
+    def record(self, bus, writers, aggregate_rate):
+        """writers台が同時に書き込んでいるときの合計スループットを記録する"""
+        if bus is None or writers <= 0 or aggregate_rate <= 0:
+            return
+        with self._lock:
+            levels = self._throughput.setdefault(bus, {})
+            previous = levels.get(writers)
+            levels[writers] = aggregate_rate if previous is None else (
+                EWMA_ALPHA * aggregate_rate + (1 - EWMA_ALPHA) * previous)
+
+    def status(self):
+        with self._lock:
+            buses = sorted(set(self._active) | set(self._throughput))
+            active = dict(self._active)
+            throughput = {bus: dict(levels) for bus, levels in self._throughput.items()}
+        return {
+            "fixed_writers": self.fixed_writers or None,
+            "bandwidth_mbps": round(self.bandwidth / MB, 2) if self.bandwidth else None,
+            "buses": [{
+                "bus": bus,
+                "active_writers": active.get(bus, 0),
+                "writer_limit": self.writer_limit(bus),
+                "aggregate_mbps_by_writers": {n: round(rate / MB, 2)
+                                              for n, rate in sorted(throughput.get(bus, {}).items())},
+            } for bus in buses],
+        }
+
+
+SCHEDULER = BusScheduler()
@@ -0,0 +1,266 @@
+"""容量偽装USBメモリの検出（書き込み前の容量プローブ）
+
+報告された容量全体に対数間隔で並べた位置に、位置を埋め込んだ4KBのタグを書いて読み戻す。
+実容量を超えた位置への書き込みが先頭側に折り返すデバイスでは、低い位置のタグが高い位置の
+タグで上書きされ、書き込みを捨てるデバイスではタグが読み戻せない。どちらの場合も、
+最初に失敗した位置の手前までを実際に使える容量とする。元の内容は読んでおき、最後に書き戻す。
+"""
+import os
+import json
+import time
+import errno
+import struct
+import hashlib
+import threading
+import device_io
+import buffer_pool
+import device_registry
+from log_pipeline import log
+
+MB = 1024 * 1024
+
+# タグの大きさ（O_DIRECTで書けるよう4096の倍数）
+PROBE_BLOCK_SIZE = 4096
+# 先頭側で最初に調べる位置と、容量が倍になるごとに調べる位置の数
+MIN_PROBE_OFFSET = MB
+PROBES_PER_DOUBLING = 4
+# 結果の保存先
+RESULTS_PATH = os.environ.get(
+    "YAKERU_CAPACITY_PROBES",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "capacity_probes.json")
+)
+TAG_MAGIC = b"YAKERU-PROBE"
+
+_lock = threading.Lock()
+
+
+def _load():
+    try:
+        with open(RESULTS_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save(results):
+    tmp_path = RESULTS_PATH + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(results, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, RESULTS_PATH)
+
+
+def probe_offsets(capacity, block_size=PROBE_BLOCK_SIZE):
+    """先頭・末尾と、容量が倍になるごとにPROBES_PER_DOUBLING個ずつ並べた位置
+
+    実容量が2のべき乗の偽装デバイスでは、折り返し先もこの中のどれかになる
+    """
+    last = (capacity - block_size) // block_size * block_size
+    if last < 0:
+        return []
+    offsets = {0, last}
+    base = MIN_PROBE_OFFSET
+    while base < capacity:
+        for step in range(PROBES_PER_DOUBLING):
+            offset = (base + base * step // PROBES_PER_DOUBLING) // block_size * block_size
+            if offset <= last:
+                offsets.add(offset)
+        base *= 2
+    return sorted(offsets)
+
+
+def _tag(nonce, offset, block_size=PROBE_BLOCK_SIZE):
+    header = TAG_MAGIC + nonce + struct.pack("<Q", offset)
+    fill = hashlib.sha256(header).digest()
+    body = fill * ((block_size - len(header)) // len(fill) + 1)
+    return (header + body)[:block_size]
+
+
+def _tag_offset(data, nonce):
+    """読み戻したデータがこのプローブのタグなら、書き込んだ位置を返す（壊れていればNone）"""
+    header_size = len(TAG_MAGIC) + len(nonce)
+    if bytes(data[:header_size]) != TAG_MAGIC + nonce:
+        return None
+    offset, = struct.unpack_from("<Q", data, header_size)
+    return offset if bytes(data) == _tag(nonce, offset, len(data)) else None
+
+
+def _restore(device_path, writer, write_block, originals):
+    """プローブで上書きした位置に元の内容を書き戻す。最初に起きたエラーを返す（なければNone）"""
+    first_error = None
+    # 折り返したデバイスでは高い位置の書き戻しが低い位置を上書きするため、高い位置から書き戻す
+    for offset in sorted(originals, reverse=True):
+        try:
+            write_block(offset, originals[offset])
+        except OSError as e:
+            log("probe", f"Failed to restore {device_path} at offset {offset}: {e}",
+                level="error", device=device_path)
+            first_error = first_error or e
+    try:
+        writer.fsync()
+    except OSError as e:
+        log("probe", f"Failed to flush restored data to {device_path}: {e}",
+            level="error", device=device_path)
+        first_error = first_error or e
+    return first_error
+
+
+def probe(device_path):
+    """デバイスの実際に使える容量を調べ、結果を保存して返す
+
+    数十か所に4KBずつ書き込むだけなので、通常は数秒で終わる
+    """
+    started = time.monotonic()
+    nonce = os.urandom(16)
+    block_size = PROBE_BLOCK_SIZE
+
+    reader, direct = device_io.open_uncached(device_path)
+    try:
+        reported = reader.size()
+        offsets = probe_offsets(reported, block_size)
+        writer = device_io.open_device(device_path, writable=True,
+                                       engine="direct" if direct else "buffered")
+        buffer = buffer_pool.get_pool().acquire(block_size)
+        view = buffer.view[:block_size]
+
+        def read_block(offset):
+            if not direct:
+                reader.drop_cache(offset, block_size)
+            return bytes(view[:reader.preadinto(view, offset)])
+
+        def write_block(offset, data):
+            view[:len(data)] = data
+            done = 0
+            while done < len(data):
+                written = writer.pwrite(view[done:len(data)], offset + done)
+                if written <= 0:
+                    raise OSError(errno.EIO, f"Device accepted 0 bytes at offset {offset + done}",
+                                  device_path)
+                done += written
+
+        originals = {}
+        try:
+            for offset in offsets:
+                originals[offset] = read_block(offset)
+            # 低い位置から順に書き、折り返した書き込みが先に書いたタグを上書きするようにする
+            for offset in offsets:
+                write_block(offset, _tag(nonce, offset, block_size))
+            writer.fsync()
+
+            bad = set()
+            # 読み戻したタグごとに位置をまとめる。同じタグが読める位置は同じ物理位置を共有している
+            sharing = {}
+            for offset in offsets:
+                found = _tag_offset(read_block(offset), nonce)
+                if found is None:
+                    bad.add(offset)
+                else:
+                    sharing.setdefault(found, []).append(offset)
+            for found, members in sharing.items():
+                # 折り返しは高い位置から低い位置へ起こるため、本物でありうるのは一番低い位置だけ
+                bad.update(offset for offset in members if offset != min(members))
+                if found not in members:
+                    bad.add(found)
+        except BaseException:
+            # プローブ自体のエラーを優先する（書き戻しのエラーはログに残すだけ）
+            _restore(device_path, writer, write_block, originals)
+            raise
+        else:
+            error = _restore(device_path, writer, write_block, originals)
+            if error is not None:
+                raise error
+        finally:
+            try:
+                writer.close()
+            finally:
+                buffer.release()
+    finally:
+        reader.close()
+
+    if bad:
+        # 最初に失敗した位置と、その手前で成功した位置の間は確かめていないため、成功した位置までとする
+        good = [offset for offset in offsets if offset < min(bad) and offset not in bad]
+        usable = max(good) + block_size if good else 0
+    else:
+        usable = reported
+    key, serial = device_registry.device_key(device_path)
+    result = {
+        "device": device_path,
+        "serial": serial,
+        "reported_bytes": reported,
+        "usable_bytes": usable,
+        "counterfeit": bool(bad),
+        "probes": len(offsets),
+        "failed_offsets": sorted(bad)[:16],
+        "direct_io": direct,
+        "seconds": round(time.monotonic() - started, 3),
+        "probed_at": time.time(),
+    }
+    with _lock:
+        results = _load()
+        results[key] = result
+        _save(results)
+    if bad:
+        log("probe", f"Counterfeit capacity detected on {device_path}: reports {reported} bytes, "
+            f"usable {usable} bytes", level="warning", device=device_path,
+            reported_bytes=reported, usable_bytes=usable)
+    else:
+        log("probe", f"Capacity probe of {device_path}: {reported} bytes OK ({len(offsets)} probes, "
+            f"{result['seconds']}s)", device=device_path)
+    return result
+
+
+def get_result(device_path):
+    """保存されているプローブ結果（なければNone）"""
+    with _lock:
+        results = _load()
+    if not results:
+        return None
+    key, _ = device_registry.device_key(device_path)
+    return results.get(key)
+
+
+def annotate(devices):
+    """デバイス一覧にプローブで分かった使える容量を付け加える"""
+    with _lock:
+        results = _load()
+    if not results:
+        return devices
+    for device in devices:
+        key, _ = device_registry.device_key(device["id"])
+        result = results.get(key)
+        if result is not None:
+            device["usable_bytes"] = result["usable_bytes"]
+            device["counterfeit"] = result["counterfeit"]
+    return devices
+
+
+def reported_capacity(device_path):
+    """デバイスが報告する容量（バイト、分からなければNone）"""
+    from usb_detector import get_device_geometry
+    return get_device_geometry(device_path)["size_bytes"]
+
+
+def device_capacity(device_path):
+    """書き込める容量（プローブで偽装が分かっていれば実際の容量、なければ報告された容量。不明ならNone）"""
+    result = get_result(device_path)
+    if result is not None:
+        return result["usable_bytes"]
+    return reported_capacity(device_path)
+
+
+def ensure_fits(device_path, size):
+    """イメージがデバイスの容量（プローブで分かった使える容量）を超える場合はOSErrorにする
+
+    容量が分からないデバイス（通常ファイルなど）は確かめない
+    """
+    result = get_result(device_path)
+    if result is not None and size > result["usable_bytes"]:
+        raise OSError(errno.ENOSPC,
+                      f"Image ({size} bytes) exceeds the usable capacity of {device_path} "
+                      f"({result['usable_bytes']} bytes; the device reports {result['reported_bytes']})")
+    capacity = reported_capacity(device_path)
+    if capacity is not None and size > capacity:
+        raise OSError(errno.ENOSPC,
+                      f"Image ({size} bytes) exceeds the capacity of {device_path} ({capacity} bytes)")
@@ -0,0 +1,73 @@
+import os
+import json
+import threading
+
+# ISO_DIR内に置くチェックサムの索引ファイル
+INDEX_NAME = ".checksums.json"
+
+_lock = threading.Lock()
+
+
+def _index_path(iso_dir):
+    return os.path.join(iso_dir, INDEX_NAME)
+
+
+def load(iso_dir):
+    """索引を読み込む（ファイル名 -> エントリ）"""
+    try:
+        with open(_index_path(iso_dir), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save(iso_dir, index):
+    path = _index_path(iso_dir)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def record(iso_dir, filename, checksums):
+    """ファイルのチェックサムを記録する（サイズと更新時刻も保存し、変更されたら無効にする）"""
+    stat = os.stat(os.path.join(iso_dir, filename))
+    with _lock:
+        index = load(iso_dir)
+        index[filename] = dict(checksums, size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                               dev=stat.st_dev, ino=stat.st_ino)
+        _save(iso_dir, index)
+
+
+def remove(iso_dir, filename):
+    with _lock:
+        index = load(iso_dir)
+        if index.pop(filename, None) is not None:
+            _save(iso_dir, index)
+
+
+def _matches(entry, stat):
+    return stat.st_size == entry.get("size") and stat.st_mtime_ns == entry.get("mtime_ns")
+
+
+def lookup(iso_dir, filename, index=None):
+    """記録後に変更されていなければチェックサムを返す
+
+    ファイル名で見つからない場合も、同じinodeを指す別名（ハードリンク）の記録があればそれを使う
+    """
+    if index is None:
+        index = load(iso_dir)
+    try:
+        stat = os.stat(os.path.join(iso_dir, filename))
+    except OSError:
+        return None
+    entry = index.get(filename)
+    if entry is None or not _matches(entry, stat):
+        entry = next((e for e in index.values()
+                      if e.get("ino") == stat.st_ino and e.get("dev") == stat.st_dev
+                      and _matches(e, stat)), None)
+        if entry is None:
+            return None
+    return {k: v for k, v in entry.items() if k not in ("size", "mtime_ns", "dev", "ino")}
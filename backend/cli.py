@@ -0,0 +1,174 @@
+"""サーバーを起動せずにUSBメモリへ書き込むコマンドラインツール
+
+自動化から使うためのエントリポイント。Flask・Socket.IOは読み込まず、
+書き込みに必要なモジュールもサブコマンドを実行するときに読み込むため、すぐに起動する。
+結果はJSONで標準出力に出し、進捗は標準エラー出力に1行で表示する。
+
+    python cli.py devices
+    python cli.py write ubuntu.iso /dev/sdc /dev/sdd --verify
+    python cli.py write ubuntu.iso --all --max-concurrent 8 > result.json
+
+終了コード: 0=すべて成功（省略を含む）、1=失敗したジョブがある、2=引数や計画の誤り、130=中断
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import log_pipeline
+
+MB = 1024 * 1024
+
+# 進捗表示の更新間隔（秒）。端末でない場合は行を追加するため間隔を長くする
+PROGRESS_INTERVAL = 0.5
+PROGRESS_LOG_INTERVAL = 10.0
+
+
+def _dump(data):
+    print(json.dumps(data, indent=2, ensure_ascii=False))
+
+
+def _configure_logging(verbose):
+    """書き込み処理のログが結果のJSONに混ざらないよう、標準エラー出力に回す（--verboseのときだけ表示）"""
+    log_pipeline.configure(stream=sys.stderr, fmt="text", level="info" if verbose else "off")
+
+
+def cmd_devices(args):
+    from usb_detector import list_usb_devices
+    devices = list_usb_devices(min_size=args.min_size)
+    _dump(devices)
+    return 0
+
+
+def _progress_line(snapshot):
+    elapsed = time.time() - snapshot["started_at"] if snapshot["started_at"] else 0.0
+    rate = snapshot["bytes_written"] / MB / elapsed if elapsed > 0 else 0.0
+    eta = snapshot["eta_seconds"]
+    counts = " ".join(f"{state}={count}" for state, count in sorted(snapshot["jobs_by_state"].items()))
+    return (f"{snapshot['percent']:6.2f}%  {snapshot['bytes_written'] / MB:,.0f}/"
+            f"{snapshot['total_bytes'] / MB:,.0f} MB  {rate:6.1f} MB/s  "
+            f"eta {'-' if eta is None else f'{eta:.0f}s'}  {counts}")
+
+
+def _job_result(job):
+    telemetry = job["telemetry"] or {}
+    return {
+        "device": job["device"],
+        "state": job["state"],
+        "error": job["error"],
+        "bytes_written": telemetry.get("bytes_written", 0),
+        "average_mbps": telemetry.get("average_mbps"),
+        "elapsed_seconds": telemetry.get("elapsed_seconds"),
+        "retries": telemetry.get("retries", 0),
+        "verification": telemetry.get("verification"),
+    }
+
+
+def _wait(current, show_progress, verbose):
+    """バッチの完了を待ちながら進捗を表示する（Ctrl+Cで未開始のジョブを取り消す）"""
+    interactive = sys.stderr.isatty() and not verbose
+    interval = PROGRESS_INTERVAL if interactive else PROGRESS_LOG_INTERVAL
+    last = 0.0
+    interrupted = False
+    while current.state in ("planned", "running"):
+        try:
+            time.sleep(PROGRESS_INTERVAL)
+        except KeyboardInterrupt:
+            if interrupted:
+                raise
+            # 実行中のジョブは書き込みを終えるまで待つ（もう一度Ctrl+Cで強制終了）
+            interrupted = True
+            current.cancel()
+            print("\nCancelling pending jobs; waiting for running jobs to finish...", file=sys.stderr)
+        now = time.monotonic()
+        if show_progress and now - last >= interval:
+            last = now
+            line = _progress_line(current.snapshot())
+            sys.stderr.write(f"\r{line}\033[K" if interactive else line + "\n")
+            sys.stderr.flush()
+    if show_progress:
+        line = _progress_line(current.snapshot())
+        sys.stderr.write(f"\r{line}\033[K\n" if interactive else line + "\n")
+    return interrupted
+
+
+def cmd_write(args):
+    import threading
+    import batch
+    from usb_detector import list_usb_devices, usable_capacity
+
+    image = os.path.abspath(args.image)
+    devices = list(args.devices)
+    if args.all:
+        # イメージが収まらないことが分かっているデバイスは選ばない
+        size = os.path.getsize(image) if os.path.exists(image) else 0
+        for device in list_usb_devices():
+            capacity = usable_capacity(device)
+            if device["id"] not in devices and (capacity is None or capacity >= size):
+                devices.append(device["id"])
+    manifest = {
+        "items": [{"iso_file": os.path.basename(image), "devices": devices}],
+        "max_concurrent": args.max_concurrent or len(devices),
+        "engine": args.engine,
+        "verify": args.verify,
+        "skip_if_current": args.skip_if_current,
+        "probe_capacity": args.probe_capacity,
+    }
+    try:
+        current = batch.create_batch(manifest, os.path.dirname(image), [])
+    except batch.BatchError as e:
+        _dump({"error": str(e)})
+        return 2
+
+    started = time.monotonic()
+    current.start(lambda func: threading.Thread(target=func, daemon=True).start())
+    interrupted = _wait(current, not args.no_progress, args.verbose)
+    log_pipeline.flush()
+
+    snapshot = current.snapshot()
+    _dump({
+        "image": image,
+        "state": snapshot["state"],
+        "seconds": round(time.monotonic() - started, 2),
+        "total_bytes": snapshot["total_bytes"],
+        "bytes_written": snapshot["bytes_written"],
+        "jobs": [_job_result(job) for job in snapshot["jobs"]],
+    })
+    if interrupted:
+        return 130
+    return 0 if snapshot["state"] == "completed" else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Yakeru-USB headless writer")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show the writer's log on stderr instead of the progress line")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    devices = commands.add_parser("devices", help="list USB devices as JSON")
+    devices.add_argument("--min-size", type=int, metavar="BYTES",
+                         help="only devices with at least this much usable capacity")
+    devices.set_defaults(func=cmd_devices)
+
+    write = commands.add_parser("write", help="write one image to one or more devices in parallel")
+    write.add_argument("image", help="path to the ISO image")
+    write.add_argument("devices", nargs="*", help="device paths (e.g. /dev/sdc, sim:///tmp/stick.img)")
+    write.add_argument("--all", action="store_true", help="write to every detected USB device")
+    write.add_argument("--max-concurrent", type=int,
+                       help="devices written at the same time (default: all)")
+    write.add_argument("--engine", choices=("buffered", "direct", "dsync"))
+    write.add_argument("--verify", action="store_true", help="sampled read-back verification")
+    write.add_argument("--skip-if-current", action="store_true",
+                       help="skip devices that already hold this image")
+    write.add_argument("--probe-capacity", action="store_true",
+                       help="check for counterfeit capacity before writing")
+    write.add_argument("--no-progress", action="store_true", help="do not show the progress line")
+    write.set_defaults(func=cmd_write)
+
+    args = parser.parse_args()
+    _configure_logging(args.verbose)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,418 @@
+"""複数のバックエンド（ノード）をまとめて操作するコーディネーター
+
+各ノードは通常どおりapp.pyを実行しているマシンで、コーディネーターはそのHTTP APIだけを使う。
+ノードのデバイス一覧とISO一覧を集約し、イメージを持っていて空いているデバイスのあるノードに
+ジョブを割り振り（各ノードではバッチ書き込みとして実行）、ノードごとの進捗をまとめて通知する。
+
+ノードは環境変数 YAKERU_CLUSTER_NODES（カンマ区切りのURL）か、APIで登録する。
+"""
+import os
+import json
+import time
+import uuid
+import threading
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from urllib.parse import urlparse
+from log_pipeline import log
+
+# 起動時に登録するノード（例: http://bench1:5000,http://bench2:5000）
+CLUSTER_NODES = [url.strip() for url in os.environ.get("YAKERU_CLUSTER_NODES", "").split(",") if url.strip()]
+# ノードへのリクエストのタイムアウト（秒）
+REQUEST_TIMEOUT = float(os.environ.get("YAKERU_CLUSTER_TIMEOUT", "10"))
+# ノードの進捗を取得する間隔（秒）
+POLL_INTERVAL = 1.0
+# この時間応答のないノードのジョブは失われたものとみなす（秒）
+NODE_LOST_TIMEOUT = 60.0
+# 保持するクラスタジョブ履歴の件数
+CLUSTER_HISTORY_LIMIT = 20
+
+
+class ClusterError(Exception):
+    """ノードとの通信の失敗や割り当ての失敗（HTTPステータスコード付き）"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class Node:
+    """バックエンドの1台。最後に取得したデバイス・ISO・バッチの状態を保持する"""
+
+    def __init__(self, url, name=None):
+        self.url = url.rstrip("/")
+        self.name = name or urlparse(self.url).netloc or self.url
+        self.online = False
+        self.busy = False
+        self.error = None
+        self.last_seen = None
+        self.devices = []
+        self.isos = []
+
+    def request(self, method, path, body=None):
+        """ノードのAPIを呼び出してJSONを返す。エラー応答はClusterErrorにする"""
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(f"{self.url}{path}", data=data, method=method,
+                                         headers={"Content-Type": "application/json",
+                                                  "User-Agent": "Yakeru-USB"})
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+                return json.loads(response.read() or b"{}")
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get("error") or str(e)
+            except ValueError:
+                message = str(e)
+            raise ClusterError(f"{self.name}: {message}", e.code)
+        except (OSError, ValueError) as e:
+            raise ClusterError(f"{self.name}: {e}", 502)
+
+    def refresh(self):
+        """デバイス一覧・ISO一覧・書き込み中かどうかを取得し直す"""
+        try:
+            self.isos = self.request("GET", "/api/isos").get("isos", [])
+            try:
+                self.devices = self.request("GET", "/api/usb-devices").get("devices", [])
+                writing = False
+            except ClusterError as e:
+                # 単独の書き込み中はデバイス一覧の取得がブロックされる（423）
+                if e.status != 423:
+                    raise
+                self.devices = []
+                writing = True
+            batches = self.request("GET", "/api/batches").get("batches", [])
+            self.busy = writing or any(b.get("state") == "running" for b in batches)
+            self.online = True
+            self.error = None
+            self.last_seen = time.time()
+        except ClusterError as e:
+            self.online = False
+            self.error = str(e)
+        return self
+
+    def free_devices(self):
+        return [] if self.busy or not self.online else [d["id"] for d in self.devices]
+
+    def find_iso(self, iso_file, sha256=None):
+        for iso in self.isos:
+            if iso.get("name") == iso_file and (not sha256 or iso.get("sha256") in (None, sha256)):
+                return iso
+        return None
+
+    def snapshot(self):
+        return {
+            "name": self.name,
+            "url": self.url,
+            "online": self.online,
+            "busy": self.busy,
+            "error": self.error,
+            "last_seen": self.last_seen,
+            "devices": len(self.devices),
+            "isos": len(self.isos),
+        }
+
+
+# ---- ノードの管理 ----
+
+_nodes = OrderedDict()
+_nodes_lock = threading.Lock()
+
+
+def add_node(url, name=None):
+    if not url or not url.startswith(("http://", "https://")):
+        raise ClusterError("Node url must start with http:// or https://")
+    node = Node(url, name)
+    with _nodes_lock:
+        if node.name in _nodes:
+            raise ClusterError(f"Node {node.name} is already registered", 409)
+        _nodes[node.name] = node
+    return node.refresh()
+
+
+def remove_node(name):
+    with _nodes_lock:
+        if _nodes.pop(name, None) is None:
+            raise ClusterError(f"Node {name} not found", 404)
+
+
+def list_nodes():
+    with _nodes_lock:
+        return list(_nodes.values())
+
+
+def get_node(name):
+    with _nodes_lock:
+        return _nodes.get(name)
+
+
+def refresh_nodes():
+    """全ノードの状態を並行して取得し直す"""
+    nodes = list_nodes()
+    threads = [threading.Thread(target=node.refresh, daemon=True) for node in nodes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return nodes
+
+
+def aggregate_devices(nodes):
+    return [dict(device, node=node.name, busy=node.busy)
+            for node in nodes if node.online for device in node.devices]
+
+
+def aggregate_isos(nodes):
+    """ISOファイル名ごとに、持っているノードをまとめる"""
+    isos = OrderedDict()
+    for node in nodes:
+        if not node.online:
+            continue
+        for iso in node.isos:
+            entry = isos.setdefault(iso["name"], {"name": iso["name"], "size": iso.get("size"),
+                                                  "sha256": iso.get("sha256"), "nodes": []})
+            entry["nodes"].append(node.name)
+            if iso.get("sha256") and entry["sha256"] and iso["sha256"] != entry["sha256"]:
+                # 同じ名前で内容の異なるイメージがある
+                entry["conflict"] = True
+    return list(isos.values())
+
+
+for _url in CLUSTER_NODES:
+    with _nodes_lock:
+        _node = Node(_url)
+        _nodes[_node.name] = _node
+
+
+# ---- 割り当て ----
+
+def plan(manifest, nodes):
+    """マニフェストのジョブをノードに割り振り、{ノード名: ノードに送るマニフェスト} を返す
+
+    デバイスを指定したジョブはそのノードへ、台数指定のジョブはイメージを持つノードのうち
+    空きデバイスの多いノードから順に割り当てる（持っているノードの少ないイメージから先に割り当てる）。
+    """
+    items = manifest.get("items")
+    if not items:
+        raise ClusterError("Manifest must contain items")
+    by_name = {node.name: node for node in nodes}
+    free = {node.name: len(node.free_devices()) for node in nodes}
+    assignments = OrderedDict()
+
+    def assign(node_name, iso_file, device=None):
+        node_manifest = assignments.setdefault(node_name, {"items": OrderedDict()})
+        item = node_manifest["items"].setdefault(iso_file, {"iso_file": iso_file, "count": 0,
+                                                            "devices": []})
+        if device is None:
+            item["count"] += 1
+        else:
+            item["devices"].append(device)
+        free[node_name] -= 1
+
+    counted = []
+    for item in items:
+        iso_file = item.get("iso_file")
+        if not iso_file:
+            raise ClusterError("Each item must specify iso_file")
+        sha256 = item.get("sha256")
+        for target in item.get("devices") or []:
+            node = by_name.get(target.get("node"))
+            if node is None:
+                raise ClusterError(f"Node {target.get('node')} not found", 404)
+            if node.busy or not node.online:
+                raise ClusterError(f"Node {node.name} is not available", 409)
+            if node.find_iso(iso_file, sha256) is None:
+                raise ClusterError(f"Node {node.name} does not have {iso_file}", 404)
+            assign(node.name, iso_file, device=target.get("device"))
+        count = int(item.get("count", 0))
+        if count < 0:
+            raise ClusterError("count must not be negative")
+        if count:
+            candidates = [node.name for node in nodes if node.find_iso(iso_file, sha256) is not None]
+            if not candidates:
+                raise ClusterError(f"No node has {iso_file}", 404)
+            counted.append((iso_file, count, candidates))
+
+    counted.sort(key=lambda entry: len(entry[2]))
+    for iso_file, count, candidates in counted:
+        for _ in range(count):
+            node_name = max(candidates, key=lambda name: free[name])
+            if free[node_name] <= 0:
+                raise ClusterError(f"Not enough free devices for {iso_file}", 409)
+            assign(node_name, iso_file)
+
+    if any(value < 0 for value in free.values()):
+        raise ClusterError("Not enough free devices", 409)
+    if not assignments:
+        raise ClusterError("Manifest does not contain any jobs")
+    for node_manifest in assignments.values():
+        node_manifest["items"] = list(node_manifest["items"].values())
+        for key in ("max_concurrent", "engine", "verify", "skip_if_current", "probe_capacity"):
+            if manifest.get(key) is not None:
+                node_manifest[key] = manifest[key]
+    return assignments
+
+
+# ---- 実行 ----
+
+class ClusterJob:
+    """各ノードに送ったバッチの進捗をまとめる"""
+
+    def __init__(self, assignments):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.state = "planned"
+        self.created_at = time.time()
+        self.finished_at = None
+        self.parts = OrderedDict((name, {
+            "node": name,
+            "manifest": node_manifest,
+            "batch_id": None,
+            "batch": None,
+            "state": "planned",
+            "error": None,
+            "last_seen": None,
+        }) for name, node_manifest in assignments.items())
+        self._cancelled = False
+        self._on_update = None
+
+    def start(self, spawn, on_update=None):
+        """各ノードでバッチを開始し、spawn(func)で起動したスレッドで進捗を取得し続ける"""
+        self._on_update = on_update
+        self.state = "running"
+        for name, part in self.parts.items():
+            node = get_node(name)
+            try:
+                if node is None:
+                    raise ClusterError(f"Node {name} not found", 404)
+                result = node.request("POST", "/api/batches", part["manifest"])
+                part["batch_id"] = result["batch_id"]
+                part["batch"] = result
+                part["state"] = "running"
+                part["last_seen"] = time.monotonic()
+            except ClusterError as e:
+                part["state"] = "error"
+                part["error"] = str(e)
+                log("cluster", f"Failed to start on {name}: {e}", level="error",
+                    cluster_job_id=self.job_id, node=name)
+        log("cluster", f"Dispatched to {len(self.parts)} nodes", cluster_job_id=self.job_id)
+        spawn(self._poll)
+
+    def cancel(self):
+        """各ノードの未開始のジョブを取り消す"""
+        self._cancelled = True
+        for name, part in self.parts.items():
+            node = get_node(name)
+            if node is None or part["state"] != "running":
+                continue
+            try:
+                part["batch"] = node.request("POST", f"/api/batches/{part['batch_id']}/cancel")
+            except ClusterError as e:
+                log("cluster", f"Failed to cancel on {name}: {e}", level="warning",
+                    cluster_job_id=self.job_id, node=name)
+
+    def _poll(self):
+        while any(part["state"] == "running" for part in self.parts.values()):
+            for name, part in self.parts.items():
+                if part["state"] == "running":
+                    self._poll_part(name, part)
+            self._notify()
+            time.sleep(POLL_INTERVAL)
+        states = [part["state"] for part in self.parts.values()]
+        if all(state == "completed" for state in states):
+            self.state = "completed"
+        elif self._cancelled:
+            self.state = "cancelled"
+        else:
+            self.state = "completed_with_errors"
+        self.finished_at = time.time()
+        log("cluster", self.state, cluster_job_id=self.job_id, state=self.state)
+        self._notify()
+
+    def _poll_part(self, name, part):
+        node = get_node(name)
+        try:
+            if node is None:
+                raise ClusterError(f"Node {name} not found", 404)
+            part["batch"] = node.request("GET", f"/api/batches/{part['batch_id']}")
+            part["last_seen"] = time.monotonic()
+            part["error"] = None
+            if part["batch"]["state"] != "running":
+                part["state"] = part["batch"]["state"]
+        except ClusterError as e:
+            part["error"] = str(e)
+            if time.monotonic() - part["last_seen"] > NODE_LOST_TIMEOUT:
+                log("cluster", f"Lost contact with {name}: {e}", level="error",
+                    cluster_job_id=self.job_id, node=name)
+                part["state"] = "lost"
+
+    def _notify(self):
+        if self._on_update is None:
+            return
+        try:
+            self._on_update(self)
+        except Exception as e:
+            log("cluster", f"Cluster progress notification failed: {e}", level="warning",
+                cluster_job_id=self.job_id)
+
+    def snapshot(self):
+        total = 0
+        written = 0
+        etas = []
+        jobs = []
+        nodes = []
+        for name, part in self.parts.items():
+            batch = part["batch"] or {}
+            total += batch.get("total_bytes", 0)
+            written += batch.get("bytes_written", 0)
+            if batch.get("eta_seconds") is not None and part["state"] == "running":
+                etas.append(batch["eta_seconds"])
+            jobs.extend(dict(job, node=name) for job in batch.get("jobs", []))
+            nodes.append({
+                "node": name,
+                "state": part["state"],
+                "batch_id": part["batch_id"],
+                "error": part["error"],
+                "percent": batch.get("percent", 0.0),
+                "eta_seconds": batch.get("eta_seconds"),
+                "manifest": part["manifest"],
+            })
+        return {
+            "job_id": self.job_id,
+            "state": self.state,
+            "total_bytes": total,
+            "bytes_written": written,
+            "percent": round(written * 100.0 / total, 2) if total else 0.0,
+            # ノードは並行して書き込むため、一番遅いノードの残り時間が全体の残り時間
+            "eta_seconds": max(etas) if etas else None,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "nodes": nodes,
+            "jobs": jobs,
+        }
+
+
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+
+
+def create_job(manifest, register=True):
+    """マニフェストからジョブを作る。register=Falseなら一覧に載せない（dry_runの割り当て確認用）"""
+    assignments = plan(manifest, refresh_nodes())
+    job = ClusterJob(assignments)
+    if not register:
+        return job
+    with _jobs_lock:
+        _jobs[job.job_id] = job
+        while len(_jobs) > CLUSTER_HISTORY_LIMIT:
+            _jobs.popitem(last=False)
+    return job
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def list_jobs():
+    with _jobs_lock:
+        return list(_jobs.values())
@@ -0,0 +1,204 @@
+"""USBメモリごとの書き込み履歴と、劣化したデバイスの検出
+
+書き込みジョブが終わるたびに、デバイスのシリアルごとにイメージサイズ・フェーズごとの時間と速度・
+リトライ回数・検証結果を記録する。バッチが終わったときには、他のジョブより大幅に遅かったジョブに
+straggler（バッチの足を引っ張ったデバイス）の印を付ける。
+
+report() は履歴から次のデバイスを検出する:
+- degraded: 最近のジョブの書き込み速度が、最初の頃のジョブより DEGRADATION_THRESHOLD 以上遅い
+- straggler: 直近のバッチで、何度も straggler になっている
+"""
+import os
+import json
+import time
+import threading
+import device_registry
+from log_pipeline import log
+
+MB = 1024 * 1024
+
+# 記録ファイルの保存先
+HISTORY_PATH = os.environ.get(
+    "YAKERU_DEVICE_HISTORY",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "device_history.json")
+)
+# デバイスごとに保持するジョブ数
+HISTORY_LIMIT = 200
+# 基準の速度（最初の頃）と最近の速度をそれぞれ何件のジョブの中央値で求めるか
+BASELINE_JOBS = 3
+RECENT_JOBS = 3
+# 最近の速度が基準からこの割合以上落ちたら劣化とみなす
+DEGRADATION_THRESHOLD = float(os.environ.get("YAKERU_DEGRADATION_THRESHOLD", "0.3"))
+# バッチ内で他のジョブの速度の中央値のこの割合を下回った一番遅いジョブをstragglerとする
+STRAGGLER_RATIO = 0.75
+# stragglerを判定するのに必要な、バッチ内の完了したジョブ数
+STRAGGLER_MIN_JOBS = 3
+# 直近STRAGGLER_WINDOW回のバッチのうちSTRAGGLER_MIN_COUNT回以上stragglerなら報告する
+STRAGGLER_WINDOW = 10
+STRAGGLER_MIN_COUNT = 3
+
+_lock = threading.Lock()
+
+
+def _load():
+    try:
+        with open(HISTORY_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save(history):
+    tmp_path = HISTORY_PATH + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(history, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, HISTORY_PATH)
+
+
+def _rate(size, seconds):
+    return round(size / seconds / MB, 2) if size > 0 and seconds > 0 else None
+
+
+def _median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def job_entry(telemetry):
+    """テレメトリから履歴に残す1件分の記録を作る"""
+    phases = telemetry.phase_times
+    written = telemetry.bytes_written - telemetry.resumed_from
+    # バッファ経由の書き込みは同期が終わるまでデバイスに届いていないため、同期までを含めた速度を使う
+    device_seconds = sum(phases.get(phase, 0.0) for phase in ("writing", "flushing", "syncing"))
+    verification = telemetry.verification
+    return {
+        "job_id": telemetry.job_id,
+        "device": telemetry.device,
+        "finished_at": time.time(),
+        "status": telemetry.status,
+        "image_bytes": telemetry.total_bytes,
+        "bytes_written": written,
+        "phase_seconds": {phase: round(seconds, 3) for phase, seconds in phases.items()},
+        "write_mbps": _rate(written, phases.get("writing", 0.0)),
+        "device_mbps": _rate(written, device_seconds),
+        "verify_mbps": _rate(verification["verified_bytes"], phases.get("verifying", 0.0))
+        if verification else None,
+        "retries": telemetry.retries,
+        "stalls": telemetry.stall_count,
+        "verified": verification["verified"] if verification else None,
+        "mismatches": verification["mismatches"] if verification else None,
+        "straggler": False,
+    }
+
+
+def record(telemetry):
+    """終わったジョブを履歴に追加する（書き込みを省略したジョブは記録しない）"""
+    if telemetry.skipped or not telemetry.device:
+        return
+    entry = job_entry(telemetry)
+    key, serial = device_registry.device_key(telemetry.device)
+    with _lock:
+        history = _load()
+        device = history.setdefault(key, {"serial": serial, "jobs": []})
+        device["serial"] = serial or device.get("serial")
+        device["jobs"] = (device["jobs"] + [entry])[-HISTORY_LIMIT:]
+        _save(history)
+
+
+def mark_stragglers(batch_id, telemetries):
+    """バッチのジョブに batch_id を付け、他より大幅に遅かったジョブにstragglerの印を付ける
+
+    比べられるだけのジョブがないバッチは記録しない（stragglerの判定の回数に数えない）
+    """
+    rates = {}
+    for telemetry in telemetries:
+        entry = job_entry(telemetry)
+        if telemetry.status == "completed" and not telemetry.skipped and entry["device_mbps"]:
+            rates[telemetry.job_id] = (telemetry.device, entry["device_mbps"])
+    if len(rates) < STRAGGLER_MIN_JOBS:
+        return None
+    slowest, (slowest_device, rate) = min(rates.items(), key=lambda item: item[1][1])
+    others = _median([other for job_id, (_, other) in rates.items() if job_id != slowest])
+    straggler = slowest if rate < others * STRAGGLER_RATIO else None
+
+    keys = {job_id: device_registry.device_key(device_path)[0]
+            for job_id, (device_path, _) in rates.items()}
+    with _lock:
+        history = _load()
+        for job_id, key in keys.items():
+            for entry in reversed(history.get(key, {}).get("jobs", [])):
+                if entry["job_id"] == job_id:
+                    entry["batch_id"] = batch_id
+                    entry["straggler"] = job_id == straggler
+                    break
+        _save(history)
+    if straggler is not None:
+        log("history", f"{slowest_device} was the straggler of the batch ({rate} MB/s, "
+            f"others {others:.2f} MB/s)", level="warning", batch_id=batch_id, job_id=straggler,
+            device=slowest_device)
+    return straggler
+
+
+def summarize(key, device, threshold=DEGRADATION_THRESHOLD):
+    """1台分の履歴を集計し、劣化とstragglerの判定を付ける"""
+    jobs = device["jobs"]
+    completed = [job for job in jobs if job["status"] == "completed" and job["device_mbps"]]
+    summary = {
+        "key": key,
+        "serial": device.get("serial"),
+        "last_device": jobs[-1]["device"] if jobs else None,
+        "last_job_at": jobs[-1]["finished_at"] if jobs else None,
+        "jobs": len(jobs),
+        "failed_jobs": sum(1 for job in jobs if job["status"] != "completed"),
+        "bytes_written": sum(job["bytes_written"] for job in jobs),
+        "retries": sum(job["retries"] for job in jobs),
+        "verify_failures": sum(1 for job in jobs if job.get("verified") is False),
+        "latest_mbps": completed[-1]["device_mbps"] if completed else None,
+        "baseline_mbps": None,
+        "recent_mbps": None,
+        "degradation_percent": None,
+        "straggler_batches": 0,
+        "batches": 0,
+        "flags": [],
+    }
+    # 最初の頃と最近のジョブが重ならないだけの件数があるときだけ比べる
+    if len(completed) >= BASELINE_JOBS + RECENT_JOBS:
+        baseline = _median([job["device_mbps"] for job in completed[:BASELINE_JOBS]])
+        recent = _median([job["device_mbps"] for job in completed[-RECENT_JOBS:]])
+        degradation = 1.0 - recent / baseline
+        summary.update(baseline_mbps=round(baseline, 2), recent_mbps=round(recent, 2),
+                       degradation_percent=round(degradation * 100, 1))
+        if degradation >= threshold:
+            summary["flags"].append("degraded")
+    batch_jobs = [job for job in jobs if job.get("batch_id")][-STRAGGLER_WINDOW:]
+    summary["batches"] = len(batch_jobs)
+    summary["straggler_batches"] = sum(1 for job in batch_jobs if job["straggler"])
+    if summary["straggler_batches"] >= STRAGGLER_MIN_COUNT:
+        summary["flags"].append("straggler")
+    return summary
+
+
+def report(threshold=DEGRADATION_THRESHOLD, flagged_only=False):
+    """全デバイスの集計（劣化・stragglerのデバイスを先に並べる）"""
+    with _lock:
+        history = _load()
+    summaries = [summarize(key, device, threshold) for key, device in history.items()]
+    if flagged_only:
+        summaries = [summary for summary in summaries if summary["flags"]]
+    summaries.sort(key=lambda summary: (not summary["flags"], -(summary["last_job_at"] or 0)))
+    return summaries
+
+
+def get_history(device_path):
+    """デバイスの履歴（シリアルが分かれば、挿し直してパスが変わっても同じ履歴）"""
+    key, _ = device_registry.device_key(device_path)
+    with _lock:
+        device = _load().get(key)
+    if device is None:
+        return None
+    return dict(device, summary=summarize(key, device))
@@ -0,0 +1,135 @@
+import os
+import stat
+import struct
+import sim_device
+
+# 範囲を指定するLinuxのブロックデバイス用ioctl（linux/fs.h）
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+# geometry() が返す項目
+GEOMETRY_FIELDS = ("size_bytes", "logical_sector_size", "physical_sector_size",
+                   "minimum_io_size", "optimal_io_size")
+
+
+class BlockDevice:
+    """ブロックデバイス（または通常ファイル）をオフセット指定で読み書きするハンドル"""
+
+    def __init__(self, path, writable=False, engine="buffered", truncate=False):
+        self.path = path
+        flags = os.O_WRONLY | os.O_CREAT if writable else os.O_RDONLY
+        if writable and truncate:
+            flags |= os.O_TRUNC
+        if engine == "direct":
+            flags |= os.O_DIRECT
+        elif engine == "dsync":
+            flags |= os.O_DSYNC
+        self.fd = os.open(path, flags, 0o644)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def pwrite(self, data, offset):
+        return os.pwrite(self.fd, data, offset)
+
+    def pread(self, length, offset):
+        return os.pread(self.fd, length, offset)
+
+    def preadinto(self, buffer, offset):
+        """bufferに直接読み込む（O_DIRECTではbufferのアドレスと長さを揃えておく）"""
+        return os.preadv(self.fd, [buffer], offset)
+
+    def fsync(self):
+        os.fsync(self.fd)
+
+    def discard(self, offset, length):
+        """範囲をデバイスに破棄させる（TRIM/UNMAP）。対応していなければOSError"""
+        self._range_ioctl(BLKDISCARD, offset, length)
+
+    def zeroout(self, offset, length):
+        """範囲をゼロにする（デバイスが対応していなければカーネルがゼロを書き込む）。Linux以外はOSError"""
+        self._range_ioctl(BLKZEROOUT, offset, length)
+
+    def _range_ioctl(self, request, offset, length):
+        import fcntl
+        fcntl.ioctl(self.fd, request, struct.pack("QQ", offset, length))
+
+    def drop_cache(self, offset=0, length=0):
+        """ページキャッシュを破棄し、次の読み込みがデバイスから行われるようにする"""
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(self.fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+    def disable_direct_io(self):
+        """O_DIRECTフラグを外す（末尾の半端な長さを書き込むため）"""
+        import fcntl
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+
+    def size(self):
+        return os.lseek(self.fd, 0, os.SEEK_END)
+
+    def present(self):
+        return os.path.exists(self.path)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def open_device(path, writable=False, engine="buffered", truncate=False):
+    """device_pathを開く。sim:// URIの場合は疑似デバイスを返す"""
+    if sim_device.is_simulated(path):
+        return sim_device.open_device(path, truncate=writable and truncate)
+    return BlockDevice(path, writable=writable, engine=engine, truncate=truncate)
+
+
+def _read_int(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def geometry(path):
+    """容量（バイト）・論理/物理セクタサイズ・最小/最適なI/Oサイズ（カーネルの値、分からないものはNone）
+
+    Linuxのブロックデバイスはsysfsから読むため、デバイスを開く権限がなくても取得できる。
+    通常ファイルは書き込むにつれて大きくなるため容量はNoneとする
+    """
+    if sim_device.is_simulated(path):
+        return sim_device.geometry(path)
+    result = dict.fromkeys(GEOMETRY_FIELDS)
+    try:
+        if not stat.S_ISBLK(os.stat(path).st_mode):
+            return result
+    except OSError:
+        return result
+    sysfs = f"/sys/class/block/{os.path.basename(os.path.realpath(path))}"
+    sectors = _read_int(f"{sysfs}/size")
+    # sysfsのsizeはカーネルの512バイト単位
+    result["size_bytes"] = sectors * 512 if sectors is not None else None
+    for field, name in (("logical_sector_size", "logical_block_size"),
+                        ("physical_sector_size", "physical_block_size"),
+                        ("minimum_io_size", "minimum_io_size"),
+                        ("optimal_io_size", "optimal_io_size")):
+        # 0は「報告なし」
+        result[field] = _read_int(f"{sysfs}/queue/{name}") or None
+    return result
+
+
+def open_uncached(path):
+    """ページキャッシュを経由せずに読むため、可能ならO_DIRECTで開く
+
+    (デバイス, O_DIRECTかどうか) を返す。O_DIRECTでない場合は読む前にdrop_cacheを呼ぶこと
+    """
+    if not sim_device.is_simulated(path) and hasattr(os, "O_DIRECT"):
+        try:
+            return BlockDevice(path, engine="direct"), True
+        except OSError:
+            pass
+    return open_device(path), False
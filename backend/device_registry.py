@@ -0,0 +1,188 @@
+"""書き込み済みのUSBメモリの記録（書き直しの省略用）
+
+書き込みに成功したら、デバイスのシリアルごとに書き込んだイメージのハッシュと、
+イメージ内の固定位置のいくつかの領域のハッシュ（フィンガープリント）を記録する。
+次に同じイメージを書き込むとき、デバイス上の同じ領域を読んでフィンガープリントが一致すれば、
+内容が残っているとみなして書き込みを省略できる。
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+import device_io
+import http_source
+import buffer_pool
+import image_cache
+import checksum_index
+import write_journal
+
+# 記録ファイルの保存先
+REGISTRY_PATH = os.environ.get(
+    "YAKERU_DEVICE_REGISTRY",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "device_registry.json")
+)
+# フィンガープリントに使う領域の数と大きさ（O_DIRECTで読めるよう4096の倍数）
+FINGERPRINT_REGIONS = 8
+FINGERPRINT_REGION_SIZE = 64 * 1024
+ALIGNMENT = 4096
+
+_lock = threading.Lock()
+
+
+def _load():
+    try:
+        with open(REGISTRY_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save(registry):
+    tmp_path = REGISTRY_PATH + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(registry, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, REGISTRY_PATH)
+
+
+def device_key(device_path):
+    """記録のキー（シリアルが取れればシリアル、なければデバイスパス）"""
+    from usb_detector import get_device_serial
+    import sim_device
+    serial = None if sim_device.is_simulated(device_path) else get_device_serial(device_path)
+    return write_journal.journal_key(device_path, serial), serial
+
+
+def fingerprint_regions(size):
+    """イメージのサイズから決まる固定の領域 [(offset, length), ...]（先頭・末尾と等間隔の位置）"""
+    if size <= 0:
+        return []
+    last = max(size - FINGERPRINT_REGION_SIZE, 0) // ALIGNMENT * ALIGNMENT
+    offsets = sorted({last * i // (FINGERPRINT_REGIONS - 1) // ALIGNMENT * ALIGNMENT
+                      for i in range(FINGERPRINT_REGIONS)})
+    return [(offset, min(FINGERPRINT_REGION_SIZE, size - offset)) for offset in offsets]
+
+
+def _digest(read_at, regions):
+    digest = hashlib.sha256()
+    for offset, length in regions:
+        digest.update(read_at(offset, length))
+    return digest.hexdigest()
+
+
+def image_fingerprint(iso_path):
+    """イメージの識別情報とフィンガープリントを計算する"""
+    if http_source.is_url(iso_path):
+        size = http_source.probe(iso_path)["size"]
+        regions = fingerprint_regions(size)
+        fingerprint = _digest(lambda offset, length: http_source.read_range(iso_path, offset, length),
+                              regions)
+        sha256 = None
+    else:
+        with image_cache.peek_image(iso_path) as image:
+            size = image.size
+            regions = fingerprint_regions(size)
+
+            def read_at(offset, length):
+                image.seek(offset)
+                return bytes(image.read(length))
+
+            fingerprint = _digest(read_at, regions)
+        checksums = checksum_index.lookup(os.path.dirname(iso_path), os.path.basename(iso_path)) or {}
+        sha256 = checksums.get("sha256")
+    return {
+        "name": os.path.basename(iso_path),
+        "size": size,
+        "sha256": sha256,
+        "regions": regions,
+        "fingerprint": fingerprint,
+    }
+
+
+def device_fingerprint(device_path, regions):
+    """デバイス上の同じ領域のフィンガープリント（ページキャッシュを経由せずに読む）"""
+    buffer = buffer_pool.get_pool().acquire(FINGERPRINT_REGION_SIZE)
+    device, direct = device_io.open_uncached(device_path)
+    try:
+        view = buffer.view[:FINGERPRINT_REGION_SIZE]
+
+        def read_at(offset, length):
+            if not direct:
+                device.drop_cache(offset, length)
+            # O_DIRECTでは長さも揃える必要があるため、領域全体を読んでから切り出す
+            return bytes(view[:device.preadinto(view, offset)][:length])
+
+        return _digest(read_at, regions)
+    finally:
+        device.close()
+        buffer.release()
+
+
+def record(iso_path, device_path, image=None):
+    """書き込みに成功したデバイスを記録する"""
+    key, serial = device_key(device_path)
+    image = image or image_fingerprint(iso_path)
+    with _lock:
+        registry = _load()
+        registry[key] = {
+            "serial": serial,
+            "device": device_path,
+            "image": image,
+            "written_at": time.time(),
+        }
+        _save(registry)
+
+
+def list_entries():
+    with _lock:
+        return _load()
+
+
+def forget(device_path):
+    key, _ = device_key(device_path)
+    with _lock:
+        registry = _load()
+        if registry.pop(key, None) is not None:
+            _save(registry)
+
+
+def check(iso_path, device_path):
+    """デバイスがすでにこのイメージを保持しているか確認する
+
+    戻り値の "current" がTrueなら書き込みを省略できる。"reason" に判定の理由を入れる
+    """
+    started = time.monotonic()
+    key, serial = device_key(device_path)
+    result = {"current": False, "serial": serial, "reason": None, "entry": None}
+    with _lock:
+        entry = _load().get(key)
+    if entry is None:
+        result["reason"] = "no record for this device"
+        return _finish(result, started)
+    result["entry"] = entry
+
+    recorded = entry["image"]
+    image = image_fingerprint(iso_path)
+    if recorded["size"] != image["size"] or recorded["fingerprint"] != image["fingerprint"] \
+            or (recorded.get("sha256") and image["sha256"] and recorded["sha256"] != image["sha256"]):
+        result["reason"] = f"device was last written with {recorded['name']}"
+        return _finish(result, started)
+
+    try:
+        on_device = device_fingerprint(device_path, [tuple(region) for region in recorded["regions"]])
+    except OSError as e:
+        result["reason"] = f"could not read device: {e}"
+        return _finish(result, started)
+    if on_device != recorded["fingerprint"]:
+        result["reason"] = "device content has changed since it was written"
+        return _finish(result, started)
+    result["current"] = True
+    result["reason"] = f"device already holds {image['name']}"
+    return _finish(result, started)
+
+
+def _finish(result, started):
+    result["seconds"] = round(time.monotonic() - started, 4)
+    return result
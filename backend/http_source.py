@@ -0,0 +1,344 @@
+"""HTTP(S) のURLから直接ISOイメージを読み込む書き込み元
+
+バックグラウンドのスレッドが先読みバッファ（キュー）を埋め、書き込みループはそこから読む。
+ネットワークの揺らぎはバッファが吸収し、接続が切れた場合はRangeヘッダーで続きから取り直す。
+cache_pathを指定すると、受信したデータを同時にファイルに保存し、完了時に原子的に登録する。
+"""
+import os
+import queue
+import hashlib
+import threading
+from urllib.parse import urlparse, unquote
+from write_retry import RetryPolicy
+import checksum_index
+import image_store
+from log_pipeline import log
+
+MB = 1024 * 1024
+
+# 先読みバッファのサイズ
+READAHEAD_SIZE = int(os.environ.get("YAKERU_HTTP_READAHEAD_MB", "64")) * MB
+# ソケットから一度に読む単位
+CHUNK_SIZE = MB
+# 接続・読み込みのタイムアウト（秒）
+TIMEOUT = float(os.environ.get("YAKERU_HTTP_TIMEOUT", "30"))
+# 接続が切れた場合に続きから取り直す回数（データが届くたびにリセット）
+MAX_RECONNECTS = int(os.environ.get("YAKERU_HTTP_RETRY_MAX", "10"))
+
+_EOF = object()
+
+
+def is_url(path):
+    return isinstance(path, str) and path.startswith(("http://", "https://"))
+
+
+def _open(url, start=None, end=None, method="GET"):
+    # http.clientとurllib.requestは読み込みに時間がかかるため、URLを開くときに読み込む
+    import urllib.request
+    request = urllib.request.Request(url, method=method, headers={"User-Agent": "Yakeru-USB"})
+    if start is not None:
+        request.add_header("Range", f"bytes={start}-{'' if end is None else end}")
+    return urllib.request.urlopen(request, timeout=TIMEOUT)
+
+
+def probe(url):
+    """サイズ・Range対応・ETagなどを取得する"""
+    import urllib.error
+    try:
+        with _open(url, method="HEAD") as response:
+            headers = response.headers
+            size = headers.get("Content-Length")
+    except urllib.error.HTTPError as e:
+        if e.code not in (403, 405, 501):
+            raise
+        # HEADに対応していないサーバーでは先頭1バイトだけ取得する
+        with _open(url, start=0, end=0) as response:
+            headers = response.headers
+            content_range = headers.get("Content-Range", "")
+            size = content_range.rsplit("/", 1)[-1] if "/" in content_range else headers.get("Content-Length")
+    if size is None or not str(size).isdigit():
+        raise OSError(f"Could not determine the size of {url}")
+    return {
+        "size": int(size),
+        "accept_ranges": headers.get("Accept-Ranges", "").lower() == "bytes",
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+    }
+
+
+def identity(url):
+    """再開用ジャーナルに記録するイメージの識別情報"""
+    info = probe(url)
+    return {
+        "name": url,
+        "size": info["size"],
+        "etag": info["etag"],
+        "last_modified": info["last_modified"],
+    }
+
+
+def read_range(url, offset, length):
+    """offsetからlengthバイトを1回のリクエストで読む（書き込み済み領域の照合用）"""
+    if length <= 0:
+        return b""
+    with _open(url, start=offset, end=offset + length - 1) as response:
+        if response.status == 200:
+            # Rangeに対応していないサーバーは先頭から返すため読み飛ばす
+            _discard(response, offset)
+        return response.read(length)
+
+
+def _discard(response, length):
+    while length > 0:
+        data = response.read(min(CHUNK_SIZE, length))
+        if not data:
+            raise OSError("Connection closed while skipping to the requested offset")
+        length -= len(data)
+
+
+def cache_filename(url):
+    """URLから保存先のファイル名を決める"""
+    name = os.path.basename(unquote(urlparse(url).path)) or "download.iso"
+    if not name.lower().endswith(".iso"):
+        name += ".iso"
+    return name
+
+
+def cached_copy(url, cache_dir):
+    """以前の書き込みで保存した同じイメージがあればそのパスを返す"""
+    name = cache_filename(url)
+    entry = checksum_index.lookup(cache_dir, name)
+    if not entry or entry.get("source_url") != url:
+        return None
+    try:
+        info = probe(url)
+    except OSError:
+        return None
+    path = os.path.join(cache_dir, name)
+    if os.path.getsize(path) != info["size"]:
+        return None
+    if info["etag"] and entry.get("etag") and info["etag"] != entry["etag"]:
+        return None
+    return path
+
+
+def _is_fatal(error):
+    """再接続しても意味のないエラー（404など）か"""
+    import urllib.error
+    return isinstance(error, urllib.error.HTTPError) and 400 <= error.code < 500 \
+        and error.code not in (408, 429)
+
+
+class HttpImageSource:
+    """URLからイメージを先読みしながら読み込む（image_cacheのソースと同じインターフェース）"""
+    zero_copy = False
+
+    def __init__(self, url, cache_dir=None, readahead=READAHEAD_SIZE):
+        self.path = url
+        self.url = url
+        info = probe(url)
+        self.size = info["size"]
+        self.etag = info["etag"]
+        self.cache_dir = cache_dir
+        self.readahead = readahead
+        self.reconnects = 0
+        self._position = 0
+        self._thread = None
+        self._stop = threading.Event()
+        self._queue = None
+        self._pending = memoryview(b"")
+        self._eof = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def seek(self, offset):
+        self._stop_reader()
+        self._position = offset
+        self._pending = memoryview(b"")
+        self._eof = offset >= self.size
+
+    def read(self, size):
+        buffer = bytearray(size)
+        count = self.readinto(buffer)
+        return bytes(memoryview(buffer)[:count])
+
+    def readinto(self, buffer):
+        """バッファが一杯になるか末尾に達するまで読む（ブロック境界を保つため）"""
+        view = memoryview(buffer).cast("B")
+        filled = 0
+        while filled < len(view):
+            if not self._pending:
+                if self._eof:
+                    break
+                chunk = self._next_chunk()
+                if chunk is None:
+                    break
+                self._pending = memoryview(chunk)
+            count = min(len(self._pending), len(view) - filled)
+            view[filled:filled + count] = self._pending[:count]
+            self._pending = self._pending[count:]
+            filled += count
+        self._position += filled
+        return filled
+
+    def close(self):
+        self._stop_reader()
+
+    # ---- 先読みスレッド ----
+
+    def _next_chunk(self):
+        if self._thread is None:
+            self._queue = queue.Queue(maxsize=max(self.readahead // CHUNK_SIZE, 1))
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._fill, args=(self._position,), daemon=True)
+            self._thread.start()
+        item = self._queue.get()
+        if item is _EOF:
+            self._eof = True
+            return None
+        if isinstance(item, Exception):
+            self._eof = True
+            raise item
+        return item
+
+    def _stop_reader(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        # キューが一杯で止まっているスレッドを起こす
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread = None
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fill(self, offset):
+        import http.client
+        cache = _CacheWriter(self.url, self.cache_dir, self.size, self.etag) \
+            if self.cache_dir and offset == 0 else None
+        policy = RetryPolicy(max_retries=MAX_RECONNECTS)
+        attempt = 0
+        try:
+            while offset < self.size and not self._stop.is_set():
+                try:
+                    with _open(self.url, start=offset if offset else None) as response:
+                        skip = offset if offset and response.status == 200 else 0
+                        if skip:
+                            _discard(response, skip)
+                        while offset < self.size and not self._stop.is_set():
+                            data = response.read(min(CHUNK_SIZE, self.size - offset))
+                            if not data:
+                                raise OSError(f"Connection closed at offset {offset}")
+                            if cache:
+                                cache.write(data)
+                            if not self._put(data):
+                                return
+                            offset += len(data)
+                            attempt = 0
+                except (OSError, http.client.HTTPException) as e:
+                    if self._stop.is_set():
+                        return
+                    attempt += 1
+                    if _is_fatal(e) or attempt > policy.max_retries:
+                        raise OSError(f"Failed to download {self.url} at offset {offset}: {e}") from e
+                    delay = policy.delay(attempt)
+                    self.reconnects += 1
+                    log("http", f"Connection lost at offset {offset} ({e}); "
+                        f"reconnecting in {delay:.1f}s", level="warning", url=self.url, offset=offset)
+                    self._stop.wait(delay)
+            if offset >= self.size:
+                if cache:
+                    cache.commit()
+                    cache = None
+                self._put(_EOF)
+        except Exception as e:
+            self._put(e)
+        finally:
+            if cache:
+                cache.discard()
+
+
+class _CacheWriter:
+    """受信したデータをISO_DIRに保存し、全て届いたら登録する"""
+
+    def __init__(self, url, cache_dir, size, etag):
+        self.url = url
+        self.cache_dir = cache_dir
+        self.size = size
+        self.etag = etag
+        self.name = cache_filename(url)
+        self.final_path = os.path.join(cache_dir, self.name)
+        # ISO一覧に表示されないよう、完了まではドットで始まる名前にする
+        self.part_path = os.path.join(cache_dir, f".{self.name}.download")
+        self.digest = hashlib.sha256()
+        self.written = 0
+        self.file = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.file = open(self.part_path, 'wb')
+        except OSError as e:
+            log("http", f"Cannot cache {url}: {e}", level="warning", url=url)
+
+    def write(self, data):
+        if self.file is None:
+            return
+        try:
+            self.file.write(data)
+            self.digest.update(data)
+            self.written += len(data)
+        except OSError as e:
+            log("http", f"Caching {self.url} failed: {e}", level="warning", url=self.url)
+            self.discard()
+
+    def commit(self):
+        if self.file is None:
+            return
+        if self.written != self.size:
+            self.discard()
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        try:
+            # 同名のファイルがあれば上書きしない
+            os.link(self.part_path, self.final_path)
+        except OSError as e:
+            log("http", f"Cannot register cached image {self.final_path}: {e}", level="warning")
+        else:
+            checksum_index.record(self.cache_dir, self.name, {
+                "sha256": self.digest.hexdigest(),
+                "source_url": self.url,
+                "etag": self.etag,
+            })
+            log("http", f"Cached {self.url} as {self.final_path}", url=self.url)
+            if image_store.ENABLED:
+                try:
+                    image_store.add(self.cache_dir, self.name, self.digest.hexdigest())
+                except OSError as e:
+                    log("http", f"Failed to add {self.name} to the image store: {e}", level="warning")
+        self.discard()
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        try:
+            os.unlink(self.part_path)
+        except FileNotFoundError:
+            pass
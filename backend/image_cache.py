@@ -0,0 +1,339 @@
+import os
+import mmap
+import time
+import threading
+from collections import OrderedDict
+from buffer_pool import buffer_address
+import http_source
+from log_pipeline import log
+
+MB = 1024 * 1024
+
+# メモリに保持するイメージの合計サイズの上限
+CACHE_BUDGET = int(os.environ.get("YAKERU_IMAGE_CACHE_BUDGET_MB", "4096")) * MB
+# mlockでRAMに固定するか（CAP_IPC_LOCKまたは十分なRLIMIT_MEMLOCKが必要）
+CACHE_MLOCK = os.environ.get("YAKERU_IMAGE_CACHE_MLOCK", "0") == "1"
+# この期間内にこの回数以上書き込まれたイメージを「ホット」とみなす
+HOT_THRESHOLD = int(os.environ.get("YAKERU_IMAGE_CACHE_HOT_THRESHOLD", "2"))
+HOT_WINDOW = float(os.environ.get("YAKERU_IMAGE_CACHE_HOT_WINDOW", "3600"))
+# ストリーミング読み込みでページキャッシュを破棄する間隔
+DONTNEED_INTERVAL = 64 * MB
+
+
+def _image_key(path):
+    """同じファイルを別名で参照しても同じキーになるよう、inodeで識別する"""
+    stat = os.stat(path)
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _fadvise(fd, offset, length, advice_name):
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice_name))
+        except OSError:
+            pass
+
+
+_libc = None
+
+
+def _mlock(obj, length, lock=True):
+    """バッファをRAMに固定（または解除）する。成功した場合はTrue"""
+    global _libc
+    try:
+        import ctypes
+        import ctypes.util
+        if _libc is None:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        address = buffer_address(obj)
+        if address is None:
+            return False
+        func = _libc.mlock if lock else _libc.munlock
+        func.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        return func(ctypes.c_void_p(address), ctypes.c_size_t(length)) == 0
+    except Exception:
+        return False
+
+
+class FileImageSource:
+    """通常の読み込み。読み終えた範囲はページキャッシュから破棄する（一度きりのジョブ向け）"""
+    zero_copy = False
+
+    def __init__(self, path, drop_cache=True):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.drop_cache = drop_cache
+        self._dropped_until = 0
+        _fadvise(self.file.fileno(), 0, 0, "POSIX_FADV_SEQUENTIAL")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def seek(self, offset):
+        self.file.seek(offset)
+        self._dropped_until = offset
+
+    def read(self, size):
+        data = self.file.read(size)
+        self._maybe_drop()
+        return data
+
+    def readinto(self, buffer):
+        count = self.file.readinto(buffer)
+        self._maybe_drop()
+        return count
+
+    def _maybe_drop(self):
+        if not self.drop_cache:
+            return
+        position = self.file.tell()
+        if position - self._dropped_until >= DONTNEED_INTERVAL:
+            _fadvise(self.file.fileno(), self._dropped_until, position - self._dropped_until,
+                     "POSIX_FADV_DONTNEED")
+            self._dropped_until = position
+
+    def close(self):
+        if self.file is not None:
+            if self.drop_cache:
+                _fadvise(self.file.fileno(), 0, 0, "POSIX_FADV_DONTNEED")
+            self.file.close()
+            self.file = None
+
+
+class _MappedImage:
+    """メモリマップされたイメージ（キャッシュのエントリ）"""
+
+    def __init__(self, path, key, lock):
+        self.path = path
+        self.key = key
+        self.size = key[2]
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        self.refcount = 0
+        self.loaded_at = time.time()
+        self.last_used = time.time()
+        self.hits = 0
+        # カーネルに先読みを依頼（非同期）
+        if hasattr(mmap, "MADV_WILLNEED"):
+            self.mmap.madvise(mmap.MADV_WILLNEED)
+        self.locked = _mlock(self.mmap, self.size) if lock else False
+        if lock and not self.locked:
+            log("cache", f"Failed to lock {path} in memory (check RLIMIT_MEMLOCK)", level="warning")
+
+    def close(self):
+        if self.locked:
+            _mlock(self.mmap, self.size, lock=False)
+            self.locked = False
+        try:
+            self.view.release()
+            self.mmap.close()
+        except BufferError:
+            # まだ書き込み中のビューが残っている場合はGCに任せる
+            pass
+        # キャッシュから外したイメージはページキャッシュからも破棄する
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                _fadvise(fd, 0, 0, "POSIX_FADV_DONTNEED")
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+
+class MappedImageSource:
+    """キャッシュされたイメージから、コピーせずにmemoryviewで読み出す"""
+    zero_copy = True
+
+    def __init__(self, cache, entry):
+        self._cache = cache
+        self._entry = entry
+        self.path = entry.path
+        self.size = entry.size
+        self._position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def seek(self, offset):
+        self._position = offset
+
+    def read(self, size):
+        start = self._position
+        end = min(start + size, self.size)
+        self._position = end
+        return self._entry.view[start:end]
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self._entry is not None:
+            self._cache._release(self._entry)
+            self._entry = None
+
+
+class ImageCache:
+    """繰り返し書き込まれるイメージをメモリに保持するLRUキャッシュ"""
+
+    def __init__(self, budget=CACHE_BUDGET, lock=CACHE_MLOCK,
+                 hot_threshold=HOT_THRESHOLD, hot_window=HOT_WINDOW):
+        self.budget = budget
+        self.lock_pages = lock
+        self.hot_threshold = hot_threshold
+        self.hot_window = hot_window
+        self._entries = OrderedDict()   # key -> _MappedImage（末尾が最近使われたもの）
+        self._uses = {}                 # key -> 書き込みに使われた時刻のリスト
+        self._pinned = set()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "streamed": 0}
+
+    def open(self, path):
+        """書き込み用にイメージを開く。ホットなイメージはメモリから、それ以外はファイルから読む"""
+        key = _image_key(path)
+        with self._lock:
+            now = time.time()
+            uses = [t for t in self._uses.get(key, []) if now - t < self.hot_window]
+            uses.append(now)
+            self._uses[key] = uses
+
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return self._acquire(entry)
+
+            hot = key in self._pinned or len(uses) >= self.hot_threshold
+            if hot and self.budget > 0 and key[2] <= self.budget and self._make_room(key[2]):
+                try:
+                    entry = _MappedImage(path, key, self.lock_pages)
+                except (OSError, ValueError) as e:
+                    log("cache", f"Failed to map {path}: {e}", level="warning")
+                else:
+                    self._entries[key] = entry
+                    self.stats["misses"] += 1
+                    log("cache", f"Image cached in memory: {os.path.basename(path)} "
+                        f"({key[2] // MB} MB, locked={entry.locked})")
+                    return self._acquire(entry)
+            self.stats["streamed"] += 1
+
+        # 一度きりのイメージはページキャッシュを汚さないように読む
+        return FileImageSource(path, drop_cache=not hot)
+
+    def peek(self, path):
+        """照合やフィンガープリントのために開く
+
+        書き込み回数には数えず、新しくメモリにも載せない。すでにキャッシュされていればそれを使う
+        """
+        key = _image_key(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.refcount += 1
+                return MappedImageSource(self, entry)
+        # 部分的に読むだけなので、他の書き込みが使っているページキャッシュは破棄しない
+        return FileImageSource(path, drop_cache=False)
+
+    def _acquire(self, entry):
+        entry.refcount += 1
+        entry.hits += 1
+        entry.last_used = time.time()
+        return MappedImageSource(self, entry)
+
+    def _release(self, entry):
+        with self._lock:
+            entry.refcount -= 1
+            if entry.key not in self._entries and entry.refcount == 0:
+                entry.close()
+
+    def _used_bytes(self):
+        return sum(entry.size for entry in self._entries.values())
+
+    def _make_room(self, size):
+        """予算内に収まるよう、使われていない古いイメージから追い出す（ロック保持中に呼ぶ）"""
+        used = self._used_bytes()
+        for key in list(self._entries):
+            if used + size <= self.budget:
+                break
+            entry = self._entries[key]
+            if entry.refcount > 0 or key in self._pinned:
+                continue
+            del self._entries[key]
+            entry.close()
+            used -= entry.size
+            self.stats["evictions"] += 1
+            log("cache", f"Image evicted from memory: {os.path.basename(entry.path)}")
+        return used + size <= self.budget
+
+    def pin(self, path):
+        """イメージを常にメモリに保持する（次回の書き込みからキャッシュされる）"""
+        key = _image_key(path)
+        with self._lock:
+            self._pinned.add(key)
+            if key not in self._entries and key[2] <= self.budget and self._make_room(key[2]):
+                self._entries[key] = _MappedImage(path, key, self.lock_pages)
+
+    def unpin(self, path):
+        key = _image_key(path)
+        with self._lock:
+            self._pinned.discard(key)
+            entry = self._entries.get(key)
+            if entry is not None and entry.refcount == 0:
+                del self._entries[key]
+                entry.close()
+
+    def status(self):
+        with self._lock:
+            return {
+                "budget_bytes": self.budget,
+                "used_bytes": self._used_bytes(),
+                "mlock": self.lock_pages,
+                "hot_threshold": self.hot_threshold,
+                "stats": dict(self.stats),
+                "images": [{
+                    "path": entry.path,
+                    "size": entry.size,
+                    "locked": entry.locked,
+                    "pinned": key in self._pinned,
+                    "in_use": entry.refcount,
+                    "hits": entry.hits,
+                    "last_used": entry.last_used,
+                } for key, entry in self._entries.items()],
+            }
+
+
+# プロセス全体で共有するキャッシュ
+_cache = ImageCache()
+
+
+def get_cache():
+    return _cache
+
+
+def open_image(path, cache_dir=None):
+    """書き込み用にISOイメージを開く
+
+    URLの場合はHTTPで先読みしながら読み込み、cache_dirを指定すると同時にそこへ保存する
+    """
+    if http_source.is_url(path):
+        return http_source.HttpImageSource(path, cache_dir=cache_dir)
+    return _cache.open(path)
+
+
+def peek_image(path):
+    """照合やフィンガープリントのためにISOイメージを開く（ホットなイメージの判定に数えない）"""
+    if http_source.is_url(path):
+        return http_source.HttpImageSource(path)
+    return _cache.peek(path)
@@ -0,0 +1,224 @@
+"""ISOイメージの内容アドレス型ストア（重複排除）
+
+YAKERU_CAS=1 の場合、ISO_DIR内のイメージは .store/sha256/<先頭2文字>/<ハッシュ>.iso に1つだけ保存し、
+ISO_DIR直下の名前はそこへのハードリンク（別のファイルシステムではreflink）にする。
+同じinodeを共有するため、イメージキャッシュとチェックサム索引も別名間で共有される。
+reflinkではリンク数で参照を数えられないため、各名前のチェックサム索引に記録したsha256と
+共有方法（store_link）からストアのイメージへの参照を判定する。
+"""
+import os
+import errno
+import hashlib
+import threading
+import checksum_index
+from log_pipeline import log
+
+ENABLED = os.environ.get("YAKERU_CAS", "0") == "1"
+# ISO_DIR内のストアの場所（ISO一覧には表示されない）
+STORE_DIR_NAME = ".store"
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+_lock = threading.Lock()
+
+
+def _object_relpath(sha256):
+    return os.path.join(STORE_DIR_NAME, "sha256", sha256[:2], f"{sha256}.iso")
+
+
+def object_path(iso_dir, sha256):
+    return os.path.join(iso_dir, _object_relpath(sha256))
+
+
+def has_object(iso_dir, sha256):
+    return bool(sha256) and os.path.exists(object_path(iso_dir, sha256.lower()))
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(HASH_CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _clone(src, dst):
+    """reflink（FICLONE）でデータを共有するコピーを作る。対応していなければOSError"""
+    import fcntl
+    FICLONE = 0x40049409
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        except OSError:
+            os.close(dst_fd)
+            dst_fd = None
+            os.unlink(dst)
+            raise
+        finally:
+            if dst_fd is not None:
+                os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _share(src, dst):
+    """dstをsrcと同じ内容を共有するファイルとして作る（ハードリンク、だめならreflink）"""
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    _clone(src, dst)
+    return "reflink"
+
+
+def _replace_with(src, dst):
+    """既存のdstを、srcを共有するファイルに原子的に置き換える"""
+    tmp = f"{dst}.dedupe-tmp"
+    try:
+        os.unlink(tmp)
+    except FileNotFoundError:
+        pass
+    method = _share(src, tmp)
+    os.replace(tmp, dst)
+    return method
+
+
+def add(iso_dir, filename, sha256=None):
+    """ISO_DIR内のファイルをストアに登録する。同じ内容が既にあればそれを共有させる
+
+    戻り値は "stored"（新規）、"linked"（既存の内容と共有）、"unchanged"（登録済み）
+    """
+    path = os.path.join(iso_dir, filename)
+    checksums = checksum_index.lookup(iso_dir, filename) or {}
+    if sha256 is None:
+        sha256 = checksums.get("sha256") or file_sha256(path)
+    sha256 = sha256.lower()
+    # 以前にreflinkでストアと共有させ、その後変更されていない名前（別のinodeなのでsamefileでは分からない）
+    reflinked = checksums.get("sha256") == sha256 and checksums.get("store_link") == "reflink"
+    checksums["sha256"] = sha256
+    target = object_path(iso_dir, sha256)
+
+    with _lock:
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            checksums["store_link"] = _share(path, target)
+            checksum_index.record(iso_dir, _object_relpath(sha256), checksums)
+            result = "stored"
+        elif reflinked:
+            result = "unchanged"
+        elif os.path.samefile(path, target):
+            checksums["store_link"] = "hardlink"
+            result = "unchanged"
+        else:
+            checksums["store_link"] = _replace_with(target, path)
+            result = "linked"
+        checksum_index.record(iso_dir, filename, checksums)
+    if result != "unchanged":
+        log("store", f"{filename} -> {sha256[:12]} ({result})")
+    return result
+
+
+def link(iso_dir, filename, sha256):
+    """ストアにある内容に新しい名前を付ける（同じイメージの再登録はデータを転送しない）"""
+    sha256 = sha256.lower()
+    path = os.path.join(iso_dir, filename)
+    with _lock:
+        method = _share(object_path(iso_dir, sha256), path)
+        checksum_index.record(iso_dir, filename, {"sha256": sha256, "store_link": method})
+    log("store", f"{filename} -> {sha256[:12]} (linked)")
+
+
+def dedupe(iso_dir):
+    """ISO_DIR内の全イメージをストアに登録し、重複を共有させる"""
+    results = {"stored": 0, "linked": 0, "unchanged": 0, "errors": []}
+    for name in sorted(os.listdir(iso_dir)):
+        if not name.lower().endswith(".iso") or not os.path.isfile(os.path.join(iso_dir, name)):
+            continue
+        try:
+            results[add(iso_dir, name)] += 1
+        except OSError as e:
+            results["errors"].append({"name": name, "error": str(e)})
+    results.update(status(iso_dir))
+    return results
+
+
+def _names(iso_dir):
+    """ISO_DIR直下のイメージの名前と、変更されていなければそのチェックサム（名前 -> (stat, エントリ)）"""
+    if not os.path.isdir(iso_dir):
+        return {}
+    index = checksum_index.load(iso_dir)
+    names = {}
+    for name in os.listdir(iso_dir):
+        path = os.path.join(iso_dir, name)
+        if name.lower().endswith(".iso") and os.path.isfile(path):
+            names[name] = (os.stat(path), checksum_index.lookup(iso_dir, name, index) or {})
+    return names
+
+
+def references(iso_dir):
+    """ストアのイメージごとに、同じ内容を持つ名前の一覧（sha256 -> 名前のリスト）"""
+    refs = {}
+    for name, (_, entry) in sorted(_names(iso_dir).items()):
+        if entry.get("sha256"):
+            refs.setdefault(entry["sha256"], []).append(name)
+    return refs
+
+
+def gc(iso_dir):
+    """どの名前からも参照されなくなったストアのイメージを削除する
+
+    ハードリンクされていても、索引上で同じ内容を持つ名前があっても参照されているとみなす
+    （reflinkした名前はリンク数に現れないため、索引の記録で判定する）
+    """
+    removed = 0
+    root = os.path.join(iso_dir, STORE_DIR_NAME, "sha256")
+    if not os.path.isdir(root):
+        return removed
+    with _lock:
+        referenced = references(iso_dir)
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                sha256 = name[:-len(".iso")]
+                if os.stat(path).st_nlink == 1 and sha256 not in referenced:
+                    os.unlink(path)
+                    checksum_index.remove(iso_dir, os.path.relpath(path, iso_dir))
+                    removed += 1
+    return removed
+
+
+def status(iso_dir):
+    """ストアのイメージ数と重複排除で節約した容量"""
+    root = os.path.join(iso_dir, STORE_DIR_NAME, "sha256")
+    objects = set()
+    stored_bytes = 0
+    if os.path.isdir(root):
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                objects.add(name[:-len(".iso")])
+                stored_bytes += os.path.getsize(os.path.join(dirpath, name))
+    named_bytes = 0
+    names = _names(iso_dir)
+    seen = set()
+    physical_bytes = stored_bytes
+    for stat, entry in names.values():
+        named_bytes += stat.st_size
+        shared = stat.st_nlink > 1 or (entry.get("store_link") == "reflink"
+                                       and entry.get("sha256") in objects)
+        if not shared and (stat.st_dev, stat.st_ino) not in seen:
+            # ストアに登録されていないファイル
+            physical_bytes += stat.st_size
+        seen.add((stat.st_dev, stat.st_ino))
+    return {
+        "enabled": ENABLED,
+        "objects": len(objects),
+        "names": len(names),
+        "stored_bytes": stored_bytes,
+        "saved_bytes": max(named_bytes - physical_bytes, 0),
+    }
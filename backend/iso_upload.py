@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+from werkzeug.utils import secure_filename
+import checksum_index
+import image_store
+from log_pipeline import log
+
+# リクエストボディを読み込む単位
+UPLOAD_CHUNK_SIZE = int(os.environ.get("YAKERU_UPLOAD_CHUNK_MB", "4")) * 1024 * 1024
+# アップロード中のファイルを置くISO_DIR内のディレクトリ（ISO一覧には表示されない）
+UPLOAD_DIR_NAME = ".uploads"
+
+
+class UploadError(Exception):
+    """アップロードの失敗（HTTPステータスコード付き）"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+# アップロードIDごとのハッシュ計算の途中状態（同じプロセス内での再開時に先頭から読み直さないため）
+_hashers = {}
+# 同じアップロードへの同時書き込みを防ぐ
+_active = set()
+_lock = threading.Lock()
+
+
+def _upload_dir(iso_dir):
+    return os.path.join(iso_dir, UPLOAD_DIR_NAME)
+
+
+def _paths(iso_dir, upload_id):
+    if not upload_id.isalnum():
+        raise UploadError("Invalid upload id", 404)
+    base = os.path.join(_upload_dir(iso_dir), upload_id)
+    return base + ".json", base + ".part"
+
+
+def _load_session(iso_dir, upload_id):
+    session_path, part_path = _paths(iso_dir, upload_id)
+    try:
+        with open(session_path, 'r') as f:
+            session = json.load(f)
+    except (OSError, ValueError):
+        raise UploadError(f"Upload {upload_id} not found", 404)
+    try:
+        session["offset"] = os.path.getsize(part_path)
+    except OSError:
+        session["offset"] = 0
+    return session
+
+
+def create_upload(iso_dir, filename, size=None, sha256=None):
+    """アップロードを開始し、セッション情報を返す"""
+    name = secure_filename(filename or "")
+    if not name.lower().endswith(".iso"):
+        raise UploadError("Only .iso files can be uploaded")
+    if os.path.exists(os.path.join(iso_dir, name)):
+        raise UploadError(f"ISO file {name} already exists", 409)
+    if size is not None and int(size) < 0:
+        raise UploadError("Invalid size")
+
+    # 同じ内容がストアにあれば、データを受け取らずに名前だけ登録する
+    if image_store.ENABLED and sha256 and image_store.has_object(iso_dir, sha256):
+        stored_size = os.path.getsize(image_store.object_path(iso_dir, sha256.lower()))
+        if size is None or int(size) == stored_size:
+            image_store.link(iso_dir, name, sha256)
+            return {"id": None, "filename": name, "size": stored_size, "offset": stored_size,
+                    "sha256": sha256.lower(), "completed": True, "deduplicated": True}
+
+    upload_id = uuid.uuid4().hex
+    session = {
+        "id": upload_id,
+        "filename": name,
+        "size": int(size) if size is not None else None,
+        "expected_sha256": sha256.lower() if sha256 else None,
+        "created_at": time.time(),
+    }
+    os.makedirs(_upload_dir(iso_dir), exist_ok=True)
+    session_path, part_path = _paths(iso_dir, upload_id)
+    with open(session_path, 'w') as f:
+        json.dump(session, f)
+    open(part_path, 'wb').close()
+    session["offset"] = 0
+    return session
+
+
+def get_upload(iso_dir, upload_id):
+    """アップロードの状態（再開位置を含む）を返す"""
+    return _load_session(iso_dir, upload_id)
+
+
+def list_uploads(iso_dir):
+    """未完了のアップロード一覧"""
+    upload_dir = _upload_dir(iso_dir)
+    if not os.path.isdir(upload_dir):
+        return []
+    uploads = []
+    for name in sorted(os.listdir(upload_dir)):
+        if name.endswith(".json"):
+            try:
+                uploads.append(_load_session(iso_dir, name[:-len(".json")]))
+            except UploadError:
+                pass
+    return uploads
+
+
+def _hash_state(upload_id, part_path, offset):
+    """offsetまでのハッシュ状態を返す。保持していなければ書き込み済み部分を読み直す"""
+    state = _hashers.get(upload_id)
+    if state is not None and state["offset"] == offset:
+        return state
+    state = {"offset": 0, "sha256": hashlib.sha256(), "md5": hashlib.md5()}
+    with open(part_path, 'rb') as f:
+        while state["offset"] < offset:
+            data = f.read(min(UPLOAD_CHUNK_SIZE, offset - state["offset"]))
+            if not data:
+                break
+            state["sha256"].update(data)
+            state["md5"].update(data)
+            state["offset"] += len(data)
+    _hashers[upload_id] = state
+    return state
+
+
+def write_chunk(iso_dir, upload_id, stream, offset=None):
+    """リクエストボディをoffsetから書き込み、同じ読み込みでハッシュも計算する
+
+    offsetを省略した場合は書き込み済みの末尾に追記する。
+    サイズが指定されたアップロードは、最後まで届いた時点で登録まで行う。
+    """
+    session = _load_session(iso_dir, upload_id)
+    session_path, part_path = _paths(iso_dir, upload_id)
+    current = session["offset"]
+    if offset is None:
+        offset = current
+    if offset != current:
+        raise UploadError(f"Upload offset mismatch (expected {current})", 409, offset=current)
+
+    with _lock:
+        if upload_id in _active:
+            raise UploadError("Upload already in progress", 409, offset=current)
+        _active.add(upload_id)
+    try:
+        state = _hash_state(upload_id, part_path, offset)
+        size = session["size"]
+        with open(part_path, 'r+b') as f:
+            f.seek(offset)
+            while True:
+                data = stream.read(UPLOAD_CHUNK_SIZE)
+                if not data:
+                    break
+                if size is not None and state["offset"] + len(data) > size:
+                    raise UploadError(f"Upload exceeds declared size {size}", 413,
+                                      offset=state["offset"])
+                f.write(data)
+                state["sha256"].update(data)
+                state["md5"].update(data)
+                state["offset"] += len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        session["offset"] = state["offset"]
+    finally:
+        with _lock:
+            _active.discard(upload_id)
+
+    if size is not None and session["offset"] == size:
+        return complete_upload(iso_dir, upload_id)
+    return session
+
+
+def complete_upload(iso_dir, upload_id):
+    """アップロードを検証し、ISOディレクトリに原子的に登録する"""
+    session = _load_session(iso_dir, upload_id)
+    session_path, part_path = _paths(iso_dir, upload_id)
+    if session["size"] is not None and session["offset"] != session["size"]:
+        raise UploadError(f"Upload incomplete ({session['offset']}/{session['size']} bytes)",
+                          409, offset=session["offset"])
+
+    state = _hash_state(upload_id, part_path, session["offset"])
+    checksums = {"sha256": state["sha256"].hexdigest(), "md5": state["md5"].hexdigest()}
+    expected = session.get("expected_sha256")
+    if expected and expected != checksums["sha256"]:
+        # 内容が壊れているため、最初からやり直してもらう
+        cancel_upload(iso_dir, upload_id)
+        raise UploadError(f"SHA-256 mismatch (expected {expected}, got {checksums['sha256']})", 422)
+
+    # リンクで登録し、同名のファイルがある場合は上書きせずに失敗させる
+    final_path = os.path.join(iso_dir, session["filename"])
+    try:
+        os.link(part_path, final_path)
+    except FileExistsError:
+        raise UploadError(f"ISO file {session['filename']} already exists", 409)
+    _fsync_dir(iso_dir)
+    checksum_index.record(iso_dir, session["filename"], checksums)
+    cancel_upload(iso_dir, upload_id)
+    if image_store.ENABLED:
+        image_store.add(iso_dir, session["filename"], checksums["sha256"])
+
+    log("upload", f"Upload completed: {session['filename']} ({session['offset']} bytes, "
+        f"sha256 {checksums['sha256']})", upload_id=session['id'])
+    session.update(checksums, completed=True)
+    return session
+
+
+def cancel_upload(iso_dir, upload_id):
+    """アップロードを中止し、途中のファイルを削除する"""
+    _hashers.pop(upload_id, None)
+    for path in _paths(iso_dir, upload_id):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
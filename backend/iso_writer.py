@@ -1,12 +1,42 @@
 import os
+import re
+import math
 import time
-import shutil
 import glob
 import platform
-import ctypes
-from ctypes import wintypes
 import subprocess
-import tempfile
+from telemetry import WriteTelemetry
+import log_pipeline
+from log_pipeline import log
+import write_journal
+from write_retry import RetryPolicy, WriteRetryEngine
+import device_io
+import sim_device
+import image_cache
+import buffer_pool
+import checksum_index
+import sampled_verify
+import device_registry
+import capacity_probe
+
+# 既定の書き込み単位
+DEFAULT_BLOCK_SIZE = 1024 * 1024  # 1MB
+# O_DIRECTで要求されるオフセット・長さのアライメント（デバイスのセクタがこれより大きければセクタに揃える）
+DIRECT_IO_ALIGNMENT = 4096
+# デバイスの最適なI/Oサイズに合わせる場合の書き込み単位の上限（バッファプールを使い切らないように）
+MAX_BLOCK_SIZE = 8 * 1024 * 1024
+
+# 書き込みエンジン
+#   buffered: ページキャッシュ経由のpwrite（既定）
+#   direct:   O_DIRECTでページキャッシュを経由せずに書き込む（Linuxのみ）
+#   dsync:    O_DSYNCで書き込みごとにデバイスへ同期する
+ENGINES = ("buffered", "direct", "dsync")
+
+# ワイプ時にゼロで上書きするデバイスの先頭と末尾の範囲
+# （MBR・GPT・バックアップGPT・ファイルシステムやRAIDの署名はここに収まる）
+WIPE_EDGE_SIZE = 1024 * 1024
+# discardを使わずにゼロを書き込む場合の書き込み単位
+WIPE_ZERO_CHUNK = 4 * 1024 * 1024
 
 def get_iso_files(iso_dir):
     """指定ディレクトリ内のISOファイル一覧を取得"""
@@ -14,15 +44,21 @@ def get_iso_files(iso_dir):
         return []
         
     iso_files = []
+    checksums = checksum_index.load(iso_dir)
     for file in glob.glob(os.path.join(iso_dir, "*.iso")):
         filename = os.path.basename(file)
         size = os.path.getsize(file)
-        iso_files.append({
+        entry = {
             "name": filename,
             "size": size,
             "size_formatted": format_size(size),
             "path": file
-        })
+        }
+        # アップロード時に計算したチェックサムがあれば付ける
+        known = checksum_index.lookup(iso_dir, filename, checksums)
+        if known:
+            entry["sha256"] = known.get("sha256")
+        iso_files.append(entry)
     
     return iso_files
 
@@ -34,19 +70,84 @@ def format_size(size_bytes):
         size_bytes /= 1024.0
     return f"{size_bytes:.2f} PB"
 
-def write_iso_to_device(iso_path, device_path, progress_callback=None):
-    """ISOファイルをブロックデバイスに書き込む"""
+def available_engines():
+    """このプラットフォームで使用できる書き込みエンジンの一覧"""
+    if platform.system() == "Windows":
+        return ["buffered"]
+    engines = ["buffered"]
+    if hasattr(os, "O_DIRECT"):
+        engines.append("direct")
+    if hasattr(os, "O_DSYNC"):
+        engines.append("dsync")
+    return engines
+
+def write_iso_to_device(iso_path, device_path, progress_callback=None, telemetry=None,
+                        resume=False, engine=None, block_size=None, cache_dir=None,
+                        rate_limiter=None, verify=False, skip_if_current=False,
+                        probe_capacity=False):
+    """ISOファイルをブロックデバイスに書き込む
+
+    telemetryにWriteTelemetryを渡すと、速度・ETA・フェーズ時間が記録される。
+    resume=Trueの場合、ジャーナルに記録された同期済みオフセットから書き込みを再開する
+    （Linux/macOSのみ）。engineとblock_sizeで書き込み方式と書き込み単位を選択できる
+    （block_sizeを省略すると、デバイスが報告するセクタサイズと最適なI/Oサイズから決める）。
+    iso_pathにはHTTP(S)のURLも指定でき、cache_dirを指定するとダウンロードしたイメージをそこに保存する。
+    rate_limiterを渡すと、書き込みのたびにその帯域制限に従う（同じUSBバスのジョブで共有）。
+    verify=Trueの場合、書き込み後に抜き取り検証を行い、不一致があればOSErrorにする（Linux/macOSのみ）。
+    skip_if_current=Trueの場合、デバイスがすでに同じイメージを保持していれば書き込まずに完了する。
+    probe_capacity=Trueの場合、書き込み前に容量偽装がないか調べ、実際の容量に収まらなければ失敗する（Linux/macOSのみ）
+    """
+    if telemetry is None:
+        telemetry = WriteTelemetry(device=device_path)
+    engine = engine or "buffered"
+    status = "error"
+    # このジョブの間に記録するログにjob_idとデバイスを付ける
+    log_token = log_pipeline.bind(job_id=telemetry.job_id, device=device_path)
     try:
+        if engine not in available_engines():
+            raise ValueError(f"Unsupported write engine: {engine}")
+        from usb_detector import get_device_geometry
+        geometry = get_device_geometry(device_path)
+        alignment = io_alignment(geometry)
+        block_size = block_size or preferred_block_size(geometry, alignment)
+        if engine == "direct" and block_size % alignment:
+            raise ValueError(f"Block size must be a multiple of {alignment} for direct I/O")
+        log("write", f"Writing in {block_size} byte blocks aligned to {alignment} bytes",
+            level="debug", block_size=block_size, alignment=alignment, geometry=geometry)
+
         # 書き込み開始を通知
-        if progress_callback:
-            progress_callback(0, "started")
+        _enter_phase(telemetry, progress_callback, 0, "started")
+        
+        if skip_if_current:
+            with telemetry.span("fingerprint check", cat="registry"):
+                check = device_registry.check(iso_path, device_path)
+            if check["current"]:
+                log("write", f"Skipping write to {device_path}: {check['reason']}")
+                telemetry.skipped = True
+                status = "completed"
+                _enter_phase(telemetry, progress_callback, 100, "completed")
+                return True
+        # 書き込みが途中で終わった場合に古い記録で省略しないよう、先に記録を消す
+        _update_registry(device_registry.forget, device_path)
             
-        # Windowsの場合、特別な処理が必要
-        if platform.system() == "Windows":
-            return _write_iso_to_windows_device(iso_path, device_path, progress_callback)
-        
-        # Linux/macOSの場合の処理
-        return _write_iso_to_linux_device(iso_path, device_path, progress_callback)
+        # Windowsの場合、特別な処理が必要（疑似デバイスはどのOSでも共通の処理で書き込む）
+        if platform.system() == "Windows" and not sim_device.is_simulated(device_path):
+            if resume:
+                log("write", "Resume is not supported on Windows; writing from the beginning", level="warning")
+            if verify:
+                log("write", "Sampled verification is not supported on Windows; skipping", level="warning")
+            if probe_capacity:
+                log("write", "Capacity probing is not supported on Windows; skipping", level="warning")
+            result = _write_iso_to_windows_device(iso_path, device_path, progress_callback, telemetry,
+                                                  block_size, cache_dir, rate_limiter)
+        else:
+            # Linux/macOSの場合の処理
+            result = _write_iso_to_linux_device(iso_path, device_path, progress_callback, telemetry,
+                                                resume, engine, block_size, cache_dir, rate_limiter,
+                                                verify, probe_capacity, alignment)
+        status = "completed"
+        _update_registry(device_registry.record, iso_path, device_path)
+        return result
         
     except Exception as e:
         # エラーを通知
@@ -55,133 +156,224 @@ def write_iso_to_device(iso_path, device_path, progress_callback=None):
         raise
     
     finally:
-        # 必要に応じてデバイスを安全に取り外す処理を追加できます
-        pass
+        telemetry.finish(status)
+        log_pipeline.unbind(log_token)
 
-def _write_iso_to_linux_device(iso_path, device_path, progress_callback=None):
+def io_alignment(geometry):
+    """O_DIRECTの書き込みを揃える単位（物理セクタにも揃え、デバイス内の読み直し・書き直しを避ける）"""
+    sectors = [geometry.get("logical_sector_size"), geometry.get("physical_sector_size")]
+    return max([DIRECT_IO_ALIGNMENT] + [sector for sector in sectors if sector])
+
+def preferred_block_size(geometry, alignment=DIRECT_IO_ALIGNMENT):
+    """既定の書き込み単位以上で、デバイスの最適なI/Oサイズ（なければ最小のI/Oサイズ）の倍数になる最小の大きさ"""
+    unit = geometry.get("optimal_io_size") or geometry.get("minimum_io_size") or alignment
+    unit = unit * alignment // math.gcd(unit, alignment)
+    if unit > MAX_BLOCK_SIZE:
+        unit = alignment
+    return -(-DEFAULT_BLOCK_SIZE // unit) * unit
+
+def _update_registry(func, *args):
+    """書き込み済みデバイスの記録を更新する（失敗しても書き込み自体は成功扱い）"""
+    try:
+        func(*args)
+    except Exception as e:
+        log("registry", f"Failed to update the device registry: {e}", level="warning")
+
+def _enter_phase(telemetry, progress_callback, progress, phase):
+    """テレメトリのフェーズを切り替えて進捗を通知する"""
+    telemetry.start_phase(phase)
+    if progress_callback:
+        progress_callback(progress, phase)
+
+def _run(telemetry, cmd, **kwargs):
+    """サブプロセスを実行し、その所要時間をトレースに記録する"""
+    with telemetry.span(" ".join(cmd), cat="subprocess"):
+        return subprocess.run(cmd, **kwargs)
+
+def _check_output(telemetry, cmd, **kwargs):
+    """subprocess.check_outputの所要時間をトレースに記録する"""
+    with telemetry.span(" ".join(cmd), cat="subprocess"):
+        return subprocess.check_output(cmd, **kwargs)
+
+def _sleep(telemetry, seconds, reason="wait"):
+    """待機時間をトレースに記録しながらスリープする"""
+    with telemetry.span(f"sleep ({reason})", cat="sleep", seconds=seconds):
+        time.sleep(seconds)
+
+def _write_iso_to_linux_device(iso_path, device_path, progress_callback=None, telemetry=None,
+                               resume=False, engine="buffered", block_size=DEFAULT_BLOCK_SIZE,
+                               cache_dir=None, rate_limiter=None, verify=False, probe_capacity=False,
+                               alignment=DIRECT_IO_ALIGNMENT):
     """Linux/macOS環境でISOファイルをデバイスに書き込む"""
+    if telemetry is None:
+        telemetry = WriteTelemetry(device=device_path)
     try:
+        simulated = sim_device.is_simulated(device_path)
+        
+        # 中断時に再開できるよう、デバイスのシリアルごとにジャーナルを記録する
+        from usb_detector import get_device_serial
+        serial = None if simulated else get_device_serial(device_path)
+        journal_key = write_journal.journal_key(device_path, serial)
+        identity = write_journal.image_identity(iso_path)
+        
         # デバイス準備（Linuxの場合はマウント解除が必要な場合がある）
-        if platform.system() == "Linux":
-            if progress_callback:
-                progress_callback(0, "preparing_disk")
+        if platform.system() == "Linux" and not simulated:
+            _enter_phase(telemetry, progress_callback, 0, "preparing_disk")
                 
             # デバイスがマウントされているか確認し、マウント解除を試みる
-            if not _ensure_device_not_mounted(device_path, progress_callback):
+            if not _ensure_device_not_mounted(device_path, progress_callback, telemetry):
                 raise OSError(f"Failed to unmount device {device_path}")
                 
-            if progress_callback:
-                progress_callback(0, "disk_prepared")
+            _enter_phase(telemetry, progress_callback, 0, "disk_prepared")
             
             # Linux環境では、前回の書き込み後にカーネルがキャッシュを保持している可能性があるため
             # デバイスを再オープンする前に強制的にsyncを実行し、IO状態をリセットする
             try:
-                subprocess.run(["sync"], check=True)
+                _run(telemetry, ["sync"], check=True)
                 # ブロックデバイスのキャッシュをクリア
                 if os.path.exists('/sbin/blockdev'):
-                    subprocess.run(["blockdev", "--flushbufs", device_path], check=False)
+                    _run(telemetry, ["blockdev", "--flushbufs", device_path], check=False)
                 # 少し待機して、カーネルがデバイスの状態を更新する時間を確保
-                time.sleep(1)
+                _sleep(telemetry, 1, "device settle")
             except Exception as e:
-                print(f"Warning: Device sync issue: {e}")
-        
-        # ISOファイルを開く
-        with open(iso_path, 'rb') as iso_file:
-            # ISOファイルのサイズを取得
-            iso_file.seek(0, os.SEEK_END)
-            iso_size = iso_file.tell()
-            iso_file.seek(0)
+                log("device", f"Device sync issue: {e}", level="warning")
+        
+        # マウント解除の後で、書き込む前に容量偽装がないか調べる（結果は下のensure_fitsで使う）
+        if probe_capacity:
+            _enter_phase(telemetry, progress_callback, 0, "probing_capacity")
+            with telemetry.span("capacity probe", cat="probe"):
+                capacity_probe.probe(device_path)
+        
+        # 再開モードでは、書き込み済み領域の末尾を照合してから続きを書き込む
+        start_offset = 0
+        if resume:
+            start_offset = _find_resume_offset(iso_path, device_path, journal_key, identity, telemetry)
+        else:
+            # 最初から書き直す場合、以前のジャーナルはもう当てにならない
+            write_journal.clear(journal_key)
+        
+        # ISOファイルを開く（繰り返し書き込まれるイメージはメモリ上のキャッシュから読む）
+        with image_cache.open_image(iso_path, cache_dir) as iso_file:
+            iso_size = iso_file.size
+            iso_file.seek(start_offset)
+            telemetry.total_bytes = iso_size
+            # 容量プローブで分かった実際の容量に収まらなければ、書き込む前に失敗させる
+            capacity_probe.ensure_fits(device_path, iso_size)
             
-            if progress_callback:
-                progress_callback(0, "opening_device")
-                
-            # リトライに関する変数
-            max_retries = 10  # 最大リトライ回数
-            retry_delay = 2.0  # リトライ間隔（秒）
+            # キャッシュ済みイメージはmmapのスライスをそのまま渡す（ページ境界に揃っているためO_DIRECTでも可）
+            # それ以外は共有プールのバッファに読み込み、ループごとのメモリ確保をなくす
+            chunk_buffer = None if iso_file.zero_copy else _acquire_buffer(block_size, telemetry)
             
-            with open(device_path, 'wb') as device:
-                buffer_size = 1024 * 1024  # 1MB
-                bytes_written = 0
-                last_report_time = time.time()
-                report_interval = 0.5  # 進捗報告の間隔 (秒)
+            _enter_phase(telemetry, progress_callback, 0, "opening_device")
+            
+            try:
+                with telemetry.span("open device", cat="io", path=device_path, engine=engine):
+                    # 再開時は既存の内容を残すため切り詰めずに開く
+                    device = device_io.open_device(device_path, writable=True, engine=engine,
+                                                   truncate=not start_offset)
+            except Exception:
+                if chunk_buffer is not None:
+                    chunk_buffer.release()
+                raise
+            try:
+                buffer_size = block_size
+                bytes_written = start_offset
+                next_checkpoint = start_offset + write_journal.CHECKPOINT_INTERVAL
+                if start_offset:
+                    telemetry.bytes_written = start_offset
+                    telemetry.resumed_from = start_offset
+                
+                # 書き込み位置を明示するpwriteで、失敗した範囲だけを同じオフセットから書き直す
+                retry_engine = _make_retry_engine(
+                    device.pwrite, telemetry, progress_callback, iso_size,
+                    device_present=device.present)
                 
-                if progress_callback:
-                    progress_callback(0, "writing")
+                _enter_phase(telemetry, progress_callback, int(start_offset * 100 / iso_size) if iso_size > 0 else 0,
+                             "writing")
+                
+                if chunk_buffer is None:
+                    def read_chunk():
+                        return iso_file.read(buffer_size)
+                else:
+                    chunk_view = chunk_buffer.view[:buffer_size]
+                    
+                    def read_chunk():
+                        return chunk_view[:iso_file.readinto(chunk_view)]
                 
                 while True:
-                    buffer = iso_file.read(buffer_size)
+                    buffer = read_chunk()
                     if not buffer:
                         break
                     
-                    # 書き込み処理にリトライロジックを追加
-                    retry_count = 0
-                    write_success = False
-                    
-                    while retry_count <= max_retries and not write_success:
-                        if retry_count > 0:
-                            # リトライの場合は少し待機
-                            time.sleep(retry_delay)
-                            print(f"Retrying write operation (attempt {retry_count}/{max_retries})")
-                            if progress_callback:
-                                progress_callback(int(bytes_written * 100 / iso_size) if iso_size > 0 else 0,
-                                                f"writing (retry {retry_count}/{max_retries})")
-                        
-                        try:
-                            # 書き込み処理
-                            device.write(buffer)
-                            write_success = True
-                        except (IOError, OSError) as e:
-                            print(f"Write error: {str(e)}")
-                            retry_count += 1
-                            if retry_count > max_retries:
-                                raise OSError(f"Write failed after {max_retries} retries: {str(e)}")
-                    
+                    if engine == "direct" and len(buffer) % alignment:
+                        # 末尾の半端な長さはO_DIRECTでは書けないため通常の書き込みに切り替える
+                        device.disable_direct_io()
+                    if rate_limiter is not None:
+                        rate_limiter.throttle(len(buffer))
+                    retry_engine.write(buffer, bytes_written)
                     bytes_written += len(buffer)
-                    print(f"Bytes written: {bytes_written}/{iso_size} ({bytes_written * 100 / iso_size:.2f}%)")
                     
-                    # 定期的に進捗を報告
-                    current_time = time.time()
-                    if progress_callback and (current_time - last_report_time) >= report_interval:
+                    # 速度サンプルが更新されたタイミングで進捗を報告
+                    if telemetry.add_bytes(len(buffer)) and progress_callback:
                         progress_percent = int(bytes_written * 100 / iso_size) if iso_size > 0 else 0
                         progress_callback(progress_percent, "writing")
-                        last_report_time = current_time
+                    
+                    # 一定量ごとにデバイスへ同期し、同期済みオフセットをジャーナルに記録
+                    if bytes_written >= next_checkpoint:
+                        _checkpoint(device, journal_key, device_path, identity, bytes_written, telemetry)
+                        next_checkpoint = bytes_written + write_journal.CHECKPOINT_INTERVAL
                 
                 # 書き込みバッファをフラッシュ
-                if progress_callback:
-                    progress_callback(100, "flushing")  # 99%でフラッシュ中と表示
+                _enter_phase(telemetry, progress_callback, 100, "flushing")
+                
+                with telemetry.span("fsync", cat="io"):
+                    device.fsync()
                 
-                device.flush()
-                os.fsync(device.fileno())
+                # 全体が同期できたのでジャーナルは不要
+                write_journal.clear(journal_key)
                 
-                if progress_callback:
-                    progress_callback(100, "syncing")  # ディスクキャッシュ同期
+                _enter_phase(telemetry, progress_callback, 100, "syncing")  # ディスクキャッシュ同期
                 
                 # Linux環境ではsync呼び出しでディスクキャッシュを確実に同期
                 if platform.system() == "Linux":
-                    subprocess.run(["sync"], check=True)
+                    _run(telemetry, ["sync"], check=True)
+            finally:
+                if chunk_buffer is not None:
+                    chunk_buffer.release()
+                device.close()
+        
+        # 書き込んだ内容を抜き取りで読み戻して照合
+        if verify:
+            _enter_phase(telemetry, progress_callback, 100, "verifying")
+            with telemetry.span("sampled verify", cat="verify"):
+                report = sampled_verify.verify_sample(iso_path, device_path, telemetry=telemetry)
+            telemetry.verification = report
+            if not report["verified"]:
+                raise OSError(f"Verification failed: {report['mismatches']} sampled blocks "
+                              f"differ from the image")
         
         # 完了を通知
         if progress_callback:
-            progress_callback(99, "finalizing")  # 完了前に最終化ステップを追加
+            _enter_phase(telemetry, progress_callback, 99, "finalizing")  # 完了前に最終化ステップを追加
             
             # 書き込み完了後、Linux環境ではデバイスファイル記述子がクローズされても
             # カーネルバッファが完全にフラッシュされるまで時間がかかるため
             # syncコマンドを3回実行して確実にディスク同期を行う
             for i in range(3):
                 try:
-                    subprocess.run(["sync"], check=True)
-                    time.sleep(0.5)
+                    _run(telemetry, ["sync"], check=True)
+                    _sleep(telemetry, 0.5, "post-sync")
                 except Exception as e:
-                    print(f"Warning: Sync issue on attempt {i+1}: {e}")
+                    log("device", f"Sync issue on attempt {i+1}: {e}", level="warning")
 
             # デバイス状態の更新を明示的にカーネルに要求
             try:
-                if os.path.exists('/sbin/hdparm'):
-                    subprocess.run(["/sbin/hdparm", "-z", device_path], check=False)
+                if os.path.exists('/sbin/hdparm') and not simulated:
+                    _run(telemetry, ["/sbin/hdparm", "-z", device_path], check=False)
             except Exception as e:
-                print(f"Warning: Failed to refresh device: {e}")
+                log("device", f"Failed to refresh device: {e}", level="warning")
                 
-            progress_callback(100, "completed")
+            _enter_phase(telemetry, progress_callback, 100, "completed")
         
         return True
         
@@ -191,95 +383,272 @@ def _write_iso_to_linux_device(iso_path, device_path, progress_callback=None):
             progress_callback(0, f"error: {str(e)}")
         raise
 
-def _ensure_device_not_mounted(device_path, progress_callback=None):
+def wipe_device(device_path, progress_callback=None, telemetry=None, zero=False):
+    """再利用するUSBメモリを短時間で消去する
+
+    先頭と末尾のWIPE_EDGE_SIZEをゼロで上書きしてパーティションテーブル（バックアップGPTを含む）と
+    ファイルシステムの署名を消し、残りはBLKDISCARDで破棄する（非対応なら残す）。
+    zero=Trueの場合は残りもBLKZEROOUT（非対応ならゼロの書き込み）で確実にゼロにする。
+    Windowsではdiskpart cleanを使う。各ステップの所要時間を返し、テレメトリにも記録する
+    """
+    if telemetry is None:
+        telemetry = WriteTelemetry(device=device_path)
+    steps = []
+    status = "error"
+    log_token = log_pipeline.bind(job_id=telemetry.job_id, device=device_path)
+    
+    def step(name, progress, func, *args):
+        _enter_phase(telemetry, progress_callback, progress, name)
+        started = time.monotonic()
+        result = func(*args)
+        steps.append({"step": name, "seconds": round(time.monotonic() - started, 3), "result": result})
+        return result
+    
+    try:
+        _enter_phase(telemetry, progress_callback, 0, "started")
+        simulated = sim_device.is_simulated(device_path)
+        # 消去したデバイスの書き込み記録は使えなくなる
+        _update_registry(device_registry.forget, device_path)
+        
+        if platform.system() == "Windows" and not simulated:
+            drive_number = _windows_drive_number(device_path)
+            if not step("diskpart_clean", 0, _prepare_disk_with_diskpart, drive_number, None, telemetry):
+                raise OSError(f"Failed to clean disk {drive_number}")
+        else:
+            if platform.system() == "Linux" and not simulated:
+                if not step("dismounting_volume", 0, _ensure_device_not_mounted, device_path, None, telemetry):
+                    raise OSError(f"Failed to unmount device {device_path}")
+            
+            with device_io.open_device(device_path, writable=True) as device:
+                size = device.size()
+                telemetry.total_bytes = size
+                edge = min(WIPE_EDGE_SIZE, size)
+                tail_start = max(size - WIPE_EDGE_SIZE, edge) // DIRECT_IO_ALIGNMENT * DIRECT_IO_ALIGNMENT
+                step("erasing_signatures", 0, _zero_range, device, [(0, edge), (tail_start, size - tail_start)])
+                if tail_start > edge:
+                    step("zeroing" if zero else "discarding", 1, _clear_range, device, edge,
+                         tail_start - edge, zero, telemetry, progress_callback)
+                step("syncing", 99, device.fsync)
+            
+            # カーネルに空になったパーティションテーブルを読み直させる
+            if platform.system() == "Linux" and not simulated and os.path.exists('/sbin/blockdev'):
+                step("rereading_partitions", 99, lambda: _run(
+                    telemetry, ["blockdev", "--rereadpt", device_path], check=False).returncode == 0)
+        
+        status = "completed"
+        telemetry.wipe = steps
+        _enter_phase(telemetry, progress_callback, 100, "completed")
+        log("wipe", f"Wiped {device_path}: " + ", ".join(f"{s['step']} {s['seconds']}s" for s in steps),
+            steps=steps)
+        return {"device": device_path, "steps": steps,
+                "seconds": round(sum(s["seconds"] for s in steps), 3)}
+    except Exception as e:
+        telemetry.wipe = steps
+        if progress_callback:
+            progress_callback(0, f"error: {str(e)}")
+        raise
+    finally:
+        telemetry.finish(status)
+        log_pipeline.unbind(log_token)
+
+def _zero_range(device, ranges):
+    """範囲のリストをゼロで上書きする"""
+    written = 0
+    for offset, length in ranges:
+        written += _write_zeros(device, offset, length)
+    return {"bytes": written}
+
+def _write_zeros(device, offset, length, telemetry=None, progress_callback=None, total=None):
+    zeros = bytes(min(WIPE_ZERO_CHUNK, length))
+    end = offset + length
+    position = offset
+    while position < end:
+        count = device.pwrite(zeros[:min(len(zeros), end - position)], position)
+        if count <= 0:
+            raise OSError(f"Write returned {count} at offset {position}")
+        position += count
+        if telemetry is not None and telemetry.add_bytes(count) and progress_callback:
+            progress_callback(int(telemetry.bytes_written * 100 / total) if total else 0, "zeroing")
+    return length
+
+def _clear_range(device, offset, length, zero, telemetry, progress_callback):
+    """署名を消した残りの範囲を消去し、使った方法を返す"""
+    # ioctlの範囲はセクタ単位に揃える（offsetとlengthはDIRECT_IO_ALIGNMENTの倍数）
+    try:
+        if zero:
+            device.zeroout(offset, length)
+            return {"method": "zeroout", "bytes": length}
+        device.discard(offset, length)
+        return {"method": "discard", "bytes": length}
+    except OSError as e:
+        if not zero:
+            # 署名は消してあるので、discardできなくても再利用には十分
+            log("wipe", f"Discard is not supported on {device.path} ({e}); "
+                "leaving the remaining data in place")
+            return {"method": "skipped", "bytes": 0, "reason": str(e)}
+        log("wipe", f"Zeroout is not supported on {device.path} ({e}); writing zeros")
+    _write_zeros(device, offset, length, telemetry, progress_callback, offset + length)
+    return {"method": "zero-fill", "bytes": length}
+
+def _windows_drive_number(device_path):
+    """\\\\.\\PhysicalDriveN 形式のパスからディスク番号を取り出す"""
+    if '\\\\?\\PhysicalDrive' in device_path or '\\\\.\\PhysicalDrive' in device_path:
+        return device_path.split('PhysicalDrive')[-1]
+    raise ValueError(f"Invalid device path format: {device_path}")
+
+def _acquire_buffer(size, telemetry):
+    """共有プールから書き込みバッファを借りる（メモリ予算を超える場合は空くまで待つ）"""
+    pool = buffer_pool.get_pool()
+    buffer = pool.acquire(size, timeout=0)
+    if buffer is None:
+        log("buffer", "Waiting for a write buffer (buffer pool budget reached)")
+        with telemetry.span("wait for buffer", cat="memory", size=size):
+            buffer = pool.acquire(size)
+    return buffer
+
+def _make_retry_engine(write_at, telemetry, progress_callback, iso_size, device_present=None):
+    """リトライ時にテレメトリと進捗通知を更新する書き込みエンジンを作成"""
+    policy = RetryPolicy()
+    
+    def on_retry(attempt, delay, error, offset):
+        log("retry", f"Write error at offset {offset}: {error}; "
+            f"retrying in {delay:.2f}s (attempt {attempt}/{policy.max_retries})",
+            level="warning", offset=offset, attempt=attempt)
+        telemetry.instant("write error", cat="error", offset=offset, error=str(error))
+        telemetry.record_retry(offset=offset, delay=round(delay, 3))
+        if progress_callback:
+            progress_callback(int(offset * 100 / iso_size) if iso_size > 0 else 0,
+                              f"writing (retry {attempt}/{policy.max_retries})")
+    
+    return WriteRetryEngine(write_at, policy, on_retry=on_retry,
+                            sleep=lambda delay: _sleep(telemetry, delay, "retry backoff"),
+                            device_present=device_present)
+
+def _find_resume_offset(iso_path, device_path, journal_key, identity, telemetry):
+    """ジャーナルと書き込み済み領域の照合結果から再開オフセットを決める"""
+    with telemetry.span("resume check", cat="journal") as span:
+        offset = write_journal.resume_offset(journal_key, identity)
+        if offset and not write_journal.verify_tail(iso_path, device_path, offset):
+            log("journal", f"Written region before offset {offset} does not match the image; "
+                "restarting from 0", level="warning")
+            offset = 0
+        span.args["offset"] = offset
+    if offset:
+        log("journal", f"Resuming write of {identity['name']} at offset {offset}")
+        telemetry.instant("resume", cat="journal", offset=offset)
+    return offset
+
+def _checkpoint(device, journal_key, device_path, identity, offset, telemetry):
+    """書き込み済みデータをデバイスへ同期し、ジャーナルを更新する"""
+    with telemetry.span("checkpoint", cat="journal", offset=offset):
+        device.fsync()
+        write_journal.save(journal_key, device_path, identity, offset)
+
+def _mounted_partitions(device_path, telemetry):
+    """デバイスのうちマウントされているもの（デバイス自体とパーティション）のリスト"""
+    mount_output = _check_output(telemetry, ["mount"], universal_newlines=True)
+    # デバイスパーティションを取得（例: /dev/sdb -> /dev/sdb1, /dev/sdb2等）
+    # /dev/loop1 が /dev/loop10 に一致しないよう、デバイス名の後ろはパーティション番号のみ許可する
+    partition_pattern = re.compile(re.escape(device_path) + r'(p?\d+)?$')
+    mounted = []
+    for line in mount_output.splitlines():
+        parts = line.split()
+        if parts and partition_pattern.match(parts[0]):
+            mounted.append(parts[0])
+    return mounted
+
+def unmount_device(device_path, telemetry=None):
+    """書き込みと同じ手順でデバイスをマウント解除し、解除できなかったパーティションのリストを返す
+
+    Linux以外と疑似デバイスでは何もしない。マウント状態を確認できなければOSError
+    """
+    if platform.system() != "Linux" or sim_device.is_simulated(device_path):
+        return []
+    if telemetry is None:
+        telemetry = WriteTelemetry(device=device_path)
+    if not _ensure_device_not_mounted(device_path, None, telemetry):
+        raise OSError(f"Failed to unmount device {device_path}")
+    return _mounted_partitions(device_path, telemetry)
+
+def _ensure_device_not_mounted(device_path, progress_callback=None, telemetry=None):
     """デバイスがマウントされていないことを確認（Linuxのみ）"""
     if platform.system() != "Linux":
         return True
+    if telemetry is None:
+        telemetry = WriteTelemetry(device=device_path)
     
     try:
-        # マウントポイントを確認
-        mount_output = subprocess.check_output(["mount"], universal_newlines=True)
-        mount_lines = mount_output.splitlines()
-        
-        # デバイスパーティションを取得（例: /dev/sdb -> /dev/sdb1, /dev/sdb2等）
-        device_base = os.path.basename(device_path)
-        mounted_partitions = []
-        
-        for line in mount_lines:
-            if device_base in line or device_path in line:
-                parts = line.split()
-                if len(parts) >= 1:
-                    mounted_partitions.append(parts[0])
+        # マウントされているパーティションを確認
+        mounted_partitions = _mounted_partitions(device_path, telemetry)
         
         # マウントされているパーティションがある場合はアンマウント
         if mounted_partitions:
-            if progress_callback:
-                progress_callback(0, "dismounting_volume")
+            _enter_phase(telemetry, progress_callback, 0, "dismounting_volume")
                 
             for partition in mounted_partitions:
-                print(f"Unmounting {partition}...")
+                log("device", f"Unmounting {partition}...")
                 # 強制オプションを追加
-                subprocess.run(["umount", "-f", partition], check=False)
+                _run(telemetry, ["umount", "-f", partition], check=False)
                 
             # アンマウント後に再確認
-            time.sleep(1)
-            mount_output = subprocess.check_output(["mount"], universal_newlines=True)
+            _sleep(telemetry, 1, "unmount settle")
+            mount_output = _check_output(telemetry, ["mount"], universal_newlines=True)
             for partition in mounted_partitions:
                 if partition in mount_output:
-                    print(f"Failed to unmount {partition}")
+                    log("device", f"Failed to unmount {partition}", level="warning")
                     # 最後の手段: lazily unmountを試行
                     try:
-                        subprocess.run(["umount", "-l", partition], check=False)
-                        time.sleep(0.5)
+                        _run(telemetry, ["umount", "-l", partition], check=False)
+                        _sleep(telemetry, 0.5, "lazy unmount")
                     except Exception as e:
-                        print(f"Error during lazy unmount: {e}")
+                        log("device", f"Error during lazy unmount: {e}", level="warning")
             
             # 再確認
-            time.sleep(0.5)
-            mount_output = subprocess.check_output(["mount"], universal_newlines=True)
+            _sleep(telemetry, 0.5, "unmount settle")
+            mount_output = _check_output(telemetry, ["mount"], universal_newlines=True)
             still_mounted = False
             for partition in mounted_partitions:
                 if partition in mount_output:
                     still_mounted = True
-                    print(f"Partition {partition} is still mounted")
+                    log("device", f"Partition {partition} is still mounted", level="warning")
             
             # それでも問題がある場合は続行するが警告を出す
             if still_mounted:
-                print("WARNING: Some partitions could not be unmounted. Continuing anyway...")
+                log("device", "Some partitions could not be unmounted. Continuing anyway...", level="warning")
         
         return True
         
     except Exception as e:
-        print(f"Error ensuring device not mounted: {e}")
+        log("device", f"Error ensuring device not mounted: {e}", level="error")
         return False
 
-def _write_iso_to_windows_device(iso_path, device_path, progress_callback=None):
+def _write_iso_to_windows_device(iso_path, device_path, progress_callback=None, telemetry=None,
+                                 block_size=DEFAULT_BLOCK_SIZE, cache_dir=None, rate_limiter=None):
     """Windows環境でISOファイルをデバイスに書き込む"""
+    # Windows専用のモジュールは使うときに読み込む（CLIなどの起動を速くするため）
+    import ctypes
+    from ctypes import wintypes
+    
     autoplay_enabled = None  # 自動再生の設定を保持する変数を初期化
+    if telemetry is None:
+        telemetry = WriteTelemetry(device=device_path)
     
     try:
         # デバイス番号を抽出
-        if '\\\\?\\PhysicalDrive' in device_path:
-            drive_number = device_path.split('PhysicalDrive')[-1]
-        elif '\\\\.\\PhysicalDrive' in device_path:
-            drive_number = device_path.split('PhysicalDrive')[-1]
-        else:
-            raise ValueError(f"Invalid device path format: {device_path}")
+        drive_number = _windows_drive_number(device_path)
         
         # Windows自動再生を一時的に無効化
-        if progress_callback:
-            progress_callback(0, "disabling_autoplay")
+        _enter_phase(telemetry, progress_callback, 0, "disabling_autoplay")
         
         # 自動再生の設定を保存して無効化
         autoplay_enabled = _disable_windows_autoplay()
         
         # DiskPartスクリプトを使用してディスクをクリーンアップ
-        if not _prepare_disk_with_diskpart(drive_number, progress_callback):
+        if not _prepare_disk_with_diskpart(drive_number, progress_callback, telemetry):
             # エラー時の処理は上位のエラーハンドリングで行うため、ここでは設定を復元せずにエラーを上げる
             raise OSError(f"Failed to prepare disk {drive_number}")
         
-        if progress_callback:
-            progress_callback(0, "opening_device")
+        _enter_phase(telemetry, progress_callback, 0, "opening_device")
         
         # 正規化されたデバイスパス
         if not device_path.startswith("\\\\.\\"):
@@ -295,134 +664,95 @@ def _write_iso_to_windows_device(iso_path, device_path, progress_callback=None):
         INVALID_HANDLE_VALUE = wintypes.HANDLE(-1).value
         
         # ISOファイルを開く
-        with open(iso_path, 'rb') as iso_file:
-            # ファイルサイズをseekを使って取得
-            iso_file.seek(0, os.SEEK_END)
-            iso_size = iso_file.tell()
-            iso_file.seek(0)  # ファイルポインタを先頭に戻す
-            print(f"ISO size: {iso_size} bytes")
+        with image_cache.open_image(iso_path, cache_dir) as iso_file:
+            iso_size = iso_file.size
+            telemetry.total_bytes = iso_size
+            # 容量プローブで分かった実際の容量に収まらなければ、書き込む前に失敗させる
+            capacity_probe.ensure_fits(device_path, iso_size)
+            log("write", f"ISO size: {iso_size} bytes")
+            
+            # 後でデバイスを開いてから待たないよう、先に書き込みバッファを確保する
+            chunk_buffer = None if iso_file.zero_copy else _acquire_buffer(block_size, telemetry)
             
             # CreateFileWでデバイスを開く
-            h_device = ctypes.windll.kernel32.CreateFileW(
-                normalized_path,                   # デバイスパス
-                GENERIC_WRITE,                     # アクセスモード（書き込み）
-                FILE_SHARE_READ | FILE_SHARE_WRITE,# 共有モード
-                None,                              # セキュリティ属性
-                OPEN_EXISTING,                     # 作成方法
-                0,                                 # フラグと属性
-                None                               # テンプレートファイル
-            )
+            with telemetry.span("CreateFileW", cat="io", path=normalized_path):
+                h_device = ctypes.windll.kernel32.CreateFileW(
+                    normalized_path,                   # デバイスパス
+                    GENERIC_WRITE,                     # アクセスモード（書き込み）
+                    FILE_SHARE_READ | FILE_SHARE_WRITE,# 共有モード
+                    None,                              # セキュリティ属性
+                    OPEN_EXISTING,                     # 作成方法
+                    0,                                 # フラグと属性
+                    None                               # テンプレートファイル
+                )
             
             if h_device == INVALID_HANDLE_VALUE:
                 error_code = ctypes.windll.kernel32.GetLastError()
+                if chunk_buffer is not None:
+                    chunk_buffer.release()
                 # ここでは設定を復元せず、後のfinallyブロックでリソース解放を一括で行う
                 raise OSError(f"Failed to open device. Error code: {error_code}")
             
             try:
                 # 書き込みを開始
-                if progress_callback:
-                    progress_callback(0, "writing")
+                _enter_phase(telemetry, progress_callback, 0, "writing")
                 
-                buffer_size = 1024 * 1024  # 1MB
+                buffer_size = block_size
                 bytes_written = 0
-                last_report_time = time.time()
-                report_interval = 0.5  # 進捗報告の間隔 (秒)
                 
-                # リトライに関する変数
-                max_retries = 10  # 最大リトライ回数を3回から10回に増やす
-                retry_delay = 2.0  # リトライ間隔を1.0秒から2.0秒に増やす
+                if chunk_buffer is None:
+                    def read_chunk():
+                        return iso_file.read(buffer_size)
+                else:
+                    chunk_view = chunk_buffer.view[:buffer_size]
+                    
+                    def read_chunk():
+                        return chunk_view[:iso_file.readinto(chunk_view)]
+                
+                # OVERLAPPEDでオフセットを指定して書き込み、失敗した範囲だけを書き直す
+                retry_engine = _make_retry_engine(
+                    _windows_write_at(h_device), telemetry, progress_callback, iso_size)
                 
                 while True:
-                    buffer = iso_file.read(buffer_size)
+                    buffer = read_chunk()
                     if not buffer:
                         break
                     
-                    # バッファの長さ
-                    buffer_len = len(buffer)
-                    
-                    # バッファをctypes.c_char配列に変換
-                    c_buffer = (ctypes.c_char * buffer_len).from_buffer_copy(buffer)
-                    bytes_to_write = wintypes.DWORD(buffer_len)
-                    bytes_written_ptr = wintypes.DWORD(0)
-                    
-                    # 書き込み処理にリトライロジックを追加
-                    retry_count = 0
-                    write_success = False
-                    last_error_code = 0
-                    
-                    while retry_count <= max_retries and not write_success:
-                        if retry_count > 0:
-                            # リトライの場合は少し待機
-                            time.sleep(retry_delay)
-                            print(f"Retrying write operation (attempt {retry_count}/{max_retries})")
-                            if progress_callback:
-                                progress_callback(int(bytes_written * 100 / iso_size) if iso_size > 0 else 0, 
-                                                 f"writing (retry {retry_count}/{max_retries})")
-                        
-                        # WriteFileでデバイスに書き込み
-                        success = ctypes.windll.kernel32.WriteFile(
-                            h_device,                  # デバイスハンドル
-                            c_buffer,                  # データバッファ
-                            bytes_to_write,            # 書き込むバイト数
-                            ctypes.byref(bytes_written_ptr), # 書き込まれたバイト数
-                            None                       # オーバーラップド構造体
-                        )
-                        
-                        if success:
-                            write_success = True
-                        else:
-                            # エラーコードを取得
-                            last_error_code = ctypes.windll.kernel32.GetLastError()
-                            # エラーコード1のみリトライ（それ以外はリトライしない）
-                            if last_error_code != 1:
-                                break
-                            retry_count += 1
-                    
-                    # すべてのリトライが失敗した場合
-                    if not write_success:
-                        if last_error_code == 1:
-                            error_message = f"Write failed after {max_retries} retries. Error code: 1 (Write protected media or permission issue)"
-                        else:
-                            error_message = f"Write failed. Error code: {last_error_code}"
-                        
-                        # ログに出力してからエラーを投げる
-                        print(error_message)
-                        raise OSError(error_message)
-                    
-                    bytes_written += bytes_written_ptr.value
-                    print(f"Bytes written: {bytes_written}/{iso_size} ({bytes_written * 100 / iso_size:.2f}%)")
+                    if rate_limiter is not None:
+                        rate_limiter.throttle(len(buffer))
+                    retry_engine.write(buffer, bytes_written)
+                    bytes_written += len(buffer)
                     
-                    # 進捗報告
-                    current_time = time.time()
-                    if progress_callback and (current_time - last_report_time) >= report_interval:
+                    # 速度サンプルが更新されたタイミングで進捗を報告
+                    if telemetry.add_bytes(len(buffer)) and progress_callback:
                         progress_percent = int(bytes_written * 100 / iso_size) if iso_size > 0 else 0
                         progress_callback(progress_percent, "writing")
-                        last_report_time = current_time
                 
                 # 書き込みバッファをフラッシュ
-                if progress_callback:
-                    progress_callback(99, "flushing")  # 99%でフラッシュ中と表示
+                _enter_phase(telemetry, progress_callback, 99, "flushing")  # 99%でフラッシュ中と表示
                 
-                flush_success = ctypes.windll.kernel32.FlushFileBuffers(h_device)
+                with telemetry.span("FlushFileBuffers", cat="io"):
+                    flush_success = ctypes.windll.kernel32.FlushFileBuffers(h_device)
                 if not flush_success:
                     flush_error = ctypes.windll.kernel32.GetLastError()
-                    print(f"Warning: FlushFileBuffers returned error: {flush_error}")
+                    log("write", f"FlushFileBuffers returned error: {flush_error}", level="warning")
                 
             finally:
+                if chunk_buffer is not None:
+                    chunk_buffer.release()
                 # デバイスハンドルを閉じる - 複数回呼ばれないようにfinallyブロックに移動
                 ctypes.windll.kernel32.CloseHandle(h_device)
                 # ここでは自動再生設定を復元しない
         
         # 書き込みが完了してISO処理が終わってから設定を元に戻す
         if autoplay_enabled is not None:
-            print("書き込み完了後に自動再生の設定を復元します")
+            log("device", "書き込み完了後に自動再生の設定を復元します")
             _restore_windows_autoplay(autoplay_enabled)
             # 復元後に参照をクリアして複数回呼び出しを防ぐ
             autoplay_enabled = None
         
         # 完了通知
-        if progress_callback:
-            progress_callback(100, "completed")
+        _enter_phase(telemetry, progress_callback, 100, "completed")
         
         return True
         
@@ -434,9 +764,45 @@ def _write_iso_to_windows_device(iso_path, device_path, progress_callback=None):
     finally:
         # 例外発生時も含めて、ここで必ずautoplayの設定を元に戻す
         if autoplay_enabled is not None:
-            print("例外発生時または後処理として自動再生の設定を復元します")
+            log("device", "例外発生時または後処理として自動再生の設定を復元します")
             _restore_windows_autoplay(autoplay_enabled)
 
+def _windows_write_at(h_device):
+    """OVERLAPPED構造体で書き込み位置を指定するWriteFile関数を返す"""
+    import ctypes
+    from ctypes import wintypes
+    
+    class OVERLAPPED(ctypes.Structure):
+        _fields_ = [
+            ("Internal", ctypes.c_void_p),
+            ("InternalHigh", ctypes.c_void_p),
+            ("Offset", wintypes.DWORD),
+            ("OffsetHigh", wintypes.DWORD),
+            ("hEvent", wintypes.HANDLE),
+        ]
+    
+    def write_at(view, offset):
+        length = len(view)
+        # コピーせずにバッファのアドレスを直接渡す（viewが参照を保持している）
+        c_buffer = ctypes.c_void_p(buffer_pool.buffer_address(view))
+        overlapped = OVERLAPPED()
+        overlapped.Offset = offset & 0xFFFFFFFF
+        overlapped.OffsetHigh = offset >> 32
+        bytes_written = wintypes.DWORD(0)
+        success = ctypes.windll.kernel32.WriteFile(
+            h_device,                      # デバイスハンドル
+            c_buffer,                      # データバッファ
+            length,                        # 書き込むバイト数
+            ctypes.byref(bytes_written),   # 書き込まれたバイト数
+            ctypes.byref(overlapped)       # 書き込み位置
+        )
+        if not success:
+            # winerror付きのOSErrorにしてリトライエンジンで分類できるようにする
+            raise ctypes.WinError(ctypes.windll.kernel32.GetLastError())
+        return bytes_written.value
+    
+    return write_at
+
 def _disable_windows_autoplay():
     """Windows自動再生を一時的に無効化し、元の設定を返す"""
     if platform.system() != "Windows":
@@ -444,6 +810,7 @@ def _disable_windows_autoplay():
         
     try:
         import winreg
+        import ctypes
         
         # 現在の自動再生設定を取得（復元用）
         try:
@@ -464,11 +831,11 @@ def _disable_windows_autoplay():
         except:
             pass
             
-        print("Windows Autoplay disabled temporarily")
+        log("device", "Windows Autoplay disabled temporarily")
         return current_value
         
     except Exception as e:
-        print(f"Failed to disable Windows Autoplay: {e}")
+        log("device", f"Failed to disable Windows Autoplay: {e}", level="warning")
         return None
 
 def _restore_windows_autoplay(previous_value):
@@ -478,6 +845,7 @@ def _restore_windows_autoplay(previous_value):
         
     try:
         import winreg
+        import ctypes
         
         # 自動再生設定を元に戻す
         key = winreg.OpenKey(winreg.HKEY_CURRENT_USER, r"Software\Microsoft\Windows\CurrentVersion\Explorer\AutoplayHandlers", 0, winreg.KEY_WRITE)
@@ -490,16 +858,18 @@ def _restore_windows_autoplay(previous_value):
         except:
             pass
             
-        print(f"Windows Autoplay setting restored to previous state: {previous_value}")
+        log("device", f"Windows Autoplay setting restored to previous state: {previous_value}")
         
     except Exception as e:
-        print(f"Failed to restore Windows Autoplay setting: {e}")
+        log("device", f"Failed to restore Windows Autoplay setting: {e}", level="warning")
 
-def _prepare_disk_with_diskpart(disk_number, progress_callback=None):
+def _prepare_disk_with_diskpart(disk_number, progress_callback=None, telemetry=None):
     """DiskPartを使用してディスクを準備する"""
+    import tempfile
+    if telemetry is None:
+        telemetry = WriteTelemetry()
     try:
-        if progress_callback:
-            progress_callback(1, "preparing_disk")
+        _enter_phase(telemetry, progress_callback, 1, "preparing_disk")
             
         # 一時ファイルにDiskPartスクリプトを作成
         with tempfile.NamedTemporaryFile(delete=False, suffix='.txt', mode='w') as script:
@@ -508,17 +878,17 @@ def _prepare_disk_with_diskpart(disk_number, progress_callback=None):
             script.write("exit\n")
             script_path = script.name
         
-        if progress_callback:
-            progress_callback(0, "cleaning_disk")
+        _enter_phase(telemetry, progress_callback, 0, "cleaning_disk")
             
         # DiskPartを実行
-        process = subprocess.Popen(
-            ["diskpart", "/s", script_path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        stdout, stderr = process.communicate()
+        with telemetry.span("diskpart clean", cat="subprocess", disk=disk_number):
+            process = subprocess.Popen(
+                ["diskpart", "/s", script_path],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+            stdout, stderr = process.communicate()
         
         # 一時ファイルを削除
         try:
@@ -527,18 +897,17 @@ def _prepare_disk_with_diskpart(disk_number, progress_callback=None):
             pass
         
         if process.returncode != 0:
-            print(f"DiskPart error: {stderr}")
+            log("device", f"DiskPart error: {stderr}", level="error")
             return False
         
-        if progress_callback:
-            progress_callback(0, "disk_prepared")
+        _enter_phase(telemetry, progress_callback, 0, "disk_prepared")
             
         # 操作の成功後、少し待機（ディスクが再スキャンされるのを待つ）
-        time.sleep(2)
+        _sleep(telemetry, 2, "disk rescan")
         return True
         
     except Exception as e:
-        print(f"Error preparing disk with DiskPart: {e}")
+        log("device", f"Error preparing disk with DiskPart: {e}", level="error")
         return False
 
 # テスト実行用
@@ -0,0 +1,216 @@
+"""起動中のサーバーに多数のクライアントから同時にアクセスし、レイテンシを計測する負荷試験
+
+APIクライアント（状態のポーリングやデバイス一覧の取得を繰り返す）と、Socket.IOで進捗を受け取る
+ダッシュボード（Engine.IOのロングポーリング）を指定した数だけ動かし、エンドポイントごとの
+p50/p90/p99レイテンシをJSONで出力する。--write を指定すると、計測中にバッチ書き込みを実行する。
+
+    YAKERU_ASYNC_MODE=eventlet YAKERU_SIM_DEVICES="sim:///tmp/a.img?bw=20M;sim:///tmp/b.img?bw=20M" python app.py
+    python loadtest.py --clients 40 --dashboards 20 --duration 30 \\
+        --write test.iso --devices "sim:///tmp/a.img?bw=20M" "sim:///tmp/b.img?bw=20M"
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.error
+import urllib.request
+
+# APIクライアントが呼び出すエンドポイント（重み付き）
+ENDPOINTS = [
+    ("GET", "/api/write-status", 6),
+    ("GET", "/api/health", 2),
+    ("GET", "/api/batches", 2),
+    ("GET", "/api/isos", 1),
+    ("GET", "/api/usb-devices", 1),
+    ("GET", "/api/metrics", 1),
+]
+# ダッシュボードのロングポーリングのタイムアウト（サーバーのpingIntervalより長く）
+POLL_TIMEOUT = 60
+
+
+def percentile(values, p):
+    """ソート済みの値の最近傍順位法によるパーセンタイル"""
+    if not values:
+        return None
+    rank = max(int(len(values) * p / 100.0 + 0.999999) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def summarize(latencies):
+    values = sorted(latencies)
+    return {
+        "requests": len(values),
+        "p50_ms": _ms(percentile(values, 50)),
+        "p90_ms": _ms(percentile(values, 90)),
+        "p99_ms": _ms(percentile(values, 99)),
+        "max_ms": _ms(values[-1] if values else None),
+    }
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def _request(url, method="GET", body=None, timeout=30):
+    data = None
+    headers = {}
+    if body is not None:
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        headers["Content-Type"] = "text/plain;charset=UTF-8" if isinstance(body, bytes) \
+            else "application/json"
+    request = urllib.request.Request(url, data=data, method=method, headers=headers)
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status, response.read()
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.events = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+    def error(self, name, error):
+        with self._lock:
+            self.errors.setdefault(name, {})
+            key = type(error).__name__ if not isinstance(error, urllib.error.HTTPError) else str(error.code)
+            self.errors[name][key] = self.errors[name].get(key, 0) + 1
+
+    def event(self, name):
+        with self._lock:
+            self.events[name] = self.events.get(name, 0) + 1
+
+
+def api_client(base_url, recorder, stop, think_time, rng):
+    choices = [(method, path) for method, path, weight in ENDPOINTS for _ in range(weight)]
+    while not stop.is_set():
+        method, path = rng.choice(choices)
+        started = time.perf_counter()
+        try:
+            _request(base_url + path, method)
+            recorder.add(path, time.perf_counter() - started)
+        except urllib.error.HTTPError as e:
+            # 423（書き込み中のデバイス一覧）は正常な応答として数える
+            if e.code == 423:
+                recorder.add(path, time.perf_counter() - started)
+            else:
+                recorder.error(path, e)
+        except Exception as e:
+            recorder.error(path, e)
+        if think_time:
+            stop.wait(rng.uniform(0, 2 * think_time))
+
+
+def dashboard(base_url, recorder, stop):
+    """Engine.IO（v4）のロングポーリングでSocket.IOに接続し、受け取ったイベントを数える"""
+    url = base_url + "/socket.io/?EIO=4&transport=polling"
+    try:
+        started = time.perf_counter()
+        _, body = _request(url)
+        recorder.add("socket.io handshake", time.perf_counter() - started)
+        sid = json.loads(body.decode()[1:])["sid"]
+        url += f"&sid={sid}"
+        _request(url, "POST", b"40")
+        while not stop.is_set():
+            _, body = _request(url, timeout=POLL_TIMEOUT)
+            for packet in body.decode().split("\x1e"):
+                if packet == "2":
+                    _request(url, "POST", b"3")
+                elif packet.startswith("42"):
+                    recorder.event(json.loads(packet[2:])[0])
+                elif packet == "1":
+                    return
+    except Exception as e:
+        if not stop.is_set():
+            recorder.error("socket.io", e)
+
+
+def start_batch(base_url, iso_file, devices):
+    manifest = {"items": [{"iso_file": iso_file, "devices": devices}], "max_concurrent": len(devices)}
+    _, body = _request(base_url + "/api/batches", "POST", manifest)
+    return json.loads(body)["batch_id"]
+
+
+def run(args):
+    base_url = args.url.rstrip("/")
+    recorder = Recorder()
+    stop = threading.Event()
+    threads = []
+    for i in range(args.dashboards):
+        threads.append(threading.Thread(target=dashboard, args=(base_url, recorder, stop), daemon=True))
+    for i in range(args.clients):
+        threads.append(threading.Thread(
+            target=api_client, args=(base_url, recorder, stop, args.think_ms / 1000.0, random.Random(i)),
+            daemon=True))
+    for thread in threads:
+        thread.start()
+
+    batch_id = None
+    if args.write:
+        batch_id = start_batch(base_url, args.write, args.devices)
+        print(f"Started batch {batch_id} on {len(args.devices)} devices", file=sys.stderr)
+
+    started = time.monotonic()
+    stop.wait(args.duration)
+    stop.set()
+    elapsed = time.monotonic() - started
+    for thread in threads:
+        thread.join(timeout=1)
+
+    batch_state = None
+    if batch_id:
+        _, body = _request(f"{base_url}/api/batches/{batch_id}")
+        snapshot = json.loads(body)
+        batch_state = {key: snapshot[key] for key in ("state", "percent", "jobs_by_state")}
+
+    all_latencies = [value for name, values in recorder.latencies.items()
+                     if name.startswith("/") for value in values]
+    return {
+        "url": base_url,
+        "clients": args.clients,
+        "dashboards": args.dashboards,
+        "duration_seconds": round(elapsed, 1),
+        "requests_per_second": round(len(all_latencies) / elapsed, 1) if elapsed else None,
+        "overall": summarize(all_latencies),
+        "endpoints": {name: summarize(values) for name, values in sorted(recorder.latencies.items())},
+        "errors": recorder.errors,
+        "events_received": recorder.events,
+        "batch": batch_state,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Yakeru-USB API latency load test")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--clients", type=int, default=20, help="concurrent API clients")
+    parser.add_argument("--dashboards", type=int, default=10,
+                        help="concurrent Socket.IO (long-polling) dashboards")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds to run")
+    parser.add_argument("--think-ms", type=float, default=50.0,
+                        help="average pause between requests of one client")
+    parser.add_argument("--write", metavar="ISO_FILE",
+                        help="start a batch writing this ISO (in the server's isos directory)")
+    parser.add_argument("--devices", nargs="*", default=[], help="devices for --write")
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args()
+    if args.write and not args.devices:
+        parser.error("--write requires --devices")
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,246 @@
+"""キューを使った構造化ログ
+
+log() はレコード（辞書）をキューに入れるだけで戻り、バックグラウンドのスレッドがまとめて書き出す。
+書き込みループやリクエスト処理はログの出力先（端末・パイプ・ファイル）の遅さに引きずられない。
+
+- レコードはJSON Lines（YAKERU_LOG_FORMAT=text で人が読む形式）で、job_id・deviceなどのフィールドを持つ
+- context() で囲んだ範囲のレコードには、そのjob_id・deviceが自動で付く
+- カテゴリごとにサンプリング率（info以下）と1秒あたりの上限（error以外）を設定でき、
+  上限を超えて捨てた件数は定期的にまとめて記録する
+- キューがあふれた場合は、待たずにレコードを捨てて件数を数える
+"""
+import os
+import sys
+import json
+import time
+import queue
+import random
+import atexit
+import threading
+import contextvars
+from contextlib import contextmanager
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40, "off": 100}
+
+
+def _parse_map(text, cast=float):
+    """'progress=0.1,request=0.5' のような設定を辞書にする"""
+    result = {}
+    for item in (text or "").split(","):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            result[key.strip()] = cast(value)
+    return result
+
+
+# 出力する最低レベルと形式
+LOG_LEVEL = os.environ.get("YAKERU_LOG_LEVEL", "info")
+LOG_FORMAT = os.environ.get("YAKERU_LOG_FORMAT", "json")
+# 出力先のファイル（未指定なら標準出力）
+LOG_FILE = os.environ.get("YAKERU_LOG_FILE")
+# カテゴリごとのサンプリング率（0.0〜1.0、既定1.0）と1秒あたりの上限（既定DEFAULT_RATE_LIMIT）
+CATEGORY_SAMPLING = _parse_map(os.environ.get("YAKERU_LOG_SAMPLING"))
+CATEGORY_RATE_LIMITS = dict({"progress": 20.0, "request": 50.0, "retry": 20.0},
+                            **_parse_map(os.environ.get("YAKERU_LOG_RATE_LIMITS")))
+DEFAULT_RATE_LIMIT = 200.0
+# キューに溜められるレコード数
+QUEUE_SIZE = 10000
+# 書き出しの間隔と、上限を超えて捨てた件数を記録する間隔（秒）
+FLUSH_INTERVAL = 0.2
+SUPPRESSION_REPORT_INTERVAL = 10.0
+
+_context = contextvars.ContextVar("log_context", default={})
+
+
+class _RateLimiter:
+    """カテゴリごとのトークンバケット（1秒分までため込める）"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def allow(self, now):
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+class LogPipeline:
+    def __init__(self, stream=None, level=LOG_LEVEL, fmt=LOG_FORMAT, sampling=None, rate_limits=None):
+        self.stream = stream
+        self.level = LEVELS[level]
+        self.format = fmt
+        self.sampling = dict(CATEGORY_SAMPLING if sampling is None else sampling)
+        self.rate_limits = dict(CATEGORY_RATE_LIMITS if rate_limits is None else rate_limits)
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._limiters = {}
+        self._suppressed = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.written = 0
+        self.dropped = 0      # キューがあふれて捨てた件数
+        self.sampled_out = 0  # サンプリングで間引いた件数
+        self.rate_limited = 0
+
+    def log(self, category, message, level="info", **fields):
+        severity = LEVELS[level]
+        if severity < self.level:
+            return
+        # 警告・エラーはサンプリングせず、エラーは上限も適用しない
+        if severity < LEVELS["warning"]:
+            rate = self.sampling.get(category, 1.0)
+            if rate < 1.0 and random.random() >= rate:
+                self.sampled_out += 1
+                return
+        if severity < LEVELS["error"] and not self._allow(category):
+            return
+        record = {"ts": round(time.time(), 3), "level": level, "cat": category, "msg": message}
+        record.update(_context.get())
+        record.update(fields)
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _allow(self, category):
+        now = time.monotonic()
+        with self._lock:
+            limiter = self._limiters.get(category)
+            if limiter is None:
+                limiter = self._limiters[category] = _RateLimiter(
+                    self.rate_limits.get(category, DEFAULT_RATE_LIMIT))
+            if limiter.allow(now):
+                return True
+            self._suppressed[category] = self._suppressed.get(category, 0) + 1
+            self.rate_limited += 1
+            return False
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        last_report = time.monotonic()
+        while True:
+            try:
+                items = [self._queue.get(timeout=FLUSH_INTERVAL)]
+            except queue.Empty:
+                items = []
+            # 溜まっている分はまとめて書き出す
+            while len(items) < QUEUE_SIZE:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            now = time.monotonic()
+            if now - last_report >= SUPPRESSION_REPORT_INTERVAL:
+                last_report = now
+                items.extend(self._suppression_records())
+            self._write([item for item in items if isinstance(item, dict)])
+            for item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _suppression_records(self):
+        with self._lock:
+            suppressed, self._suppressed = self._suppressed, {}
+        return [{"ts": round(time.time(), 3), "level": "warning", "cat": "log",
+                 "msg": f"Suppressed {count} {category} records (rate limit)",
+                 "category": category, "suppressed": count}
+                for category, count in sorted(suppressed.items())]
+
+    def _write(self, records):
+        if not records:
+            return
+        lines = "".join(self._format(record) + "\n" for record in records)
+        try:
+            stream = self.stream or sys.stdout
+            stream.write(lines)
+            stream.flush()
+            self.written += len(records)
+        except (OSError, ValueError):
+            self.dropped += len(records)
+
+    def _format(self, record):
+        if self.format != "text":
+            return json.dumps(record, ensure_ascii=False, default=str)
+        extra = {k: v for k, v in record.items() if k not in ("ts", "level", "cat", "msg", "job_id")}
+        prefix = f"[{record['job_id']}] " if record.get("job_id") else ""
+        suffix = " " + " ".join(f"{k}={v}" for k, v in extra.items()) if extra else ""
+        stamp = time.strftime("%H:%M:%S", time.localtime(record["ts"]))
+        return f"{stamp} {record['level'].upper():7} {record['cat']}: {prefix}{record['msg']}{suffix}"
+
+    def flush(self, timeout=2.0):
+        """キューに入っているレコードを書き出し終わるまで待つ"""
+        if self._thread is None:
+            return
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def stats(self):
+        return {
+            "written": self.written,
+            "queued": self._queue.qsize(),
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "rate_limited": self.rate_limited,
+        }
+
+
+_pipeline = LogPipeline(open(LOG_FILE, 'a', encoding='utf-8') if LOG_FILE else None)
+atexit.register(_pipeline.flush)
+
+
+def log(category, message, level="info", **fields):
+    """構造化ログを記録する（キューに入れるだけで、出力を待たない）"""
+    _pipeline.log(category, message, level, **fields)
+
+
+def bind(**fields):
+    """以降にこのスレッドで記録するレコードにjob_id・deviceなどのフィールドを付ける（unbindで戻す）"""
+    return _context.set(dict(_context.get(), **fields))
+
+
+def unbind(token):
+    _context.reset(token)
+
+
+@contextmanager
+def context(**fields):
+    """この範囲で記録するレコードにフィールドを付ける"""
+    token = bind(**fields)
+    try:
+        yield
+    finally:
+        unbind(token)
+
+
+def configure(stream=None, level=None, fmt=None):
+    """出力先・レベル・形式を変更する（CLIなど）"""
+    _pipeline.flush()
+    if stream is not None:
+        _pipeline.stream = stream
+    if level is not None:
+        _pipeline.level = LEVELS[level]
+    if fmt is not None:
+        _pipeline.format = fmt
+
+
+def flush(timeout=2.0):
+    _pipeline.flush(timeout)
+
+
+def stats():
+    return _pipeline.stats()
@@ -0,0 +1,244 @@
+import bisect
+import threading
+import time
+
+MB = 1024 * 1024
+
+# 既定のレイテンシ用バケット（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """メトリクスの共通処理（ラベルごとの値を保持する）"""
+    type_name = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    """単調増加するカウンタ"""
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("Counter can only increase")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """任意に増減する値"""
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """累積バケット形式のヒストグラム"""
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        """withブロックの所要時間を記録するコンテキストマネージャ"""
+        return _Timer(self, labels)
+
+    def _render_sample(self, key, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames + ("le",), key + (_format_value(float(bound)),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        base = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{base} {_format_value(total)}")
+        lines.append(f"{self.name}_count{base} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Registry:
+    """メトリクスをまとめてPrometheusテキスト形式で出力する"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# ---- Yakeru-USB のメトリクス定義 ----
+
+HTTP_REQUEST_LATENCY = REGISTRY.register(Histogram(
+    "yakeru_http_request_duration_seconds", "HTTP request latency by route",
+    ("method", "route", "status")))
+DEVICE_SCAN_LATENCY = REGISTRY.register(Histogram(
+    "yakeru_device_scan_duration_seconds", "USB device scan latency", ("source",)))
+JOBS_BY_STATE = REGISTRY.register(Gauge(
+    "yakeru_jobs", "Recent write jobs by state", ("state",)))
+BYTES_WRITTEN = REGISTRY.register(Counter(
+    "yakeru_bytes_written_total", "Bytes written by finished jobs", ("device",)))
+ACTIVE_BYTES_WRITTEN = REGISTRY.register(Gauge(
+    "yakeru_active_job_bytes_written", "Bytes written so far by running jobs", ("job_id", "device")))
+WRITE_THROUGHPUT = REGISTRY.register(Histogram(
+    "yakeru_write_throughput_mbps", "Average write throughput of finished jobs (MB/s)",
+    ("device",), buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 200, 400)))
+WRITE_PHASE_DURATION = REGISTRY.register(Histogram(
+    "yakeru_write_phase_duration_seconds", "Time spent in each write phase",
+    ("phase",), buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)))
+WRITE_RETRIES = REGISTRY.register(Counter(
+    "yakeru_write_retries_total", "Write retries", ("device",)))
+JOBS_FINISHED = REGISTRY.register(Counter(
+    "yakeru_jobs_finished_total", "Finished write jobs by result", ("result",)))
+BUFFER_POOL_BYTES = REGISTRY.register(Gauge(
+    "yakeru_buffer_pool_bytes", "Write buffer pool memory by state", ("state",)))
+BUFFER_POOL_WAITING = REGISTRY.register(Gauge(
+    "yakeru_buffer_pool_waiting_jobs", "Jobs waiting for a write buffer"))
+LOG_RECORDS = REGISTRY.register(Gauge(
+    "yakeru_log_records", "Log records by outcome since startup", ("outcome",)))
+LOG_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "yakeru_log_queue_depth", "Log records waiting for the writer thread"))
+
+
+def job_state(status):
+    """ステータス文字列をメトリクス用の状態名に正規化する"""
+    if not status:
+        return "unknown"
+    if status.startswith("error"):
+        return "error"
+    if status.startswith("writing"):
+        return "writing"
+    return status
+
+
+def observe_write_job(telemetry):
+    """終了したジョブのテレメトリを集計する（書き込みループには触れない）"""
+    device = telemetry.device or "unknown"
+    state = job_state(telemetry.status)
+    # 再開したジョブは、中断前のジョブが書いてすでに数えた範囲を含めない
+    written = telemetry.bytes_written - telemetry.resumed_from
+    BYTES_WRITTEN.inc(written, device=device)
+    if telemetry.retries:
+        WRITE_RETRIES.inc(telemetry.retries, device=device)
+    JOBS_FINISHED.inc(result=state)
+    if state == "completed" and written > 0:
+        WRITE_THROUGHPUT.observe(telemetry.average_rate() / MB, device=device)
+    for phase, seconds in telemetry.phase_times.items():
+        WRITE_PHASE_DURATION.observe(seconds, phase=phase)
+
+
+def update_job_gauges(jobs):
+    """スクレイプ時にジョブ状態と実行中ジョブの書き込み量を更新する"""
+    counts = {}
+    ACTIVE_BYTES_WRITTEN.clear()
+    for telemetry in jobs:
+        state = job_state(telemetry.status)
+        counts[state] = counts.get(state, 0) + 1
+        if state not in ("completed", "error"):
+            ACTIVE_BYTES_WRITTEN.set(telemetry.bytes_written, job_id=telemetry.job_id,
+                                     device=telemetry.device or "unknown")
+    JOBS_BY_STATE.clear()
+    for state, count in counts.items():
+        JOBS_BY_STATE.set(count, state=state)
+
+
+def update_buffer_pool_gauges(status):
+    """スクレイプ時に書き込みバッファプールの使用量を更新する"""
+    BUFFER_POOL_BYTES.set(status["budget_bytes"], state="budget")
+    BUFFER_POOL_BYTES.set(status["allocated_bytes"], state="allocated")
+    BUFFER_POOL_BYTES.set(status["in_use_bytes"], state="in_use")
+    BUFFER_POOL_WAITING.set(status["waiting_jobs"])
+
+
+def update_log_gauges(stats):
+    """スクレイプ時にログの書き出し・破棄の件数を更新する"""
+    for outcome in ("written", "dropped", "sampled_out", "rate_limited"):
+        LOG_RECORDS.set(stats[outcome], outcome=outcome)
+    LOG_QUEUE_DEPTH.set(stats["queued"])
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,155 @@
+"""書き込み後の抜き取り検証
+
+全体を読み直す代わりに、ランダムに選んだブロックだけをデバイスから読み戻してイメージと照合する。
+先頭と末尾（MBR・GPTとバックアップGPT）と各パーティションの先頭は必ず検証する。
+
+ランダムに選ぶブロック数nは、「ブロックの割合p以上が壊れていれば、確率C以上でどれかを検出する」
+ように決める: (1 - p)^n <= 1 - C  より  n = ln(1 - C) / ln(1 - p)
+"""
+import os
+import math
+import time
+import random
+import struct
+import device_io
+import http_source
+import buffer_pool
+import image_cache
+from log_pipeline import log
+
+MB = 1024 * 1024
+
+# 検出したい不良ブロックの割合と、その場合に検出できる確率
+VERIFY_CONFIDENCE = float(os.environ.get("YAKERU_VERIFY_CONFIDENCE", "0.99"))
+VERIFY_DEFECT_RATE = float(os.environ.get("YAKERU_VERIFY_DEFECT_RATE", "0.005"))
+# 照合する単位（O_DIRECTで読めるよう4096の倍数）
+SAMPLE_BLOCK_SIZE = int(os.environ.get("YAKERU_VERIFY_BLOCK_KB", "64")) * 1024
+# 必ず検証するイメージの先頭と末尾の範囲
+EDGE_SIZE = MB
+# 記録する不一致の件数
+MAX_REPORTED_MISMATCHES = 16
+
+SECTOR_SIZE = 512
+
+
+def sample_size(confidence=VERIFY_CONFIDENCE, defect_rate=VERIFY_DEFECT_RATE):
+    """不良ブロックの割合defect_rateを確率confidenceで検出するのに必要なブロック数"""
+    if not 0 < confidence < 1 or not 0 < defect_rate < 1:
+        raise ValueError("confidence and defect_rate must be between 0 and 1")
+    return math.ceil(math.log(1 - confidence) / math.log(1 - defect_rate))
+
+
+def partition_offsets(read_at, size):
+    """イメージのMBR・GPTからパーティションテーブルと各パーティションの先頭のオフセットを集める
+
+    read_at(offset, length)でイメージを読む。解析できない部分は無視する
+    """
+    offsets = []
+    mbr = read_at(0, SECTOR_SIZE)
+    if len(mbr) == SECTOR_SIZE and mbr[510:512] == b"\x55\xaa":
+        for i in range(4):
+            entry = mbr[446 + i * 16:446 + (i + 1) * 16]
+            part_type = entry[4]
+            start_lba = struct.unpack_from("<I", entry, 8)[0]
+            if part_type and start_lba:
+                offsets.append(start_lba * SECTOR_SIZE)
+
+    header = read_at(SECTOR_SIZE, 92)
+    if len(header) == 92 and header[:8] == b"EFI PART":
+        backup_lba, = struct.unpack_from("<Q", header, 32)
+        entries_lba, count, entry_size = struct.unpack_from("<QII", header, 72)
+        offsets.append(backup_lba * SECTOR_SIZE)
+        offsets.append(entries_lba * SECTOR_SIZE)
+        if entry_size >= 48 and count <= 1024:
+            entries = read_at(entries_lba * SECTOR_SIZE, count * entry_size)
+            for i in range(len(entries) // entry_size):
+                entry = entries[i * entry_size:(i + 1) * entry_size]
+                if entry[:16] != b"\x00" * 16:
+                    offsets.append(struct.unpack_from("<Q", entry, 32)[0] * SECTOR_SIZE)
+    return sorted({offset for offset in offsets if 0 <= offset < size})
+
+
+def choose_blocks(size, block_size, count, required_offsets=(), rng=None):
+    """必ず検証するブロックと、残りからランダムに選んだcount個のブロックの番号を返す"""
+    rng = rng or random.SystemRandom()
+    total = (size + block_size - 1) // block_size
+    required = set()
+    for start, end in ((0, min(EDGE_SIZE, size)), (max(size - EDGE_SIZE, 0), size)):
+        required.update(range(start // block_size, (end + block_size - 1) // block_size))
+    required.update(offset // block_size for offset in required_offsets)
+    required = {block for block in required if block < total}
+
+    remaining = total - len(required)
+    count = min(count, remaining)
+    sampled = set()
+    if count == remaining:
+        sampled = set(range(total)) - required
+    else:
+        while len(sampled) < count:
+            block = rng.randrange(total)
+            if block not in required:
+                sampled.add(block)
+    return sorted(required), sorted(sampled), total
+
+
+def verify_sample(iso_path, device_path, confidence=None, defect_rate=None,
+                  block_size=SAMPLE_BLOCK_SIZE, telemetry=None, rng=None):
+    """デバイスに書き込まれた内容を抜き取りで照合し、結果と検証範囲を返す"""
+    confidence = VERIFY_CONFIDENCE if confidence is None else float(confidence)
+    defect_rate = VERIFY_DEFECT_RATE if defect_rate is None else float(defect_rate)
+    started = time.monotonic()
+    count = sample_size(confidence, defect_rate)
+
+    with image_cache.peek_image(iso_path) as image:
+        size = image.size
+
+        def read_image(offset, length):
+            length = max(min(length, size - offset), 0)
+            if http_source.is_url(iso_path):
+                return http_source.read_range(iso_path, offset, length)
+            image.seek(offset)
+            return bytes(image.read(length))
+
+        required, sampled, total = choose_blocks(size, block_size, count,
+                                                 partition_offsets(read_image, size), rng)
+        blocks = sorted(required + sampled)
+
+        buffer = buffer_pool.get_pool().acquire(block_size)
+        device, direct = device_io.open_uncached(device_path)
+        mismatches = []
+        try:
+            view = buffer.view[:block_size]
+            for block in blocks:
+                offset = block * block_size
+                length = min(block_size, size - offset)
+                if not direct:
+                    device.drop_cache(offset, length)
+                # O_DIRECTでは長さもブロック単位にそろえる必要があるため、常にブロック全体を読む
+                actual = view[:device.preadinto(view, offset)][:length]
+                if actual != read_image(offset, length):
+                    mismatches.append(offset)
+                    if telemetry is not None:
+                        telemetry.instant("verify mismatch", cat="verify", offset=offset)
+        finally:
+            device.close()
+            buffer.release()
+
+    sampled_bytes = sum(min(block_size, size - block * block_size) for block in blocks)
+    report = {
+        "verified": not mismatches,
+        "confidence": confidence,
+        "defect_rate": defect_rate,
+        "block_size": block_size,
+        "total_blocks": total,
+        "required_blocks": len(required),
+        "sampled_blocks": len(sampled),
+        "verified_bytes": sampled_bytes,
+        "coverage_percent": round(sampled_bytes * 100.0 / size, 3) if size else 100.0,
+        "direct_io": direct,
+        "mismatches": len(mismatches),
+        "mismatch_offsets": mismatches[:MAX_REPORTED_MISMATCHES],
+        "seconds": round(time.monotonic() - started, 3),
+    }
+    log("verify", f"Sampled verification of {device_path}: {len(blocks)}/{total} blocks "
+        f"({report['coverage_percent']}%), {len(mismatches)} mismatches in {report['seconds']}s")
+    return report
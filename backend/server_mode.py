@@ -0,0 +1,83 @@
+"""サーバーの並行処理モデル（YAKERU_ASYNC_MODE）
+
+threading（既定）: Flask-SocketIOの開発用サーバー。リクエストごとにスレッドを使う。
+eventlet: 本番用。グリーンスレッドで多数のダッシュボードやAPIクライアントの接続を受け付ける。
+  イベントループを止めないよう、ブロックする処理（サブプロセス、ディスクI/O）は run_blocking で
+  ネイティブスレッドのプールに回し、書き込みジョブは spawn_worker でネイティブスレッドとして動かす。
+  ワーカースレッドからのSocket.IOイベントはキューに入れ、イベントループ側のタスクが送る。
+"""
+import os
+import queue
+import threading
+from log_pipeline import log
+
+ASYNC_MODES = ("threading", "eventlet")
+ASYNC_MODE = os.environ.get("YAKERU_ASYNC_MODE", "threading")
+if ASYNC_MODE not in ASYNC_MODES:
+    raise ValueError(f"YAKERU_ASYNC_MODE must be one of {', '.join(ASYNC_MODES)}")
+# run_blockingで使うネイティブスレッドの数
+BLOCKING_THREADS = int(os.environ.get("YAKERU_BLOCKING_THREADS", "20"))
+# ワーカースレッドからのイベントを確認する間隔（秒）
+EMIT_INTERVAL = 0.05
+
+
+def is_async():
+    return ASYNC_MODE != "threading"
+
+
+def monkey_patch():
+    """標準ライブラリをグリーンスレッド対応にする（app.pyで他のモジュールより先に呼ぶ）"""
+    if ASYNC_MODE == "eventlet":
+        os.environ.setdefault("EVENTLET_THREADPOOL_SIZE", str(BLOCKING_THREADS))
+        import eventlet
+        # ロックやキューは書き込みジョブのスレッドとイベントループで共有するため、threadingはネイティブのままにする
+        eventlet.monkey_patch(thread=False)
+
+
+def run_blocking(func, *args, **kwargs):
+    """ブロックする処理を実行する（eventletではスレッドプールで実行し、その間ほかの接続を処理する）"""
+    if ASYNC_MODE == "eventlet":
+        from eventlet import tpool
+        return tpool.execute(func, *args, **kwargs)
+    return func(*args, **kwargs)
+
+
+def spawn_worker(func, *args):
+    """書き込みジョブなどの長時間の処理をネイティブスレッドで開始する"""
+    thread = threading.Thread(target=func, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+class Emitter:
+    """どのスレッドからでもSocket.IOイベントを送れるようにする"""
+
+    def __init__(self, socketio):
+        self.socketio = socketio
+        self._queue = queue.Queue()
+        self._loop_thread = None
+
+    def start(self):
+        """イベントループ側の送信タスクを開始する（eventletのみ。socketio.runの前に呼ぶ）"""
+        if not is_async():
+            return
+        self._loop_thread = threading.get_ident()
+        self.socketio.start_background_task(self._drain)
+
+    def emit(self, event, data):
+        if self._loop_thread is None or threading.get_ident() == self._loop_thread:
+            self.socketio.emit(event, data)
+        else:
+            self._queue.put((event, data))
+
+    def _drain(self):
+        while True:
+            try:
+                event, data = self._queue.get_nowait()
+            except queue.Empty:
+                self.socketio.sleep(EMIT_INTERVAL)
+                continue
+            try:
+                self.socketio.emit(event, data)
+            except Exception as e:
+                log("socketio", f"Failed to emit {event}: {e}", level="warning")
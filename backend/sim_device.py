@@ -0,0 +1,330 @@
+"""テスト用のシミュレートされたブロックデバイス
+
+device_path に sim:// URI を指定すると、実際のUSBメモリの代わりに
+通常ファイルをバックエンドとした疑似デバイスに書き込む。
+
+    sim:///tmp/stick.img?bw=20M&latency=2ms&eio=64M,128M&remove_at=1G&capacity=8G&real_capacity=2G
+
+パラメータ:
+    bw             帯域幅の上限（バイト/秒、K/M/G 接尾辞可）
+    latency        書き込み1回ごとの遅延（ms/s 接尾辞可）
+    eio            EIOを返すオフセット（カンマ区切り）
+    eio_count      各オフセットでEIOを返す回数（既定1、0なら常に失敗）
+    remove_at      このオフセットに達した時点でデバイスが取り外されたことにする
+    capacity       報告する容量（超えた書き込みはENOSPC）
+    real_capacity  実際の容量。超えた位置への書き込みは先頭に折り返す（容量偽装USBの再現）
+    max_write      1回の書き込みで受け付ける最大バイト数（部分書き込みの再現）
+    bus            接続しているUSBバスの名前（同じ名前の疑似デバイスは帯域を共有する）
+    bus_bw         バス全体の帯域幅の上限（同じバスの全デバイスの合計）
+    logical_sector / physical_sector / optimal_io
+                   報告するセクタサイズと最適なI/Oサイズ（既定は512・512・報告なし）
+"""
+import os
+import errno
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+SCHEME = "sim://"
+
+# 同じURIを開いたハンドル間でEIOの残り回数や取り外し状態を共有する
+_states = {}
+_states_lock = threading.Lock()
+# バス名 -> 帯域を共有するための状態
+_buses = {}
+
+
+def is_simulated(device_path):
+    return isinstance(device_path, str) and device_path.startswith(SCHEME)
+
+
+def _parse_size(text):
+    text = text.strip().upper()
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def _parse_duration(text):
+    text = text.strip().lower()
+    if text.endswith("ms"):
+        return float(text[:-2]) / 1000.0
+    if text.endswith("s"):
+        return float(text[:-1])
+    return float(text)
+
+
+class SimulatedDeviceState:
+    """URIごとの疑似デバイスの設定と状態"""
+
+    def __init__(self, uri):
+        parsed = urlparse(uri)
+        self.uri = uri
+        self.backing_path = parsed.path
+        params = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+
+        self.bandwidth = _parse_size(params["bw"]) if "bw" in params else None
+        self.latency = _parse_duration(params["latency"]) if "latency" in params else 0.0
+        eio_count = int(params.get("eio_count", "1"))
+        self.eio_remaining = {}
+        for item in filter(None, params.get("eio", "").split(",")):
+            # 0は「常に失敗」を表す
+            self.eio_remaining[_parse_size(item)] = eio_count if eio_count > 0 else -1
+        self.remove_at = _parse_size(params["remove_at"]) if "remove_at" in params else None
+        self.capacity = _parse_size(params["capacity"]) if "capacity" in params else None
+        self.real_capacity = _parse_size(params["real_capacity"]) if "real_capacity" in params else None
+        self.max_write = _parse_size(params["max_write"]) if "max_write" in params else None
+        self.bus = params.get("bus")
+        self.bus_bandwidth = _parse_size(params["bus_bw"]) if "bus_bw" in params else None
+        self.logical_sector = _parse_size(params.get("logical_sector", "512"))
+        self.physical_sector = _parse_size(params.get("physical_sector", str(self.logical_sector)))
+        self.optimal_io = _parse_size(params["optimal_io"]) if "optimal_io" in params else None
+
+        self.removed = False
+        self.lock = threading.Lock()
+        self.stats = {"writes": 0, "bytes_written": 0, "reads": 0, "bytes_read": 0,
+                      "eio_injected": 0, "short_writes": 0, "throttle_seconds": 0.0}
+        self._throttle_until = time.monotonic()
+
+    def reported_capacity(self):
+        if self.capacity is not None:
+            return self.capacity
+        try:
+            return os.path.getsize(self.backing_path)
+        except OSError:
+            return 0
+
+
+def _state(uri):
+    with _states_lock:
+        state = _states.get(uri)
+        if state is None:
+            state = _states[uri] = SimulatedDeviceState(uri)
+        return state
+
+
+def _bus(name):
+    with _states_lock:
+        bus = _buses.get(name)
+        if bus is None:
+            bus = _buses[name] = {"lock": threading.Lock(), "throttle_until": time.monotonic()}
+        return bus
+
+
+def device_bus(uri):
+    """疑似デバイスのバス名（指定がなければNone）"""
+    return _state(uri).bus
+
+
+def reset(uri=None):
+    """疑似デバイスの状態（EIO残り回数・取り外し状態・統計）を初期化する"""
+    with _states_lock:
+        if uri is None:
+            _states.clear()
+        else:
+            _states.pop(uri, None)
+
+
+def reinsert(uri):
+    """取り外された疑似デバイスを再接続した状態に戻す"""
+    state = _state(uri)
+    state.removed = False
+    state.remove_at = None
+
+
+def get_stats(uri):
+    return dict(_state(uri).stats)
+
+
+class SimulatedDevice:
+    """疑似デバイスのハンドル（device_io.BlockDeviceと同じインターフェース）"""
+
+    def __init__(self, uri, truncate=False):
+        self.path = uri
+        self.state = _state(uri)
+        backing_dir = os.path.dirname(self.state.backing_path)
+        if backing_dir:
+            os.makedirs(backing_dir, exist_ok=True)
+        flags = os.O_RDWR | os.O_CREAT
+        self.fd = os.open(self.state.backing_path, flags, 0o644)
+        if truncate:
+            os.ftruncate(self.fd, 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def _check_present(self):
+        if self.state.removed:
+            raise OSError(errno.ENODEV, "Simulated device removed", self.path)
+
+    def _physical_offset(self, offset):
+        # 容量偽装USB: 実容量を超えた位置は先頭に折り返す
+        real = self.state.real_capacity
+        return offset % real if real else offset
+
+    def _throttle(self, length):
+        state = self.state
+        delay = state.latency
+        if state.bandwidth:
+            with state.lock:
+                now = time.monotonic()
+                start = max(now, state._throttle_until)
+                state._throttle_until = start + length / state.bandwidth
+                delay += state._throttle_until - now
+        if state.bus and state.bus_bandwidth:
+            # 同じバスの全デバイスで帯域を分け合う
+            bus = _bus(state.bus)
+            with bus["lock"]:
+                now = time.monotonic()
+                start = max(now, bus["throttle_until"])
+                bus["throttle_until"] = start + length / state.bus_bandwidth
+                delay = max(delay, bus["throttle_until"] - now)
+        if delay > 0:
+            state.stats["throttle_seconds"] += delay
+            time.sleep(delay)
+
+    def pwrite(self, data, offset):
+        """offsetにdataを書き込み、書き込んだバイト数を返す"""
+        state = self.state
+        self._check_present()
+        view = memoryview(data)
+        length = len(view)
+
+        capacity = state.capacity
+        if capacity is not None:
+            if offset >= capacity:
+                raise OSError(errno.ENOSPC, "No space left on simulated device", self.path)
+            length = min(length, capacity - offset)
+
+        if state.remove_at is not None and offset + length > state.remove_at:
+            if offset >= state.remove_at:
+                state.removed = True
+                raise OSError(errno.ENODEV, "Simulated device removed", self.path)
+            length = state.remove_at - offset
+
+        # 範囲内に不良オフセットがあれば、その手前までを部分書き込みし、次の呼び出しでEIOを返す
+        with state.lock:
+            hits = [bad for bad, remaining in state.eio_remaining.items()
+                    if remaining != 0 and offset <= bad < offset + length]
+            if hits:
+                bad = min(hits)
+                if bad > offset:
+                    length = bad - offset
+                else:
+                    if state.eio_remaining[bad] > 0:
+                        state.eio_remaining[bad] -= 1
+                    state.stats["eio_injected"] += 1
+                    raise OSError(errno.EIO, "Simulated I/O error", self.path)
+
+        if state.max_write is not None:
+            length = min(length, state.max_write)
+
+        self._throttle(length)
+        chunk = view[:length]
+        physical = self._physical_offset(offset)
+        real = state.real_capacity
+        if real and physical + length > real:
+            # 折り返し地点をまたぐ書き込み
+            first = real - physical
+            os.pwrite(self.fd, chunk[:first], physical)
+            os.pwrite(self.fd, chunk[first:], 0)
+        else:
+            os.pwrite(self.fd, chunk, physical)
+
+        state.stats["writes"] += 1
+        state.stats["bytes_written"] += length
+        if length < len(view):
+            state.stats["short_writes"] += 1
+        return length
+
+    def pread(self, length, offset):
+        self._check_present()
+        state = self.state
+        if state.capacity is not None:
+            length = max(min(length, state.capacity - offset), 0)
+        physical = self._physical_offset(offset)
+        real = state.real_capacity
+        if real and physical + length > real:
+            first = real - physical
+            data = os.pread(self.fd, first, physical) + os.pread(self.fd, length - first, 0)
+        else:
+            data = os.pread(self.fd, length, physical)
+        state.stats["reads"] += 1
+        state.stats["bytes_read"] += len(data)
+        return data
+
+    def preadinto(self, buffer, offset):
+        data = self.pread(len(buffer), offset)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def fsync(self):
+        self._check_present()
+        os.fsync(self.fd)
+
+    def discard(self, offset, length):
+        raise OSError(errno.EOPNOTSUPP, "Discard is not supported by simulated devices")
+
+    def zeroout(self, offset, length):
+        raise OSError(errno.EOPNOTSUPP, "Zeroout is not supported by simulated devices")
+
+    def drop_cache(self, offset=0, length=0):
+        # 疑似デバイスは常にバックエンドのファイルから読むため何もしない
+        pass
+
+    def disable_direct_io(self):
+        pass
+
+    def size(self):
+        return self.state.reported_capacity()
+
+    def present(self):
+        return not self.state.removed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def geometry(uri):
+    """疑似デバイスの容量とセクタサイズ（capacityを指定しなければ容量の上限はないためNone）"""
+    state = _state(uri)
+    return {
+        "size_bytes": state.capacity,
+        "logical_sector_size": state.logical_sector,
+        "physical_sector_size": state.physical_sector,
+        "minimum_io_size": state.physical_sector,
+        "optimal_io_size": state.optimal_io,
+    }
+
+
+def open_device(uri, truncate=False):
+    return SimulatedDevice(uri, truncate=truncate)
+
+
+def list_simulated_devices():
+    """環境変数 YAKERU_SIM_DEVICES（;区切りのsim:// URI）に指定された疑似デバイスの一覧"""
+    devices = []
+    for uri in filter(None, os.environ.get("YAKERU_SIM_DEVICES", "").split(";")):
+        uri = uri.strip()
+        if not is_simulated(uri):
+            continue
+        state = _state(uri)
+        if state.removed:
+            continue
+        size = state.reported_capacity()
+        devices.append({
+            "id": uri,
+            "name": f"Simulated Device ({os.path.basename(state.backing_path)})",
+            "size": f"{size // (1024 ** 2)} MB",
+            "vendor": "Simulated",
+            "mountpoint": None,
+            "bus": state.bus
+        })
+    return devices
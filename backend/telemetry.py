@@ -0,0 +1,283 @@
+import os
+import time
+import threading
+from log_pipeline import log
+
+# 標準出力へのログ出力間隔（秒）。環境変数で上書き可能
+DEFAULT_LOG_INTERVAL = float(os.environ.get("YAKERU_TELEMETRY_LOG_INTERVAL", "5.0"))
+# この秒数以上書き込みが進まなければストールとみなす
+DEFAULT_STALL_TIMEOUT = float(os.environ.get("YAKERU_STALL_TIMEOUT", "10.0"))
+# 転送速度のサンプリング間隔（秒）
+SAMPLE_INTERVAL = 0.5
+# EWMAの平滑化係数
+EWMA_ALPHA = 0.3
+
+MB = 1024 * 1024
+
+# ジョブの終了を表すフェーズ
+TERMINAL_PHASES = ("completed",)
+# 1ジョブで保持するトレースイベントの上限（リトライが多発してもメモリを使い切らないように）
+MAX_TRACE_EVENTS = 10000
+
+
+class WriteTelemetry:
+    """書き込みジョブ1件分のスループット・ETA・フェーズ時間を記録する"""
+
+    def __init__(self, job_id=None, device=None, total_bytes=0,
+                 log_interval=None, stall_timeout=None):
+        self.job_id = job_id
+        self.device = device
+        self.total_bytes = total_bytes
+        self.log_interval = DEFAULT_LOG_INTERVAL if log_interval is None else log_interval
+        self.stall_timeout = DEFAULT_STALL_TIMEOUT if stall_timeout is None else stall_timeout
+
+        self.bytes_written = 0
+        self.resumed_from = 0    # 再開した場合の開始オフセット
+        self.verification = None  # 抜き取り検証の結果
+        self.skipped = False      # デバイスがすでに同じイメージを保持していたため書き込みを省略した
+        self.wipe = None          # ワイプの各ステップの結果と所要時間
+        self.instant_rate = 0.0  # bytes/sec
+        self.ewma_rate = 0.0     # bytes/sec
+        self.retries = 0
+        self.stall_count = 0
+        self.longest_stall = 0.0
+        self.status = "started"
+
+        self.started_at = time.time()
+        self._start_mono = time.monotonic()
+        self._finished_mono = None
+        self._phase = None
+        self._phase_start = self._start_mono
+        self.phase_times = {}
+
+        self._sample_time = self._start_mono
+        self._sample_bytes = 0
+        self._last_progress_time = self._start_mono
+        self._last_log_time = self._start_mono
+        self._lock = threading.Lock()
+        self._trace_events = []
+        self.dropped_trace_events = 0
+
+    # ---- フェーズ管理 ----
+
+    def start_phase(self, phase):
+        """現在のフェーズを終了し、新しいフェーズを開始する"""
+        now = time.monotonic()
+        with self._lock:
+            self._close_phase(now)
+            self.status = phase
+            if phase in TERMINAL_PHASES:
+                self._phase = None
+                self._finished_mono = now
+                return
+            self._phase = phase
+            self._phase_start = now
+            if phase == "writing":
+                # 書き込み開始前の待ち時間をストールとして数えないようにする
+                self._sample_time = now
+                self._sample_bytes = self.bytes_written
+                self._last_progress_time = now
+
+    def _close_phase(self, now):
+        if self._phase is not None:
+            elapsed = now - self._phase_start
+            self.phase_times[self._phase] = self.phase_times.get(self._phase, 0.0) + elapsed
+            self._append_event({"name": self._phase, "cat": "phase", "ph": "X",
+                                "ts": self._to_us(self._phase_start), "dur": elapsed * 1e6})
+
+    def finish(self, status):
+        """ジョブ終了時に呼び出し、最後のフェーズ時間を確定する"""
+        with self._lock:
+            if self._finished_mono is None:
+                self._close_phase(time.monotonic())
+                self._phase = None
+                self._finished_mono = time.monotonic()
+            self.status = status
+        log("write", f"{status}: {self.bytes_written}/{self.total_bytes} bytes "
+            f"in {self.elapsed():.1f}s (avg {self.average_rate() / MB:.2f} MB/s)",
+            level="info" if status == "completed" else "warning",
+            job_id=self.job_id, device=self.device, status=status,
+            bytes_written=self.bytes_written, average_mbps=round(self.average_rate() / MB, 2))
+
+    # ---- 書き込みループから呼ばれる部分（低オーバーヘッド） ----
+
+    def add_bytes(self, count):
+        """書き込み済みバイト数を加算する。速度サンプルを更新した場合はTrueを返す"""
+        self.bytes_written += count
+        now = time.monotonic()
+        gap = now - self._last_progress_time
+        self._last_progress_time = now
+        if gap >= self.stall_timeout:
+            self.stall_count += 1
+            self.longest_stall = max(self.longest_stall, gap)
+            log("progress", f"Write resumed after {gap:.1f}s stall", level="warning",
+                job_id=self.job_id, device=self.device, stall_seconds=round(gap, 1))
+
+        elapsed = now - self._sample_time
+        if elapsed < SAMPLE_INTERVAL:
+            return False
+
+        self.instant_rate = (self.bytes_written - self._sample_bytes) / elapsed
+        if self.ewma_rate == 0.0:
+            self.ewma_rate = self.instant_rate
+        else:
+            self.ewma_rate = EWMA_ALPHA * self.instant_rate + (1 - EWMA_ALPHA) * self.ewma_rate
+        self._sample_time = now
+        self._sample_bytes = self.bytes_written
+
+        if self.log_interval >= 0 and now - self._last_log_time >= self.log_interval:
+            self._last_log_time = now
+            self._log_line()
+        return True
+
+    def record_retry(self, **args):
+        """書き込みリトライを記録する"""
+        self.retries += 1
+        self.instant("retry", cat="retry", attempt=self.retries, **args)
+
+    # ---- トレース（Chrome trace-event形式） ----
+
+    def span(self, name, cat="step", **args):
+        """withブロックの区間をトレースに記録するコンテキストマネージャ"""
+        return _Span(self, name, cat, args)
+
+    def instant(self, name, cat="event", **args):
+        """時間幅を持たないイベントを記録する"""
+        with self._lock:
+            self._append_event({"name": name, "cat": cat, "ph": "i", "s": "t",
+                                "ts": self._to_us(time.monotonic()), "args": args})
+
+    def _record_span(self, name, cat, start, end, args):
+        with self._lock:
+            self._append_event({"name": name, "cat": cat, "ph": "X",
+                                "ts": self._to_us(start), "dur": (end - start) * 1e6,
+                                "args": args})
+
+    def _append_event(self, event):
+        # ロックを保持した状態で呼び出すこと
+        if len(self._trace_events) >= MAX_TRACE_EVENTS:
+            self.dropped_trace_events += 1
+            return
+        self._trace_events.append(event)
+
+    def _to_us(self, mono):
+        return round((mono - self._start_mono) * 1e6, 1)
+
+    def chrome_trace(self):
+        """Chrome trace-event形式（chrome://tracing / Perfetto）の辞書を返す"""
+        with self._lock:
+            events = list(self._trace_events)
+            if self._phase is not None:
+                # 実行中のフェーズも途中経過として含める
+                now = time.monotonic()
+                events.append({"name": self._phase, "cat": "phase", "ph": "X",
+                                "ts": self._to_us(self._phase_start),
+                                "dur": (now - self._phase_start) * 1e6})
+        label = f"{self.job_id or 'job'} {self.device or ''}".strip()
+        for event in events:
+            event["pid"] = 1
+            event["tid"] = 1
+        events.insert(0, {"name": "process_name", "ph": "M", "pid": 1, "tid": 1,
+                          "args": {"name": label}})
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "job_id": self.job_id,
+                "device": self.device,
+                "status": self.status,
+                "started_at": self.started_at,
+                "bytes_written": self.bytes_written,
+                "dropped_events": self.dropped_trace_events,
+            },
+        }
+
+    def _log_line(self):
+        eta = self.eta()
+        eta_text = f"{eta:.0f}s" if eta is not None else "?"
+        log("progress", f"{self.bytes_written}/{self.total_bytes} bytes "
+            f"({self.percent():.1f}%) {self.ewma_rate / MB:.2f} MB/s ETA {eta_text}",
+            job_id=self.job_id, device=self.device, percent=round(self.percent(), 1),
+            mbps=round(self.ewma_rate / MB, 2), eta_seconds=eta)
+
+    # ---- 集計値 ----
+
+    def percent(self):
+        if self.total_bytes <= 0:
+            return 0.0
+        return self.bytes_written * 100.0 / self.total_bytes
+
+    def elapsed(self):
+        end = self._finished_mono if self._finished_mono is not None else time.monotonic()
+        return end - self._start_mono
+
+    def average_rate(self):
+        """書き込みフェーズ全体の平均速度（bytes/sec）"""
+        writing_time = self.phase_times.get("writing", 0.0)
+        if self._phase == "writing":
+            writing_time += time.monotonic() - self._phase_start
+        if writing_time <= 0:
+            return 0.0
+        return (self.bytes_written - self.resumed_from) / writing_time
+
+    def eta(self):
+        """残り時間の推定値（秒）。推定できない場合はNone"""
+        if self.total_bytes <= 0 or self.ewma_rate <= 0:
+            return None
+        remaining = max(self.total_bytes - self.bytes_written, 0)
+        return remaining / self.ewma_rate
+
+    def is_stalled(self):
+        if self._phase != "writing":
+            return False
+        return time.monotonic() - self._last_progress_time >= self.stall_timeout
+
+    def snapshot(self):
+        """APIやSocket.IOイベントで返すための辞書を作成"""
+        with self._lock:
+            phase_times = dict(self.phase_times)
+            if self._phase is not None:
+                phase_times[self._phase] = (phase_times.get(self._phase, 0.0)
+                                            + time.monotonic() - self._phase_start)
+        eta = self.eta()
+        return {
+            "job_id": self.job_id,
+            "device": self.device,
+            "phase": self._phase,
+            "bytes_written": self.bytes_written,
+            "total_bytes": self.total_bytes,
+            "resumed_from": self.resumed_from,
+            "percent": round(self.percent(), 2),
+            "instant_mbps": round(self.instant_rate / MB, 2),
+            "ewma_mbps": round(self.ewma_rate / MB, 2),
+            "average_mbps": round(self.average_rate() / MB, 2),
+            "eta_seconds": round(eta, 1) if eta is not None else None,
+            "elapsed_seconds": round(self.elapsed(), 2),
+            "phase_times": {k: round(v, 3) for k, v in phase_times.items()},
+            "retries": self.retries,
+            "stalled": self.is_stalled(),
+            "stall_count": self.stall_count,
+            "longest_stall_seconds": round(self.longest_stall, 1),
+            "verification": self.verification,
+            "skipped": self.skipped,
+            "wipe": self.wipe,
+            "started_at": self.started_at,
+        }
+
+
+class _Span:
+    def __init__(self, telemetry, name, cat, args):
+        self.telemetry = telemetry
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.args["error"] = str(exc)
+        self.telemetry._record_span(self.name, self.cat, self.start, time.monotonic(), self.args)
+        return False
@@ -0,0 +1,56 @@
+"""テスト共通の設定
+
+実機のUSBメモリやリモートのサーバーは使わず、sim:// の疑似デバイスとローカルのHTTPサーバーで動かす。
+書き込みのたびに保存される状態ファイルはテストごとの一時ディレクトリに置く。
+"""
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+import capacity_probe
+import device_history
+import device_registry
+import iso_writer
+import log_pipeline
+import sim_device
+import write_journal
+
+# ログは別スレッドで書き出されpytestの出力に混ざるため、テストでは出さない
+log_pipeline.configure(level="off")
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmp_path, monkeypatch):
+    """状態ファイルの保存先を一時ディレクトリに向け、疑似デバイスの状態を初期化する"""
+    state = tmp_path / "state"
+    monkeypatch.setattr(device_registry, "REGISTRY_PATH", str(state / "device_registry.json"))
+    monkeypatch.setattr(write_journal, "JOURNAL_DIR", str(state / "journal"))
+    monkeypatch.setattr(capacity_probe, "RESULTS_PATH", str(state / "capacity_probes.json"))
+    monkeypatch.setattr(device_history, "HISTORY_PATH", str(state / "device_history.json"))
+    state.mkdir()
+    sim_device.reset()
+    yield state
+    sim_device.reset()
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    """リトライの待機時間を記録するだけにして、テストを待たせない"""
+    delays = []
+    monkeypatch.setattr(iso_writer, "_sleep", lambda telemetry, seconds, reason="wait": delays.append(seconds))
+    return delays
+
+
+@pytest.fixture
+def make_image(tmp_path):
+    """ランダムな内容のISOイメージを作る"""
+    def make(size, name="image.iso"):
+        path = tmp_path / name
+        path.write_bytes(os.urandom(size))
+        return str(path)
+    return make
@@ -0,0 +1,48 @@
+"""バッチの割り当て（dry_runでは一覧に載せないこと）"""
+from collections import OrderedDict
+
+import pytest
+
+import batch
+
+MB = 1024 * 1024
+
+
+@pytest.fixture(autouse=True)
+def empty_batches(monkeypatch):
+    monkeypatch.setattr(batch, "_batches", OrderedDict())
+
+
+@pytest.fixture
+def iso_dir(tmp_path, make_image):
+    make_image(2 * MB, name="ubuntu.iso")
+    return str(tmp_path)
+
+
+def test_create_batch_without_registering(iso_dir):
+    manifest = {"items": [{"iso_file": "ubuntu.iso", "count": 2}]}
+
+    planned = batch.create_batch(manifest, iso_dir, ["sim://a", "sim://b"], register=False)
+
+    assert len(planned.jobs) == 2
+    assert batch.list_batches() == []
+    assert batch.get_batch(planned.batch_id) is None
+
+    created = batch.create_batch(manifest, iso_dir, ["sim://a", "sim://b"])
+    assert batch.list_batches() == [created]
+
+
+def test_dry_run_endpoint_does_not_store_the_batch(iso_dir, monkeypatch):
+    app = pytest.importorskip("app")
+    monkeypatch.setattr(app, "ISO_DIR", iso_dir)
+    monkeypatch.setattr(app, "list_usb_devices", lambda: [{"id": "sim://a"}, {"id": "sim://b"}])
+    http = app.app.test_client()
+
+    response = http.post("/api/batches", json={"items": [{"iso_file": "ubuntu.iso", "count": 2}],
+                                               "dry_run": True})
+
+    assert response.status_code == 200
+    assert len(response.json["jobs"]) == 2
+    assert response.json["state"] == "planned"
+    assert http.get("/api/batches").json["batches"] == []
+    assert http.get(f"/api/batches/{response.json['batch_id']}").status_code == 404
@@ -0,0 +1,110 @@
+"""容量プローブの書き込み・書き戻しと、APIからプローブするときのマウント解除"""
+import os
+
+import pytest
+
+import capacity_probe
+import iso_writer
+
+MB = 1024 * 1024
+
+
+def _device(tmp_path, params):
+    path = tmp_path / "stick.img"
+    path.write_bytes(os.urandom(16 * MB))
+    return f"sim://{path}?{params}", path
+
+
+def test_probe_restores_original_data_with_partial_writes(tmp_path):
+    device, path = _device(tmp_path, "capacity=16M&max_write=1000")
+    before = path.read_bytes()
+
+    result = capacity_probe.probe(device)
+
+    assert not result["counterfeit"]
+    assert path.read_bytes() == before
+
+
+def test_probe_detects_wrapping_device(tmp_path):
+    device, _ = _device(tmp_path, "capacity=16M&real_capacity=4M")
+
+    result = capacity_probe.probe(device)
+
+    assert result["counterfeit"]
+    assert result["usable_bytes"] <= 4 * MB
+
+
+def test_probe_error_is_not_replaced_by_restore_error(tmp_path):
+    device, _ = _device(tmp_path, "capacity=16M&eio=2M&eio_count=0")
+
+    with pytest.raises(OSError, match="Simulated I/O error"):
+        capacity_probe.probe(device)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    app = pytest.importorskip("app")
+    monkeypatch.setattr(app, "is_writing_active", False)
+    return app, app.app.test_client()
+
+
+@pytest.fixture
+def mounts(monkeypatch):
+    """mountコマンドの出力と、umountの呼び出しを差し替える"""
+    state = {"mounted": [], "stuck": [], "umount": []}
+
+    def check_output(telemetry, cmd, **kwargs):
+        return "".join(f"{name} on /mnt type vfat (rw)\n" for name in state["mounted"])
+
+    def run(telemetry, cmd, **kwargs):
+        if cmd[0] == "umount":
+            state["umount"].append(cmd[-1])
+            if cmd[-1] not in state["stuck"]:
+                state["mounted"].remove(cmd[-1])
+
+    monkeypatch.setattr(iso_writer.platform, "system", lambda: "Linux")
+    monkeypatch.setattr(iso_writer, "_check_output", check_output)
+    monkeypatch.setattr(iso_writer, "_run", run)
+    monkeypatch.setattr(iso_writer, "_sleep", lambda telemetry, seconds, reason="wait": None)
+    return state
+
+
+def test_endpoint_unmounts_before_probing(client, mounts, monkeypatch):
+    app, http = client
+    mounts["mounted"] = ["/dev/sdx1", "/dev/sdx2"]
+    probed = []
+
+    def probe(device):
+        probed.append((device, list(mounts["mounted"]), app.is_writing_active))
+        return {"device": device}
+
+    monkeypatch.setattr(capacity_probe, "probe", probe)
+    response = http.post("/api/usb-devices/probe", json={"device": "/dev/sdx"})
+
+    assert response.status_code == 200
+    assert mounts["umount"] == ["/dev/sdx1", "/dev/sdx2"]
+    assert probed == [("/dev/sdx", [], True)]
+    assert app.is_writing_active is False
+
+
+def test_endpoint_refuses_while_still_mounted(client, mounts, monkeypatch):
+    app, http = client
+    mounts["mounted"] = ["/dev/sdx1"]
+    mounts["stuck"] = ["/dev/sdx1"]
+    monkeypatch.setattr(capacity_probe, "probe", lambda device: pytest.fail("probed a mounted device"))
+
+    response = http.post("/api/usb-devices/probe", json={"device": "/dev/sdx"})
+
+    assert response.status_code == 409
+    assert "/dev/sdx1" in response.json["error"]
+    assert app.is_writing_active is False
+
+
+def test_endpoint_refuses_during_a_write(client, monkeypatch):
+    app, http = client
+    monkeypatch.setattr(app, "is_writing_active", True)
+    monkeypatch.setattr(capacity_probe, "probe", lambda device: pytest.fail("probed during a write"))
+
+    response = http.post("/api/usb-devices/probe", json={"device": "/dev/sdx"})
+
+    assert response.status_code == 409
@@ -0,0 +1,216 @@
+"""ローカルで動かした疑似ノード（app.pyのAPIの一部を返すHTTPサーバー）を相手に、クラスタモードを確かめる"""
+import json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import cluster
+
+
+class _NodeHandler(BaseHTTPRequestHandler):
+    """ノードのISO一覧・デバイス一覧・バッチのAPIを server の属性から返す"""
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        node = self.server
+        if self.path == "/api/isos":
+            self._reply(200, {"isos": node.isos})
+        elif self.path == "/api/usb-devices":
+            if node.writing:
+                self._reply(423, {"devices": [], "blocked": True})
+            else:
+                self._reply(200, {"devices": [{"id": device} for device in node.devices]})
+        elif self.path == "/api/batches":
+            self._reply(200, {"batches": list(node.batches.values())})
+        elif self.path.startswith("/api/batches/"):
+            batch = node.batches.get(self.path.rsplit("/", 1)[-1])
+            if batch is None:
+                self._reply(404, {"error": "Batch not found"})
+            else:
+                self._reply(200, batch)
+        else:
+            self._reply(404, {"error": "Not found"})
+
+    def do_POST(self):
+        node = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path != "/api/batches":
+            self._reply(404, {"error": "Not found"})
+        elif node.reject_batches:
+            self._reply(409, {"error": "A batch is already in progress"})
+        else:
+            node.received.append(body)
+            batch_id = f"b{len(node.received)}"
+            jobs = sum(item["count"] + len(item["devices"]) for item in body["items"])
+            node.batches[batch_id] = {"batch_id": batch_id, "state": "running", "percent": 50.0,
+                                      "total_bytes": 100 * jobs, "bytes_written": 50 * jobs,
+                                      "eta_seconds": 5, "jobs": []}
+            self._reply(202, node.batches[batch_id])
+
+
+@pytest.fixture
+def make_node():
+    servers = []
+
+    def make(devices=("/dev/sdb", "/dev/sdc"), isos=("ubuntu.iso",)):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _NodeHandler)
+        server.daemon_threads = True
+        server.devices = list(devices)
+        server.isos = [{"name": name, "size": 100} for name in isos]
+        server.writing = False
+        server.reject_batches = False
+        server.batches = OrderedDict()
+        server.received = []
+        server.url = f"http://127.0.0.1:{server.server_address[1]}"
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def empty_cluster(monkeypatch):
+    monkeypatch.setattr(cluster, "_nodes", OrderedDict())
+    monkeypatch.setattr(cluster, "_jobs", OrderedDict())
+    monkeypatch.setattr(cluster, "POLL_INTERVAL", 0.01)
+
+
+def test_add_node_reads_devices_and_isos(make_node):
+    server = make_node()
+
+    node = cluster.add_node(server.url, name="bench1")
+
+    assert node.online and not node.busy
+    assert node.free_devices() == ["/dev/sdb", "/dev/sdc"]
+    assert node.find_iso("ubuntu.iso") is not None
+
+
+def test_node_writing_alone_is_busy(make_node):
+    server = make_node()
+    server.writing = True
+
+    node = cluster.add_node(server.url, name="bench1")
+
+    assert node.online and node.busy
+    assert node.free_devices() == []
+
+
+def test_unreachable_node_is_offline(make_node):
+    server = make_node()
+    url = server.url
+    server.shutdown()
+    server.server_close()
+
+    node = cluster.add_node(url, name="gone")
+
+    assert not node.online
+    assert node.error
+
+
+def test_plan_prefers_nodes_with_free_devices(make_node):
+    small = make_node(devices=["/dev/sdb"])
+    large = make_node(devices=["/dev/sdb", "/dev/sdc", "/dev/sdd"])
+    cluster.add_node(small.url, name="small")
+    cluster.add_node(large.url, name="large")
+
+    assignments = cluster.plan({"items": [{"iso_file": "ubuntu.iso", "count": 3}], "verify": True},
+                               cluster.list_nodes())
+
+    counts = {name: manifest["items"][0]["count"] for name, manifest in assignments.items()}
+    assert counts == {"large": 2, "small": 1}
+    assert all(manifest["verify"] is True for manifest in assignments.values())
+
+
+def test_plan_rejects_impossible_manifests(make_node):
+    server = make_node(devices=["/dev/sdb"])
+    cluster.add_node(server.url, name="bench1")
+    nodes = cluster.list_nodes()
+
+    with pytest.raises(cluster.ClusterError) as error:
+        cluster.plan({"items": [{"iso_file": "ubuntu.iso", "count": 2}]}, nodes)
+    assert error.value.status == 409
+    with pytest.raises(cluster.ClusterError) as error:
+        cluster.plan({"items": [{"iso_file": "debian.iso", "count": 1}]}, nodes)
+    assert error.value.status == 404
+
+
+def test_job_without_registering_is_not_listed(make_node):
+    server = make_node()
+    cluster.add_node(server.url, name="bench1")
+
+    job = cluster.create_job({"items": [{"iso_file": "ubuntu.iso", "count": 1}]}, register=False)
+
+    assert job.snapshot()["nodes"][0]["node"] == "bench1"
+    assert cluster.list_jobs() == []
+    assert cluster.get_job(job.job_id) is None
+    assert server.received == []
+
+
+def _run(job):
+    threads = []
+
+    def spawn(func):
+        thread = threading.Thread(target=func, daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    job.start(spawn)
+    return threads[0]
+
+
+def test_job_dispatches_batches_and_collects_progress(make_node):
+    first = make_node()
+    second = make_node()
+    cluster.add_node(first.url, name="first")
+    cluster.add_node(second.url, name="second")
+
+    job = cluster.create_job({"items": [{"iso_file": "ubuntu.iso", "count": 4}]})
+    poller = _run(job)
+
+    snapshot = job.snapshot()
+    assert [server.received[0]["items"][0]["count"] for server in (first, second)] == [2, 2]
+    assert snapshot["total_bytes"] == 400 and snapshot["percent"] == 50.0
+    assert snapshot["eta_seconds"] == 5
+
+    for server in (first, second):
+        for batch in server.batches.values():
+            batch.update(state="completed", bytes_written=batch["total_bytes"])
+    poller.join(timeout=5)
+
+    assert job.state == "completed"
+    assert job.snapshot()["percent"] == 100.0
+
+
+def test_job_reports_nodes_that_refuse_the_batch(make_node):
+    first = make_node()
+    second = make_node()
+    cluster.add_node(first.url, name="first")
+    cluster.add_node(second.url, name="second")
+    second.reject_batches = True
+
+    job = cluster.create_job({"items": [{"iso_file": "ubuntu.iso", "count": 2}]})
+    poller = _run(job)
+    for batch in first.batches.values():
+        batch["state"] = "completed"
+    poller.join(timeout=5)
+
+    nodes = {node["node"]: node for node in job.snapshot()["nodes"]}
+    assert nodes["second"]["state"] == "error"
+    assert "already in progress" in nodes["second"]["error"]
+    assert job.state == "completed_with_errors"
@@ -0,0 +1,205 @@
+"""ローカルのHTTPサーバーからイメージを読み、Range・ETag・再接続の扱いを確かめる"""
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import http_source
+import iso_writer
+import sim_device
+import write_journal
+from telemetry import WriteTelemetry
+from write_retry import RetryPolicy
+
+MB = 1024 * 1024
+
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    """server.image を配信する。Range・HEADへの対応と接続の切断はサーバーの属性で切り替える"""
+
+    def log_message(self, *args):
+        pass
+
+    def _range(self):
+        header = self.headers.get("Range")
+        if not header or not self.server.ranges:
+            return None
+        start, end = header[len("bytes="):].split("-")
+        size = len(self.server.image)
+        return int(start), min(int(end), size - 1) if end else size - 1
+
+    def _send_headers(self, status, length, content_range=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", self.server.etag)
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if content_range:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.server.requests.append(("HEAD", None))
+        if not self.server.head:
+            self.send_error(405)
+            return
+        self._send_headers(200, len(self.server.image))
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.headers.get("Range")))
+        image = self.server.image
+        byte_range = self._range()
+        if byte_range is None:
+            start, end = 0, len(image) - 1
+            self._send_headers(200, len(image))
+        else:
+            start, end = byte_range
+            self._send_headers(206, end - start + 1, f"bytes {start}-{end}/{len(image)}")
+        body = image[start:end + 1]
+        drop_after = self.server.drop_after
+        if drop_after is not None and len(body) > drop_after:
+            # 一度だけ、本文の途中で接続を切る
+            self.server.drop_after = None
+            self.wfile.write(body[:drop_after])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ImageHandler)
+    server.daemon_threads = True
+    server.image = os.urandom(3 * MB + 4321)
+    server.etag = '"v1"'
+    server.ranges = True
+    server.head = True
+    server.drop_after = None
+    server.requests = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/images/test.iso"
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fast_reconnect(monkeypatch):
+    """再接続の待機をなくす"""
+    monkeypatch.setattr(http_source, "RetryPolicy",
+                        lambda max_retries: RetryPolicy(max_retries=max_retries, base_delay=0))
+
+
+def _read_all(source):
+    data = bytearray()
+    while True:
+        chunk = source.read(MB)
+        if not chunk:
+            return bytes(data)
+        data += chunk
+
+
+def test_probe_reports_size_ranges_and_etag(http_server):
+    info = http_source.probe(http_server.url)
+
+    assert info["size"] == len(http_server.image)
+    assert info["accept_ranges"] is True
+    assert info["etag"] == '"v1"'
+
+
+def test_probe_falls_back_to_range_request_without_head(http_server):
+    http_server.head = False
+
+    info = http_source.probe(http_server.url)
+
+    assert info["size"] == len(http_server.image)
+    assert http_server.requests[-1] == ("GET", "bytes=0-0")
+
+
+def test_read_range_requests_only_the_range(http_server):
+    data = http_source.read_range(http_server.url, 1000, 500)
+
+    assert data == http_server.image[1000:1500]
+    assert http_server.requests[-1] == ("GET", "bytes=1000-1499")
+
+
+def test_read_range_skips_when_server_ignores_range(http_server):
+    http_server.ranges = False
+
+    data = http_source.read_range(http_server.url, MB + 7, 100)
+
+    assert data == http_server.image[MB + 7:MB + 107]
+
+
+def test_image_source_reconnects_with_range(http_server, fast_reconnect):
+    drop_after = MB + MB // 2
+    http_server.drop_after = drop_after
+
+    with http_source.HttpImageSource(http_server.url) as source:
+        data = _read_all(source)
+
+    assert data == http_server.image
+    assert source.reconnects == 1
+    gets = [header for method, header in http_server.requests if method == "GET"]
+    assert gets == [None, f"bytes={drop_after}-"]
+
+
+@pytest.mark.parametrize("ranges", [True, False])
+def test_image_source_seek(http_server, ranges):
+    http_server.ranges = ranges
+    offset = 2 * MB + 99
+
+    with http_source.HttpImageSource(http_server.url) as source:
+        source.seek(offset)
+        data = _read_all(source)
+
+    assert data == http_server.image[offset:]
+
+
+def test_cached_copy_requires_matching_etag(http_server, tmp_path):
+    cache_dir = str(tmp_path / "isos")
+    with http_source.HttpImageSource(http_server.url, cache_dir=cache_dir) as source:
+        _read_all(source)
+
+    cached = http_source.cached_copy(http_server.url, cache_dir)
+    assert cached == os.path.join(cache_dir, "test.iso")
+    with open(cached, 'rb') as f:
+        assert f.read() == http_server.image
+
+    http_server.etag = '"v2"'
+    assert http_source.cached_copy(http_server.url, cache_dir) is None
+
+
+def _write(url, device, **kwargs):
+    telemetry = WriteTelemetry(job_id="test", device=device, log_interval=-1)
+    iso_writer.write_iso_to_device(url, device, None, telemetry, block_size=256 * 1024, **kwargs)
+    return telemetry
+
+
+def test_write_from_url(http_server, tmp_path):
+    device = f"sim://{tmp_path / 'stick.img'}"
+
+    _write(http_server.url, device, verify=True)
+
+    with open(tmp_path / "stick.img", 'rb') as f:
+        assert f.read() == http_server.image
+
+
+@pytest.mark.parametrize("etag, resumed", [('"v1"', 2 * MB), ('"v2"', 0)])
+def test_resume_from_url_checks_etag(http_server, tmp_path, monkeypatch, no_backoff, etag, resumed):
+    monkeypatch.setattr(write_journal, "CHECKPOINT_INTERVAL", MB)
+    device = f"sim://{tmp_path / 'stick.img'}?remove_at=2560K"
+
+    with pytest.raises(OSError):
+        _write(http_server.url, device)
+    # サーバー側でイメージが差し替えられた（ETagが変わった）場合は最初から書き直す
+    http_server.etag = etag
+    sim_device.reinsert(device)
+    telemetry = _write(http_server.url, device, resume=True)
+
+    assert telemetry.resumed_from == resumed
+    with open(tmp_path / "stick.img", 'rb') as f:
+        assert f.read() == http_server.image
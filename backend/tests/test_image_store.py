@@ -0,0 +1,98 @@
+"""重複排除ストアの登録・共有・削除（ハードリンクが使えない場合を含む）"""
+import errno
+import os
+import shutil
+
+import pytest
+
+import checksum_index
+import image_store
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def iso_dir(tmp_path):
+    iso_dir = tmp_path / "isos"
+    iso_dir.mkdir()
+    data = os.urandom(MB)
+    (iso_dir / "a.iso").write_bytes(data)
+    (iso_dir / "a-copy.iso").write_bytes(data)
+    (iso_dir / "b.iso").write_bytes(os.urandom(MB))
+    return str(iso_dir)
+
+
+@pytest.fixture
+def no_hardlinks(monkeypatch):
+    """別のファイルシステムのようにハードリンクを失敗させ、reflinkの代わりに通常のコピーを作る"""
+    clones = []
+
+    def fail_link(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    def clone(src, dst):
+        shutil.copyfile(src, dst)
+        clones.append(dst)
+
+    monkeypatch.setattr(image_store.os, "link", fail_link)
+    monkeypatch.setattr(image_store, "_clone", clone)
+    return clones
+
+
+def _objects(iso_dir):
+    root = os.path.join(iso_dir, image_store.STORE_DIR_NAME)
+    return sorted(name for _, _, names in os.walk(root) for name in names)
+
+
+def test_gc_keeps_reflinked_objects_after_dedupe(iso_dir, no_hardlinks):
+    result = image_store.dedupe(iso_dir)
+    assert (result["stored"], result["linked"], result["errors"]) == (2, 1, [])
+
+    assert image_store.gc(iso_dir) == 0
+    assert len(_objects(iso_dir)) == 2
+    status = image_store.status(iso_dir)
+    assert status["saved_bytes"] == 3 * MB - 2 * MB
+
+    # 参照されているイメージには、索引のsha256から新しい名前を付けられる
+    sha256 = checksum_index.lookup(iso_dir, "a.iso")["sha256"]
+    image_store.link(iso_dir, "a-again.iso", sha256)
+    with open(os.path.join(iso_dir, "a.iso"), 'rb') as a, \
+            open(os.path.join(iso_dir, "a-again.iso"), 'rb') as again:
+        assert a.read() == again.read()
+
+
+def test_dedupe_does_not_replace_reflinked_names_again(iso_dir, no_hardlinks):
+    image_store.dedupe(iso_dir)
+    clones = len(no_hardlinks)
+
+    result = image_store.dedupe(iso_dir)
+
+    assert (result["stored"], result["linked"], result["unchanged"]) == (0, 0, 3)
+    assert len(no_hardlinks) == clones
+
+
+def test_gc_removes_objects_without_names(iso_dir, no_hardlinks):
+    image_store.dedupe(iso_dir)
+    os.unlink(os.path.join(iso_dir, "b.iso"))
+
+    assert image_store.gc(iso_dir) == 1
+    assert len(_objects(iso_dir)) == 1
+
+
+def test_gc_removes_objects_of_modified_names(iso_dir, no_hardlinks):
+    image_store.dedupe(iso_dir)
+    # reflinkした名前をその場で書き換えると、ストアのイメージとは別の内容になる
+    with open(os.path.join(iso_dir, "b.iso"), 'r+b') as f:
+        f.write(b"changed")
+
+    assert image_store.gc(iso_dir) == 1
+
+
+def test_gc_with_hardlinks(iso_dir):
+    result = image_store.dedupe(iso_dir)
+    assert (result["stored"], result["linked"]) == (2, 1)
+    assert image_store.gc(iso_dir) == 0
+
+    os.unlink(os.path.join(iso_dir, "b.iso"))
+    assert image_store.gc(iso_dir) == 1
+    assert image_store.status(iso_dir)["saved_bytes"] == MB
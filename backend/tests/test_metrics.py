@@ -0,0 +1,56 @@
+"""終了したジョブのテレメトリからのメトリクス集計（再開したジョブを含む）"""
+import pytest
+
+import iso_writer
+import metrics
+import sim_device
+import write_journal
+from telemetry import WriteTelemetry
+
+MB = 1024 * 1024
+
+
+def _sample(metric, **labels):
+    return metric._values.get(metric._key(labels))
+
+
+def _write(iso_path, device, **kwargs):
+    telemetry = WriteTelemetry(job_id="test", device=device, log_interval=-1)
+    try:
+        iso_writer.write_iso_to_device(iso_path, device, None, telemetry,
+                                       block_size=256 * 1024, **kwargs)
+    finally:
+        metrics.observe_write_job(telemetry)
+    return telemetry
+
+
+def test_counts_bytes_of_a_completed_job(tmp_path, make_image):
+    iso_path = make_image(2 * MB)
+    device = f"sim://{tmp_path / 'stick.img'}"
+
+    telemetry = _write(iso_path, device)
+
+    assert telemetry.status == "completed"
+    assert _sample(metrics.BYTES_WRITTEN, device=device) == 2 * MB
+    assert _sample(metrics.WRITE_THROUGHPUT, device=device)[2] == 1
+
+
+def test_resumed_job_counts_only_bytes_written_after_resuming(tmp_path, make_image, monkeypatch, no_backoff):
+    monkeypatch.setattr(write_journal, "CHECKPOINT_INTERVAL", MB)
+    iso_path = make_image(4 * MB)
+    device = f"sim://{tmp_path / 'stick.img'}?remove_at=2560K"
+
+    with pytest.raises(OSError):
+        _write(iso_path, device)
+    interrupted = _sample(metrics.BYTES_WRITTEN, device=device)
+    assert 2 * MB <= interrupted < 4 * MB
+
+    sim_device.reinsert(device)
+    telemetry = _write(iso_path, device, resume=True)
+
+    assert telemetry.resumed_from == 2 * MB
+    # 中断前のジョブが数えた範囲（ジャーナルの同期位置まで）は、再開したジョブでは数えない
+    assert _sample(metrics.BYTES_WRITTEN, device=device) == interrupted + 2 * MB
+    state = _sample(metrics.WRITE_THROUGHPUT, device=device)
+    assert state[2] == 1
+    assert state[1] == pytest.approx(telemetry.average_rate() / MB)
@@ -0,0 +1,186 @@
+"""疑似デバイス（sim://）に障害を起こして、書き込み・再開・検証・消去の各経路を確かめる"""
+import os
+
+import pytest
+
+import image_cache
+import iso_writer
+import sampled_verify
+import sim_device
+import write_journal
+from telemetry import WriteTelemetry
+
+MB = 1024 * 1024
+
+
+def _device(tmp_path, params="", name="stick.img"):
+    uri = f"sim://{tmp_path / name}"
+    return f"{uri}?{params}" if params else uri
+
+
+def _backing(device):
+    return sim_device._state(device).backing_path
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _write(iso_path, device, **kwargs):
+    telemetry = WriteTelemetry(job_id="test", device=device, log_interval=-1)
+    kwargs.setdefault("block_size", 256 * 1024)
+    iso_writer.write_iso_to_device(iso_path, device, None, telemetry, **kwargs)
+    return telemetry
+
+
+def test_retries_after_eio(tmp_path, make_image, no_backoff):
+    iso_path = make_image(4 * MB)
+    device = _device(tmp_path, "eio=1M&eio_count=2")
+
+    telemetry = _write(iso_path, device)
+
+    assert telemetry.retries == 2
+    assert len(no_backoff) == 2
+    assert sim_device.get_stats(device)["eio_injected"] == 2
+    assert _read(_backing(device)) == _read(iso_path)
+
+
+def test_gives_up_when_eio_persists(tmp_path, make_image, no_backoff):
+    iso_path = make_image(2 * MB)
+    device = _device(tmp_path, "eio=1M&eio_count=0")
+
+    with pytest.raises(OSError):
+        _write(iso_path, device)
+    assert len(no_backoff) == iso_writer.RetryPolicy().max_retries
+
+
+def test_completes_partial_writes(tmp_path, make_image):
+    iso_path = make_image(2 * MB)
+    device = _device(tmp_path, "max_write=100K")
+
+    _write(iso_path, device)
+
+    assert sim_device.get_stats(device)["short_writes"] > 0
+    assert _read(_backing(device)) == _read(iso_path)
+
+
+def test_resumes_after_removal(tmp_path, make_image, monkeypatch, no_backoff):
+    monkeypatch.setattr(write_journal, "CHECKPOINT_INTERVAL", MB)
+    iso_path = make_image(6 * MB + 12345)
+    device = _device(tmp_path, "remove_at=3584K")
+    key = write_journal.journal_key(device)
+
+    with pytest.raises(OSError):
+        _write(iso_path, device)
+    assert write_journal.load(key)["synced_offset"] == 3 * MB
+
+    sim_device.reinsert(device)
+    telemetry = _write(iso_path, device, resume=True)
+
+    assert telemetry.resumed_from == 3 * MB
+    assert _read(_backing(device)) == _read(iso_path)
+    assert write_journal.load(key) is None
+
+
+def test_resume_restarts_when_written_region_differs(tmp_path, make_image, monkeypatch, no_backoff):
+    monkeypatch.setattr(write_journal, "CHECKPOINT_INTERVAL", MB)
+    iso_path = make_image(4 * MB)
+    device = _device(tmp_path, "remove_at=2560K")
+
+    with pytest.raises(OSError):
+        _write(iso_path, device)
+    # 取り外している間に別の内容が書き込まれた
+    with open(_backing(device), 'r+b') as f:
+        f.seek(2 * MB - 4096)
+        f.write(os.urandom(4096))
+
+    sim_device.reinsert(device)
+    telemetry = _write(iso_path, device, resume=True)
+
+    assert telemetry.resumed_from == 0
+    assert _read(_backing(device)) == _read(iso_path)
+
+
+def test_sampled_verify_detects_mismatch(tmp_path, make_image):
+    iso_path = make_image(8 * MB)
+    device = _device(tmp_path)
+    _write(iso_path, device)
+
+    report = sampled_verify.verify_sample(iso_path, device)
+    assert report["verified"]
+    assert report["required_blocks"] > 0
+
+    corrupted = 4 * MB + 100
+    with open(_backing(device), 'r+b') as f:
+        f.seek(corrupted)
+        original = f.read(1)
+        f.seek(corrupted)
+        f.write(bytes([original[0] ^ 0xFF]))
+
+    # 全ブロックを選ぶほど小さな不良率を指定して、どのブロックが選ばれても確実に見つける
+    report = sampled_verify.verify_sample(iso_path, device, defect_rate=0.0001)
+    assert not report["verified"]
+    assert report["mismatches"] == 1
+    block_size = report["block_size"]
+    assert report["mismatch_offsets"] == [corrupted // block_size * block_size]
+
+
+def test_write_with_verify_fails_on_counterfeit_device(tmp_path, make_image):
+    iso_path = make_image(4 * MB)
+    # 実容量を超えた書き込みは先頭に折り返し、先に書いた内容を上書きする
+    device = _device(tmp_path, "capacity=8M&real_capacity=2M")
+
+    telemetry = WriteTelemetry(job_id="test", device=device, log_interval=-1)
+    with pytest.raises(OSError, match="Verification failed"):
+        iso_writer.write_iso_to_device(iso_path, device, None, telemetry, verify=True)
+    assert telemetry.verification["verified"] is False
+    assert telemetry.verification["mismatches"] > 0
+
+
+def _filled_device(tmp_path, size):
+    device = _device(tmp_path)
+    with open(_backing(device), 'wb') as f:
+        f.write(os.urandom(size))
+    return device
+
+
+def test_wipe_falls_back_to_zero_fill(tmp_path):
+    size = 8 * MB
+    device = _filled_device(tmp_path, size)
+
+    result = iso_writer.wipe_device(device, zero=True)
+
+    steps = {step["step"]: step["result"] for step in result["steps"]}
+    assert steps["zeroing"]["method"] == "zero-fill"
+    assert _read(_backing(device)) == bytes(size)
+
+
+def test_wipe_without_discard_erases_signatures(tmp_path):
+    size = 8 * MB
+    device = _filled_device(tmp_path, size)
+    before = _read(_backing(device))
+
+    result = iso_writer.wipe_device(device)
+
+    steps = {step["step"]: step["result"] for step in result["steps"]}
+    assert steps["discarding"]["method"] == "skipped"
+    after = _read(_backing(device))
+    edge = iso_writer.WIPE_EDGE_SIZE
+    assert after[:edge] == bytes(edge)
+    assert after[-edge:] == bytes(edge)
+    assert after[edge:-edge] == before[edge:-edge]
+
+
+def test_one_write_does_not_cache_the_image(tmp_path, make_image, monkeypatch):
+    # フィンガープリントの記録と抜き取り検証は、ホットなイメージの判定に数えない
+    cache = image_cache.ImageCache(budget=64 * MB)
+    monkeypatch.setattr(image_cache, "_cache", cache)
+    iso_path = make_image(4 * MB)
+
+    _write(iso_path, _device(tmp_path), verify=True)
+    assert cache.status()["images"] == []
+
+    _write(iso_path, _device(tmp_path, name="second.img"))
+    assert [image["path"] for image in cache.status()["images"]] == [iso_path]
+
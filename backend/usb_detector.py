@@ -3,20 +3,96 @@ import re
 import platform
 import subprocess
 import json
-import ctypes
+from sim_device import list_simulated_devices, is_simulated, device_bus
+import device_io
+import capacity_probe
+from log_pipeline import log
 
-def list_usb_devices():
-    """システム上のUSBブロックデバイスを検出して返す"""
+def list_usb_devices(min_size=None):
+    """システム上のUSBブロックデバイスを検出して返す
+
+    各デバイスには容量（size_bytes）・セクタサイズ・最適なI/Oサイズを付ける（sizeは表示用の文字列）。
+    min_sizeを指定すると、使える容量（容量プローブの結果があればその値）がそれ以上のデバイスだけを返す
+    """
     system = platform.system()
     
     if system == "Linux":
-        return _list_linux_usb_devices()
+        devices = _list_linux_usb_devices()
     elif system == "Windows":
-        return _list_windows_usb_devices()
+        devices = _list_windows_usb_devices()
     elif system == "Darwin":  # macOS
-        return _list_macos_usb_devices()
+        devices = _list_macos_usb_devices()
     else:
         raise NotImplementedError(f"Unsupported operating system: {system}")
+    
+    # テスト用の疑似デバイス（YAKERU_SIM_DEVICESで指定）を追加し、容量プローブの結果を付ける
+    devices = capacity_probe.annotate(_add_geometry(devices + list_simulated_devices()))
+    if min_size is not None:
+        devices = [device for device in devices
+                   if (usable_capacity(device) or 0) >= min_size]
+    return devices
+
+def usable_capacity(device):
+    """一覧のデバイスに書き込める容量（容量偽装が分かっていれば実際の容量、不明ならNone）"""
+    if device.get("usable_bytes") is not None:
+        return device["usable_bytes"]
+    return device.get("size_bytes")
+
+def _add_geometry(devices):
+    """容量とI/Oサイズをまだ持っていないデバイスに付ける（Linuxはsysfsを読むだけ）"""
+    for device in devices:
+        if "size_bytes" not in device:
+            device.update(get_device_geometry(device["id"]))
+    return devices
+
+def get_device_geometry(dev_path):
+    """デバイスの容量（バイト）・論理/物理セクタサイズ・最適なI/Oサイズ（分からないものはNone）"""
+    system = platform.system()
+    if is_simulated(dev_path) or system == "Linux":
+        return device_io.geometry(dev_path)
+    result = dict.fromkeys(device_io.GEOMETRY_FIELDS)
+    try:
+        if system == "Windows":
+            match = re.search(r'PhysicalDrive(\d+)', dev_path)
+            if match:
+                output = subprocess.run(
+                    ["powershell", "-Command",
+                     f"Get-Disk -Number {match.group(1)} | "
+                     "Select-Object Size, LogicalSectorSize, PhysicalSectorSize | ConvertTo-Json"],
+                    capture_output=True, text=True
+                ).stdout
+                result.update(_windows_geometry(json.loads(output)))
+        elif system == "Darwin":
+            output = subprocess.run(
+                ["diskutil", "info", "-plist", dev_path],
+                capture_output=True, text=True
+            ).stdout
+            import plistlib
+            result.update(_macos_geometry(plistlib.loads(output.encode())))
+    except Exception as e:
+        log("device", f"Failed to read the geometry of {dev_path}: {e}", level="warning")
+    return result
+
+def _windows_geometry(disk):
+    """Get-Diskの結果から容量とセクタサイズを取り出す（最適なI/OサイズはGet-Diskでは分からない）"""
+    return {
+        "size_bytes": disk.get("Size"),
+        "logical_sector_size": disk.get("LogicalSectorSize"),
+        "physical_sector_size": disk.get("PhysicalSectorSize"),
+        "minimum_io_size": disk.get("PhysicalSectorSize"),
+        "optimal_io_size": None,
+    }
+
+def _macos_geometry(info):
+    """diskutil infoの結果から容量とセクタサイズを取り出す"""
+    block_size = info.get("DeviceBlockSize")
+    return {
+        "size_bytes": info.get("TotalSize") or info.get("Size"),
+        "logical_sector_size": block_size,
+        "physical_sector_size": info.get("PhysicalBlockSize") or block_size,
+        "minimum_io_size": info.get("PhysicalBlockSize") or block_size,
+        "optimal_io_size": None,
+    }
 
 def _list_linux_usb_devices():
     """Linuxシステム上のUSBブロックデバイスを検出"""
@@ -153,12 +229,12 @@ def _list_linux_usb_devices():
                 
         return devices
     except Exception as e:
-        print(f"Error listing Linux USB devices: {e}")
+        log("device", f"Error listing Linux USB devices: {e}", level="error")
         # エラーが発生した場合、代替の検出方法を試行
         try:
             return _detect_usb_devices_with_udevadm()
         except Exception as e2:
-            print(f"Failed to detect USB devices with alternative method: {e2}")
+            log("device", f"Failed to detect USB devices with alternative method: {e2}", level="error")
             return []
 
 def _detect_usb_devices_with_udevadm():
@@ -208,7 +284,7 @@ def _detect_usb_devices_with_udevadm():
         
         return devices
     except Exception as e:
-        print(f"Error detecting USB devices with udevadm: {e}")
+        log("device", f"Error detecting USB devices with udevadm: {e}", level="error")
         return []
 
 def _get_device_model(dev_path):
@@ -253,6 +329,82 @@ def _get_device_mountpoint(dev_path):
     except:
         return None
 
+def get_device_serial(dev_path):
+    """デバイスのシリアル番号を取得（取得できない場合はNone）"""
+    system = platform.system()
+    try:
+        if system == "Linux":
+            result = subprocess.run(
+                ["lsblk", "-dno", "SERIAL", dev_path],
+                capture_output=True, text=True
+            )
+            serial = result.stdout.strip().split('\n')[0].strip()
+            if serial:
+                return serial
+            # lsblkで取得できない場合はudevadmのプロパティを参照
+            result = subprocess.run(
+                ["udevadm", "info", "--query=property", f"--name={dev_path}"],
+                capture_output=True, text=True
+            )
+            for line in result.stdout.splitlines():
+                if line.startswith("ID_SERIAL_SHORT=") or line.startswith("ID_SERIAL="):
+                    return line.split("=", 1)[1].strip() or None
+        elif system == "Windows":
+            match = re.search(r'PhysicalDrive(\d+)', dev_path)
+            if match:
+                result = subprocess.run(
+                    ["powershell", "-Command",
+                     f"(Get-Disk -Number {match.group(1)}).SerialNumber"],
+                    capture_output=True, text=True
+                )
+                return result.stdout.strip() or None
+        elif system == "Darwin":
+            result = subprocess.run(
+                ["diskutil", "info", "-plist", dev_path],
+                capture_output=True, text=True
+            )
+            import plistlib
+            info = plistlib.loads(result.stdout.encode())
+            return info.get("MediaUUID") or info.get("DiskUUID")
+    except Exception:
+        pass
+    return None
+
+def get_usb_location(dev_path):
+    """デバイスが接続されているUSBコントローラ・バス・ハブ・ポートをsysfsから取得する
+
+    同じbusのデバイスはルートハブ（コントローラ）の帯域を共有する。
+    取得できない場合（Linux以外、USB以外）はbusがNone
+    """
+    location = {"bus": None, "controller": None, "hub": None, "port": None, "speed_mbps": None}
+    if is_simulated(dev_path):
+        location["bus"] = device_bus(dev_path)
+        return location
+    if platform.system() != "Linux":
+        return location
+    try:
+        name = os.path.basename(os.path.realpath(dev_path))
+        # 例: /sys/devices/pci0000:00/0000:00:14.0/usb2/2-1/2-1.3/2-1.3:1.0/host6/...
+        parts = os.path.realpath(f"/sys/block/{name}/device").split("/")
+    except OSError:
+        return location
+    for i, part in enumerate(parts):
+        if re.match(r'^usb\d+$', part):
+            location["bus"] = part
+            location["controller"] = parts[i - 1] if i > 0 else None
+        elif re.match(r'^\d+-[\d.]+$', part):
+            location["port"] = part
+    port = location["port"]
+    if port:
+        # ポートの親（2-1.3 なら 2-1）がハブ。ルートハブ直結ならバスそのもの
+        location["hub"] = port.rsplit(".", 1)[0] if "." in port else location["bus"]
+        try:
+            with open(f"/sys/bus/usb/devices/{port}/speed") as f:
+                location["speed_mbps"] = float(f.read().strip())
+        except (OSError, ValueError):
+            pass
+    return location
+
 def _list_windows_usb_devices():
     """Windowsシステム上のUSBブロックデバイスを検出"""
     devices = []
@@ -262,7 +414,8 @@ def _list_windows_usb_devices():
         result = subprocess.run(
             ["powershell", "-Command", 
              "Get-Disk | Where-Object { $_.BusType -eq 'USB' } | " +
-             "Select-Object Number, FriendlyName, Size, OperationalStatus | " +
+             "Select-Object Number, FriendlyName, Size, LogicalSectorSize, PhysicalSectorSize, " +
+             "OperationalStatus | " +
              "ConvertTo-Json"],
             capture_output=True, text=True, check=True
         )
@@ -281,12 +434,13 @@ def _list_windows_usb_devices():
                         "id": f"\\\\?\\PhysicalDrive{disk_number}",  # 修正: 適切なデバイスパス形式
                         "name": disk.get("FriendlyName", "Unknown Device"),
                         "size": f"{disk.get('Size', 0) // (1024**3)} GB",
-                        "status": disk.get("OperationalStatus", "Unknown")
+                        "status": disk.get("OperationalStatus", "Unknown"),
+                        **_windows_geometry(disk)
                     })
                 
         return devices
     except Exception as e:
-        print(f"Error listing Windows USB devices: {e}")
+        log("device", f"Error listing Windows USB devices: {e}", level="error")
         return []
 
 def _is_disk_accessible(disk_number):
@@ -297,7 +451,7 @@ def _is_disk_accessible(disk_number):
         
         # 管理者権限がなければFalseを返す
         if not _is_admin():
-            print(f"Warning: Admin privileges required to access {device_path}")
+            log("device", f"Admin privileges required to access {device_path}", level="warning")
             return False
             
         # FILEオブジェクトをCtypesで開いてみる
@@ -306,6 +460,7 @@ def _is_disk_accessible(disk_number):
         FILE_SHARE_READ = 0x00000001
         FILE_SHARE_WRITE = 0x00000002
         
+        import ctypes
         handle = ctypes.windll.kernel32.CreateFileW(
             device_path,
             GENERIC_READ,
@@ -323,12 +478,13 @@ def _is_disk_accessible(disk_number):
         ctypes.windll.kernel32.CloseHandle(handle)
         return True
     except Exception as e:
-        print(f"Error checking disk accessibility: {e}")
+        log("device", f"Error checking disk accessibility: {e}", level="error")
         return False
 
 def _is_admin():
     """現在のプロセスが管理者権限で実行されているかチェック"""
     try:
+        import ctypes
         return ctypes.windll.shell32.IsUserAnAdmin() != 0
     except:
         return False
@@ -362,12 +518,13 @@ def _list_macos_usb_devices():
                 "name": info_data.get("MediaName", "Unknown Device"),
                 "size": info_data.get("TotalSize", 0) // (1024**2),
                 "removable": info_data.get("Removable", True),
-                "ejectable": info_data.get("Ejectable", True)
+                "ejectable": info_data.get("Ejectable", True),
+                **_macos_geometry(info_data)
             })
             
         return devices
     except Exception as e:
-        print(f"Error listing macOS USB devices: {e}")
+        log("device", f"Error listing macOS USB devices: {e}", level="error")
         return []
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+import os
+import re
+import json
+import time
+import hashlib
+import http_source
+from log_pipeline import log
+
+# ジャーナルの保存先。環境変数で変更可能
+JOURNAL_DIR = os.environ.get(
+    "YAKERU_JOURNAL_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "journal")
+)
+# 何バイト書き込むごとにfsyncしてジャーナルを更新するか
+CHECKPOINT_INTERVAL = int(os.environ.get("YAKERU_CHECKPOINT_INTERVAL_MB", "256")) * 1024 * 1024
+# 再開時に照合する、書き込み済み領域末尾のサイズ
+VERIFY_TAIL_SIZE = 4 * 1024 * 1024
+# イメージ識別用にハッシュを取る先頭・末尾のサイズ
+IDENTITY_SAMPLE_SIZE = 1024 * 1024
+
+
+def journal_key(device_path, serial=None):
+    """ジャーナルのキーを決める（シリアルがあればシリアル、なければデバイスパス）"""
+    raw = serial or f"path-{device_path}"
+    return re.sub(r'[^A-Za-z0-9._-]', '_', raw)
+
+
+def image_identity(iso_path):
+    """ISOファイルを識別する情報（名前・サイズ・更新時刻・先頭と末尾のハッシュ）"""
+    if http_source.is_url(iso_path):
+        return http_source.identity(iso_path)
+    stat = os.stat(iso_path)
+    digest = hashlib.sha256()
+    with open(iso_path, 'rb') as f:
+        digest.update(f.read(IDENTITY_SAMPLE_SIZE))
+        if stat.st_size > IDENTITY_SAMPLE_SIZE:
+            f.seek(max(stat.st_size - IDENTITY_SAMPLE_SIZE, IDENTITY_SAMPLE_SIZE))
+            digest.update(f.read(IDENTITY_SAMPLE_SIZE))
+    return {
+        "name": os.path.basename(iso_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sample_sha256": digest.hexdigest(),
+    }
+
+
+def _journal_path(key):
+    return os.path.join(JOURNAL_DIR, f"{key}.json")
+
+
+def load(key):
+    """ジャーナルを読み込む（存在しない・壊れている場合はNone）"""
+    try:
+        with open(_journal_path(key), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save(key, device_path, identity, offset):
+    """同期済みオフセットをジャーナルに原子的に書き込む"""
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    entry = {
+        "key": key,
+        "device": device_path,
+        "image": identity,
+        "synced_offset": offset,
+        "updated_at": time.time(),
+    }
+    path = _journal_path(key)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(entry, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def clear(key):
+    """書き込み完了後にジャーナルを削除する"""
+    try:
+        os.unlink(_journal_path(key))
+    except FileNotFoundError:
+        pass
+
+
+def list_journals():
+    """再開可能なジャーナルの一覧"""
+    if not os.path.isdir(JOURNAL_DIR):
+        return []
+    entries = []
+    for name in sorted(os.listdir(JOURNAL_DIR)):
+        if name.endswith(".json"):
+            entry = load(name[:-len(".json")])
+            if entry is not None:
+                entries.append(entry)
+    return entries
+
+
+def resume_offset(key, identity):
+    """ジャーナルが同じイメージのものであれば、再開可能なオフセットを返す"""
+    entry = load(key)
+    if entry is None or entry.get("image") != identity:
+        return 0
+    offset = int(entry.get("synced_offset", 0))
+    if offset <= 0 or offset > identity["size"]:
+        return 0
+    return offset
+
+
+def verify_tail(iso_path, device_path, offset, size=VERIFY_TAIL_SIZE):
+    """書き込み済み領域の末尾がISOと一致するか確認する"""
+    import device_io
+    start = max(offset - size, 0)
+    length = offset - start
+    try:
+        if http_source.is_url(iso_path):
+            expected = http_source.read_range(iso_path, start, length)
+        else:
+            with open(iso_path, 'rb') as iso_file:
+                iso_file.seek(start)
+                expected = iso_file.read(length)
+        with device_io.open_device(device_path) as device:
+            # ページキャッシュではなくデバイス上の内容を読む
+            device.drop_cache(start, length)
+            return expected == device.pread(length, start)
+    except OSError as e:
+        log("journal", f"Failed to verify written region: {e}", level="warning")
+        return False
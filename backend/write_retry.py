@@ -0,0 +1,150 @@
+import os
+import errno
+import random
+import time
+
+# 既定のリトライ設定。環境変数で上書き可能
+DEFAULT_MAX_RETRIES = int(os.environ.get("YAKERU_RETRY_MAX", "10"))
+DEFAULT_RETRY_BUDGET = float(os.environ.get("YAKERU_RETRY_BUDGET", "120"))
+
+# エラー分類
+TRANSIENT = "transient"        # 再試行する価値がある（EIOなど）
+NO_SPACE = "no_space"          # 容量不足。再試行しても無駄
+DEVICE_GONE = "device_gone"    # デバイスが取り外された
+READ_ONLY = "read_only"        # 書き込み禁止・権限不足
+FATAL = "fatal"                # その他の再試行不能なエラー
+
+_TRANSIENT_ERRNOS = {errno.EIO, errno.EAGAIN, errno.EINTR, errno.ETIMEDOUT, errno.EBUSY}
+_NO_SPACE_ERRNOS = {errno.ENOSPC, errno.EFBIG}
+_DEVICE_GONE_ERRNOS = {errno.ENODEV, errno.ENXIO, errno.ENOENT, errno.EBADF}
+_READ_ONLY_ERRNOS = {errno.EROFS, errno.EACCES, errno.EPERM}
+for _name in ("ENOMEDIUM", "ESHUTDOWN"):
+    if hasattr(errno, _name):
+        _DEVICE_GONE_ERRNOS.add(getattr(errno, _name))
+
+# Windowsのエラーコード
+_WIN_TRANSIENT = {1, 23, 31, 121, 1117}   # INVALID_FUNCTION, CRC, GEN_FAILURE, SEM_TIMEOUT, IO_DEVICE
+_WIN_NO_SPACE = {39, 112}                 # HANDLE_DISK_FULL, DISK_FULL
+_WIN_DEVICE_GONE = {2, 21, 55, 1167}      # FILE_NOT_FOUND, NOT_READY, DEV_NOT_EXIST, DEVICE_NOT_CONNECTED
+_WIN_READ_ONLY = {5, 19}                  # ACCESS_DENIED, WRITE_PROTECT
+
+
+def classify_error(exc):
+    """書き込みエラーを分類する"""
+    winerror = getattr(exc, "winerror", None)
+    if winerror is not None:
+        if winerror in _WIN_TRANSIENT:
+            return TRANSIENT
+        if winerror in _WIN_NO_SPACE:
+            return NO_SPACE
+        if winerror in _WIN_DEVICE_GONE:
+            return DEVICE_GONE
+        if winerror in _WIN_READ_ONLY:
+            return READ_ONLY
+        return FATAL
+
+    code = getattr(exc, "errno", None)
+    if code in _TRANSIENT_ERRNOS:
+        return TRANSIENT
+    if code in _NO_SPACE_ERRNOS:
+        return NO_SPACE
+    if code in _DEVICE_GONE_ERRNOS:
+        return DEVICE_GONE
+    if code in _READ_ONLY_ERRNOS:
+        return READ_ONLY
+    if code is None:
+        # errnoのないOSError（短い書き込みが続いた場合など）は一時的なものとして扱う
+        return TRANSIENT
+    return FATAL
+
+
+class RetryPolicy:
+    """指数バックオフ（ジッター付き）と全体の時間予算
+
+    max_retries は同じ範囲に対する連続リトライ回数の上限、
+    total_budget は1ジョブ全体でリトライ待機に使ってよい秒数
+    """
+
+    def __init__(self, max_retries=None, base_delay=0.5, max_delay=10.0, total_budget=None,
+                 multiplier=2.0, jitter=0.5):
+        if max_retries is None:
+            max_retries = DEFAULT_MAX_RETRIES
+        if total_budget is None:
+            total_budget = DEFAULT_RETRY_BUDGET
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.total_budget = total_budget
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        """attempt回目（1始まり）のリトライ前の待機時間"""
+        delay = min(self.base_delay * (self.multiplier ** (attempt - 1)), self.max_delay)
+        # 一部をランダム化して、複数デバイスのリトライが同時に集中しないようにする
+        return delay * (1 - self.jitter) + random.uniform(0, delay * self.jitter)
+
+
+class WriteRetryEngine:
+    """オフセット指定の書き込みを、部分書き込みとリトライを考慮して行う
+
+    write_at(view, offset) は書き込んだバイト数を返す関数（os.pwriteなど）。
+    失敗した場合は未書き込みの範囲だけを同じオフセットから書き直す。
+    """
+
+    def __init__(self, write_at, policy=None, on_retry=None, sleep=time.sleep,
+                 device_present=None):
+        self.write_at = write_at
+        self.policy = policy or RetryPolicy()
+        self.on_retry = on_retry
+        self.sleep = sleep
+        self.device_present = device_present
+        self.total_retries = 0
+        self.backoff_time = 0.0
+
+    def write(self, data, offset):
+        """dataをoffsetから全て書き込む。書き込んだバイト数を返す"""
+        view = memoryview(data)
+        if view.ndim != 1 or view.itemsize != 1:
+            view = view.cast("B")
+        length = len(view)
+        done = 0
+        attempt = 0
+        while done < length:
+            try:
+                written = self.write_at(view[done:], offset + done)
+                if written <= 0:
+                    raise OSError(f"Device accepted 0 bytes at offset {offset + done}")
+                done += written
+                # 書き込みが進んだら連続リトライ回数をリセット
+                attempt = 0
+                continue
+            except OSError as e:
+                kind = classify_error(e)
+                if kind == TRANSIENT and self.device_present is not None and not self.device_present():
+                    kind = DEVICE_GONE
+                if kind != TRANSIENT:
+                    raise _annotate(e, offset + done, kind, attempt) from e
+
+                attempt += 1
+                delay = self.policy.delay(attempt)
+                if attempt > self.policy.max_retries:
+                    raise _annotate(e, offset + done, "retries exhausted", attempt - 1) from e
+                if self.backoff_time + delay > self.policy.total_budget:
+                    raise _annotate(e, offset + done, "retry time budget exhausted", attempt - 1) from e
+
+                self.total_retries += 1
+                self.backoff_time += delay
+                if self.on_retry:
+                    self.on_retry(attempt, delay, e, offset + done)
+                self.sleep(delay)
+        return done
+
+
+def _annotate(exc, offset, kind, retries):
+    """元のerrnoを保ったまま、オフセットと分類をメッセージに加える"""
+    message = f"Write failed at offset {offset} ({kind}, {retries} retries): {exc.strerror or exc}"
+    code = exc.errno if exc.errno is not None else errno.EIO
+    error = OSError(code, message)
+    error.write_error_kind = kind
+    return error